@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+取引時間中の増分再スキャン（intraday_scan）の1周期あたりの処理時間
+
+合成した株価行列（銘柄数 × 65週 + 当日）から65週高値を求め、ローカルの代替フィード（JSONL）に
+1周期ごとに一部の銘柄の新しい足を追記しながら、足の読み込み → 当日高値の更新 → ブレイク判定を繰り返す。
+
+使い方例:
+  python benchmarks/bench_intraday.py                          # 4000銘柄, 1周期あたり全銘柄の25%に新しい足
+  python benchmarks/bench_intraday.py --codes 10000 --cycles 50 --update-ratio 1.0
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+import numpy as np
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+os.environ.setdefault('METRICS_DIR', '')
+
+import intraday_scan  # noqa: E402
+import price_matrix  # noqa: E402
+import trading_calendar  # noqa: E402
+
+
+def build_matrix(path, n_codes, calendar, today, rng):
+    sessions = calendar.sessions_between(calendar.window_start(today), calendar.previous_session(today))
+    codes = [f"{1000 + i}0" for i in range(n_codes)]
+    writer = price_matrix.MatrixWriter(codes, sessions, path)
+    walk = 1000 * np.exp(np.cumsum(rng.normal(0, 0.02, size=(n_codes, len(sessions))), axis=1))
+    dates = np.array(sessions, dtype='int32')
+    for i, code in enumerate(codes):
+        writer.add(code, {'date': dates, 'High': walk[i] * 1.01, 'Low': walk[i] * 0.99,
+                          'Close': walk[i], 'Volume': np.full(len(dates), 1e5)})
+        writer.mark_complete(code)
+    return writer.commit(), walk[:, -1]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--codes', type=int, default=4000)
+    parser.add_argument('--cycles', type=int, default=30)
+    parser.add_argument('--update-ratio', type=float, default=0.25, help='1周期に新しい足が届く銘柄の割合')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    today = datetime(2026, 10, 19)
+    calendar = trading_calendar.TradingCalendar.weekdays(today - timedelta(days=800), today + timedelta(days=30))
+    today_ord = int(calendar.session_on_or_before(today))
+    with tempfile.TemporaryDirectory() as tmp:
+        t0 = time.perf_counter()
+        matrix, last_close = build_matrix(os.path.join(tmp, 'matrix'), args.codes, calendar, today_ord, rng)
+        print(f"行列作成: {matrix.describe()}（{time.perf_counter() - t0:.1f}秒）")
+        t0 = time.perf_counter()
+        state = intraday_scan.RollingHighState.from_matrix(matrix, calendar, today_ord)
+        print(f"65週高値の計算: {(time.perf_counter() - t0) * 1000:.1f}ms")
+
+        bars = os.path.join(tmp, 'bars.jsonl')
+        feed = intraday_scan.FileFeed(bars)
+        price = last_close.copy()
+        latencies = []
+        hits = 0
+        for _ in range(args.cycles):
+            k = max(int(args.codes * args.update_ratio), 1)
+            idx = rng.choice(args.codes, size=k, replace=False)
+            price[idx] *= np.exp(rng.normal(0.002, 0.01, size=k))
+            with open(bars, 'a', encoding='utf-8') as f:
+                f.write(''.join(json.dumps({'Code': state.codes[i], 'High': round(float(price[i]), 1)}) + '\n' for i in idx))
+            t0 = time.perf_counter()
+            records = feed.poll()
+            ix, highs = state.arrays(records)
+            hits += len(state.apply(ix, highs))
+            latencies.append(time.perf_counter() - t0)
+        ms = np.array(latencies) * 1000
+        print(f"{args.codes}銘柄, 1周期 {k}本: p50 {np.percentile(ms, 50):.2f}ms, p99 {np.percentile(ms, 99):.2f}ms, "
+              f"最大 {ms.max():.2f}ms, ブレイク {hits}銘柄")
+        del matrix
+
+
+if __name__ == '__main__':
+    main()
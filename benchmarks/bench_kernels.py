@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+計算カーネルのマイクロベンチマーク（回帰ゲート付き）
+
+対象:
+  scan.count_new_highs        step1 の新高値更新回数カウント（65週分の日足 × 銘柄数）
+  score.comprehensive         step2 の calculate_comprehensive_score（形状バランス込み、銘柄数回）
+  normalize.impute_and_scale  step2 の欠損補完 + Min-Maxスケーリング（銘柄数 × 7指標）
+
+合成入力を 10^2, 10^3, 10^4 銘柄で生成し、1回あたりの秒数（合計 MIN_TIME_S 以上になるまで繰り返し呼んで
+回数で割った値）の best-of-N を計測する。
+
+使い方例:
+  python benchmarks/bench_kernels.py                      # 計測して表示
+  python benchmarks/bench_kernels.py --save-baseline      # kernel_baselines.json を更新
+  python benchmarks/bench_kernels.py --check              # 基準値より THRESHOLD 倍以上遅ければ exit 1
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(HERE)
+sys.path.insert(0, REPO_ROOT)
+
+# トークンがあると計測中に誤って API を呼ぶことがないよう、ベンチマークでは外しておく
+for _k in ('JQUANTS_TOKEN', 'JQUANTS_ACCESS_TOKEN'):
+    os.environ.pop(_k, None)
+os.environ.setdefault('METRICS_DIR', '')
+
+import step1_stock_scanner as step1  # noqa: E402
+import step2_metrics_analysis as step2  # noqa: E402
+
+BASELINE_FILE = os.path.join(HERE, 'kernel_baselines.json')
+DEFAULT_SIZES = (100, 1000, 10000)
+SESSIONS_65W = 320
+# 1回の計測で内側ループを回す最短時間（秒）
+MIN_TIME_S = float(os.environ.get('BENCH_MIN_TIME_S', '0.1'))
+METRIC_KEYS = ['new_high_count', 'volume_ratio', 'roe', 'per_inv', 'market_cap_inv', 'eps', 'volatility']
+
+
+def make_price_series(n_codes, n_sessions=SESSIONS_65W, seed=0):
+    """check_65w_high_intraday が扱うのと同じ形（日付昇順の高値配列）を銘柄数分"""
+    rng = np.random.default_rng(seed)
+    walks = 1000 * np.exp(np.cumsum(rng.normal(0, 0.02, (n_codes, n_sessions)), axis=1))
+    walks[rng.random(walks.shape) < 0.01] = np.nan
+    return list(walks)
+
+
+def make_score_vectors(n_codes, seed=0):
+    rng = np.random.default_rng(seed)
+    return rng.random((n_codes, 7)).tolist()
+
+
+def make_metrics(n_codes, seed=0):
+    """get_7_metrics の出力と同じ形（一部 None、全欠損列あり）"""
+    rng = np.random.default_rng(seed)
+    out = {}
+    for i in range(n_codes):
+        m = {k: float(v) for k, v in zip(METRIC_KEYS, rng.normal(0, 1, 7))}
+        if rng.random() < 0.3:
+            m['roe'] = None
+        m['volatility'] = None
+        out[f"{1300 + i:05d}"] = m
+    return out
+
+
+def kernel_count_new_highs(series):
+    for highs in series:
+        step1.count_new_highs(highs)
+
+
+def kernel_comprehensive(vectors):
+    for v in vectors:
+        step2.calculate_comprehensive_score(v)
+
+
+def kernel_impute_and_scale(metrics):
+    step2.impute_and_scale(pd.DataFrame(metrics).T)
+
+
+KERNELS = {
+    'scan.count_new_highs': (make_price_series, kernel_count_new_highs),
+    'score.comprehensive': (make_score_vectors, kernel_comprehensive),
+    'normalize.impute_and_scale': (make_metrics, kernel_impute_and_scale),
+}
+
+
+def measure(fn, arg, repeat, budget_s, min_time_s=MIN_TIME_S):
+    """1回あたりの秒数の best-of-repeat。
+
+    サブミリ秒のカーネルは1回の計測ではノイズが大きいため、timeit.Timer.autorange と同様に
+    合計が min_time_s 以上になるまで呼び出し回数を増やして計り、回数で割る。
+    1回あたりが budget_s を超えたらそれ以上繰り返さない。
+    """
+    best = None
+    for _ in range(repeat):
+        number = 1
+        while True:
+            t0 = time.perf_counter()
+            for _ in range(number):
+                fn(arg)
+            total = time.perf_counter() - t0
+            if total >= min_time_s:
+                break
+            number = number * 2 if total * 10 < min_time_s else int(number * min_time_s / total) + 1
+        dt = total / number
+        best = dt if best is None else min(best, dt)
+        if dt > budget_s:
+            break
+    return best
+
+
+def run(sizes, kernels, repeat, budget_s, min_time_s=MIN_TIME_S):
+    results = {}
+    for name in kernels:
+        make, fn = KERNELS[name]
+        for n in sizes:
+            data = make(n)
+            fn(data)  # ウォームアップ（import・キャッシュの影響を除く）
+            results[f"{name}@{n}"] = measure(fn, data, repeat, budget_s, min_time_s)
+            print(f"{name:28s} n={n:>6d}  {results[f'{name}@{n}'] * 1000:10.2f} ms")
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Micro-benchmarks for scan/scoring/normalization kernels')
+    parser.add_argument('--sizes', default=','.join(str(s) for s in DEFAULT_SIZES))
+    parser.add_argument('--kernels', default=','.join(KERNELS), help='対象カーネル（カンマ区切り）')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--budget-s', type=float, default=2.0, help='1回がこの秒数を超えたら繰り返さない')
+    parser.add_argument('--min-time-s', type=float, default=MIN_TIME_S,
+                        help='1回の計測でカーネルを繰り返し呼ぶ最短時間（秒）')
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--check', action='store_true', help='基準値と比較し、回帰があれば exit 1')
+    parser.add_argument('--threshold', type=float, default=float(os.environ.get('BENCH_THRESHOLD', '1.5')),
+                        help='許容する 計測値/基準値 の比率')
+    parser.add_argument('--output', default=None, help='計測結果JSONの出力先')
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(',') if s.strip()]
+    kernels = [k.strip() for k in args.kernels.split(',') if k.strip()]
+    unknown = [k for k in kernels if k not in KERNELS]
+    if unknown:
+        parser.error(f"unknown kernels: {', '.join(unknown)}")
+
+    results = run(sizes, kernels, args.repeat, args.budget_s, args.min_time_s)
+    meta = {'python': platform.python_version(), 'machine': platform.machine(),
+            'numpy': np.__version__, 'pandas': pd.__version__}
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump({'meta': meta, 'results': results}, f, indent=2)
+
+    if args.save_baseline:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline, 'r', encoding='utf-8') as f:
+                baseline = json.load(f).get('results', {})
+        baseline.update({k: round(v, 6) for k, v in results.items()})
+        with open(args.baseline, 'w', encoding='utf-8') as f:
+            json.dump({'meta': meta, 'results': dict(sorted(baseline.items()))}, f, indent=2)
+            f.write('\n')
+        print(f"基準値を保存: {args.baseline}")
+
+    if args.check:
+        if not os.path.exists(args.baseline):
+            print(f"基準値ファイルがありません: {args.baseline}")
+            return 2
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            baseline = json.load(f).get('results', {})
+        regressions = []
+        print(f"\n{'kernel':36s} {'baseline_ms':>12s} {'now_ms':>10s} {'ratio':>7s}")
+        for key, now in results.items():
+            base = baseline.get(key)
+            if not base:
+                print(f"{key:36s} {'-':>12s} {now * 1000:10.2f}    (no baseline)")
+                continue
+            ratio = now / base
+            flag = '  REGRESSION' if ratio > args.threshold else ''
+            print(f"{key:36s} {base * 1000:12.2f} {now * 1000:10.2f} {ratio:7.2f}{flag}")
+            if ratio > args.threshold:
+                regressions.append(key)
+        if regressions:
+            print(f"\n✗ {len(regressions)}件のカーネルが基準値の{args.threshold}倍を超えました: {', '.join(regressions)}")
+            return 1
+        print(f"\n✓ 回帰なし（閾値 {args.threshold}倍）")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
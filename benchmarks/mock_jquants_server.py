@@ -0,0 +1,378 @@
+#!/usr/bin/env python3
+"""
+ローカル用 J-Quants モックサーバ（性能計測用）
+
+合成データのユニバース（銘柄数・年数を指定）を生成し、パイプラインが使う以下のエンドポイントを返す:
+  POST /v1/token/auth_refresh, /v1/token/auth_user
+  GET  /v1/listed/info, /v1/prices/daily_quotes, /v1/fins/statements, /v1/fins/fs_details,
+       /v1/markets/trading_calendar, /v1/fins/announcement
+--page-size を指定すると一覧系の応答を pagination_key 付きで分割して返す。
+レイテンシ・429・5xx を確率的に注入できる。GET /__stats でエンドポイント別の処理件数を返す。
+
+使い方例:
+  python benchmarks/mock_jquants_server.py --codes 600 --years 2 --latency-ms 20 --rate-429 0.01
+  JQUANTS_API_BASE=http://127.0.0.1:8765/v1 JQUANTS_TOKEN=mock python step1_stock_scanner.py
+"""
+import argparse
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import numpy as np
+
+MOCK_ID_TOKEN = 'mock-id-token'
+MOCK_REFRESH_TOKEN = 'mock-refresh-token'
+
+# fs_details のキー表記ゆれ（IFRS/日本基準）を再現する
+PROFIT_KEYS = ['Profit (loss) attributable to owners of parent (IFRS)',
+               'Profit (loss) attributable to owners of parent']
+NCI_KEYS = ['Non-controlling interests (IFRS)', 'Non-controlling interests']
+
+
+def _parse_date(s):
+    s = s.replace('-', '')
+    return date(int(s[0:4]), int(s[4:6]), int(s[6:8]))
+
+
+class SyntheticUniverse:
+    """銘柄コードごとに決定的な（seed固定の）株価・財務データを生成する"""
+
+    def __init__(self, n_codes=600, years=2, seed=42, new_high_ratio=0.05, end_date=None, fy_years=5):
+        self.n_codes = n_codes
+        self.years = years
+        self.seed = seed
+        self.new_high_ratio = new_high_ratio
+        self.end_date = end_date or date.today()
+        self.fy_years = fy_years
+        self.codes = [f"{1300 + i:04d}0" for i in range(n_codes)]
+        self._code_set = set(self.codes)
+        start = self.end_date - timedelta(days=int(365.25 * years) + 1)
+        # 平日のみを営業日とみなす（祝日は考慮しない）
+        self.sessions = np.arange(np.datetime64(start), np.datetime64(self.end_date) + 1, dtype='datetime64[D]')
+        self.sessions = self.sessions[np.is_busday(self.sessions)]
+        self.session_strs = np.datetime_as_string(self.sessions, unit='D')
+
+    def _rng(self, code, salt=0):
+        return np.random.default_rng((self.seed * 1_000_003 + int(code[:4]) * 31 + salt) & 0xFFFFFFFF)
+
+    def listed_info(self):
+        rows = []
+        for i, code in enumerate(self.codes):
+            rows.append({
+                'Date': self.end_date.isoformat(),
+                'Code': code,
+                'CompanyName': f"合成銘柄{code[:4]}",
+                'CompanyNameEnglish': f"Synthetic {code[:4]}",
+                'Sector17Code': str(1 + i % 17),
+                'Sector33Code': f"{(i % 33 + 1) * 50:04d}",
+                'ScaleCategory': '-',
+                'MarketCode': '0113',
+                'MarketCodeName': 'グロース',
+            })
+        return rows
+
+    @lru_cache(maxsize=1024)
+    def prices(self, code):
+        """(Open, High, Low, Close, Volume) の配列を返す"""
+        n = len(self.sessions)
+        rng = self._rng(code)
+        base = float(rng.uniform(200, 5000))
+        close = base * np.exp(np.cumsum(rng.normal(0.0003, 0.02, n)))
+        spread = np.abs(rng.normal(0, 0.01, n))
+        high = close * (1 + spread)
+        low = close * (1 - np.abs(rng.normal(0, 0.01, n)))
+        opn = (high + low) / 2
+        volume = rng.integers(1_000, 2_000_000, n).astype('float64')
+        # 一定割合の銘柄は最終日に高値を更新させる
+        if rng.random() < self.new_high_ratio and n > 1:
+            high[-1] = max(high[-1], high[:-1].max() * 1.02)
+            close[-1] = high[-1] * 0.99
+        return opn.round(1), high.round(1), low.round(1), close.round(1), volume
+
+    def daily_quotes(self, code, date_str=None, from_str=None, to_str=None):
+        if code not in self._code_set:
+            return []
+        if date_str:
+            lo = hi = np.datetime64(_parse_date(date_str))
+        else:
+            lo = np.datetime64(_parse_date(from_str)) if from_str else self.sessions[0]
+            hi = np.datetime64(_parse_date(to_str)) if to_str else self.sessions[-1]
+        i0 = int(np.searchsorted(self.sessions, lo, side='left'))
+        i1 = int(np.searchsorted(self.sessions, hi, side='right'))
+        opn, high, low, close, volume = self.prices(code)
+        rows = []
+        for i in range(i0, i1):
+            rows.append({
+                'Date': self.session_strs[i], 'Code': code,
+                'Open': opn[i], 'High': high[i], 'Low': low[i], 'Close': close[i],
+                'UpperLimit': '0', 'LowerLimit': '0',
+                'Volume': volume[i], 'TurnoverValue': round(volume[i] * close[i], 0),
+                'AdjustmentFactor': 1.0,
+                'AdjustmentOpen': opn[i], 'AdjustmentHigh': high[i], 'AdjustmentLow': low[i],
+                'AdjustmentClose': close[i], 'AdjustmentVolume': volume[i],
+            })
+        return rows
+
+    def trading_calendar(self, from_str=None, to_str=None):
+        """平日を営業日（HolidayDivision=1）、土日を休業日（0）として返す"""
+        lo = np.datetime64(_parse_date(from_str)) if from_str else self.sessions[0]
+        hi = np.datetime64(_parse_date(to_str)) if to_str else self.sessions[-1]
+        days = np.arange(lo, hi + 1, dtype='datetime64[D]')
+        busy = np.is_busday(days)
+        return [{'Date': d, 'HolidayDivision': '1' if b else '0'}
+                for d, b in zip(np.datetime_as_string(days, unit='D'), busy)]
+
+    @lru_cache(maxsize=4096)
+    def _fy_rows(self, code):
+        rng = self._rng(code, salt=1)
+        shares = float(rng.integers(1_000_000, 10_000_000))
+        equity = float(rng.uniform(1e9, 8e9))
+        rows = []
+        last_fy = self.end_date.year - (1 if self.end_date.month < 6 else 0)
+        for k in range(self.fy_years):
+            y = last_fy - (self.fy_years - 1 - k)
+            profit = equity * float(rng.normal(0.08, 0.06))
+            nci = equity * float(rng.uniform(0, 0.05))
+            equity = max(equity + profit * 0.7, 1e8)
+            eps = profit / shares
+            rows.append({
+                'DisclosedDate': f"{y}-05-14", 'DisclosedTime': '15:00:00',
+                'LocalCode': code, 'TypeOfDocument': 'FYFinancialStatements_Consolidated_JP',
+                'TypeOfCurrentPeriod': 'FY',
+                'CurrentPeriodStartDate': f"{y - 1}-04-01", 'CurrentPeriodEndDate': f"{y}-03-31",
+                'NetSales': str(round(equity * 1.5)), 'OperatingProfit': str(round(profit * 1.3)),
+                'Profit': str(round(profit)), 'EarningsPerShare': f"{eps:.2f}",
+                'DilutedEarningsPerShare': f"{eps:.2f}" if eps > 0 else '',
+                'TotalAssets': str(round(equity * 2.2)), 'Equity': str(round(equity)),
+                'NumberOfIssuedAndOutstandingSharesAtTheEndOfFiscalYearIncludingTreasuryStock': str(int(shares)),
+                '_profit_to_owners': profit, '_nci': nci,
+            })
+        return tuple(rows)
+
+    def statements(self, code):
+        if code not in self._code_set:
+            return []
+        return [{k: v for k, v in r.items() if not k.startswith('_')} for r in self._fy_rows(code)]
+
+    def statements_by_date(self, date_str):
+        """その日に開示された statements（全銘柄）"""
+        d = _parse_date(date_str).isoformat()
+        return [{k: v for k, v in r.items() if not k.startswith('_')}
+                for code in self.codes for r in self._fy_rows(code) if r['DisclosedDate'] == d]
+
+    def announcements(self):
+        """翌営業日の決算発表予定（合成データでは FY 開示日の前営業日のみ返す）"""
+        nxt = np.busday_offset(np.datetime64(self.end_date), 1, roll='forward')
+        d = str(nxt)
+        return [{'Date': d, 'Code': code, 'CompanyName': f"合成銘柄{code[:4]}", 'FiscalYear': '3月期',
+                 'FiscalQuarter': 'FY', 'SectorName': '-', 'Section': 'マザーズ'}
+                for code in self.codes if any(r['DisclosedDate'] == d for r in self._fy_rows(code))]
+
+    def fs_details(self, code, date_str):
+        if code not in self._code_set:
+            return []
+        d = _parse_date(date_str).isoformat()
+        for r in self._fy_rows(code):
+            if r['DisclosedDate'] == d:
+                ifrs = int(code[:4]) % 2
+                return [{
+                    'DisclosedDate': d, 'LocalCode': code, 'TypeOfDocument': r['TypeOfDocument'],
+                    'FinancialStatement': {
+                        PROFIT_KEYS[1 - ifrs]: str(round(r['_profit_to_owners'])),
+                        NCI_KEYS[1 - ifrs]: str(round(r['_nci'])),
+                        'Equity': r['Equity'],
+                    },
+                }]
+        return []
+
+
+class FaultConfig:
+    def __init__(self, latency_ms=0.0, jitter_ms=0.0, rate_429=0.0, rate_5xx=0.0, seed=0):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def draw(self):
+        """(sleep_seconds, forced_status or None)"""
+        with self._lock:
+            delay = max(0.0, self.latency_ms + self._rng.uniform(-self.jitter_ms, self.jitter_ms)) / 1000.0
+            r = self._rng.random()
+        if r < self.rate_429:
+            return delay, 429
+        if r < self.rate_429 + self.rate_5xx:
+            return delay, 503
+        return delay, None
+
+
+class MockState:
+    def __init__(self, universe, faults, page_size=0):
+        self.universe = universe
+        self.faults = faults
+        self.page_size = page_size
+        self.stats = defaultdict(lambda: defaultdict(int))
+        self.lock = threading.Lock()
+
+    def count(self, path, status):
+        with self.lock:
+            self.stats[path][str(status)] += 1
+
+    def stats_json(self):
+        with self.lock:
+            per = {p: dict(v) for p, v in self.stats.items()}
+        return {'endpoints': per, 'total': sum(sum(v.values()) for v in per.values())}
+
+    def reset(self):
+        with self.lock:
+            self.stats.clear()
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, fmt, *args):  # アクセスログは出さない
+            pass
+
+        def _send(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False, default=float).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _dispatch(self, method):
+            u = urlparse(self.path)
+            q = {k: v[0] for k, v in parse_qs(u.query).items()}
+            path = u.path.rstrip('/')
+            if path == '/__stats':
+                return self._send(200, state.stats_json())
+            if path == '/__reset':
+                state.reset()
+                return self._send(200, {'ok': True})
+
+            ep = path[len('/v1/'):] if path.startswith('/v1/') else path.lstrip('/')
+            delay, forced = state.faults.draw()
+            if delay:
+                time.sleep(delay)
+            if forced:
+                state.count(ep, forced)
+                msg = 'Too Many Requests' if forced == 429 else 'Service Unavailable'
+                return self._send(forced, {'message': msg})
+
+            status, payload = self._route(method, ep, q)
+            state.count(ep, status)
+            self._send(status, payload)
+
+        def _page(self, list_key, rows, q):
+            """page_size 件ずつ返す（pagination_key は次ページ先頭のオフセット）"""
+            size = state.page_size
+            if not size or len(rows) <= size:
+                return 200, {list_key: rows}
+            try:
+                offset = int(q.get('pagination_key') or 0)
+            except ValueError:
+                return 400, {'message': 'invalid pagination_key'}
+            payload = {list_key: rows[offset:offset + size]}
+            if offset + size < len(rows):
+                payload['pagination_key'] = str(offset + size)
+            return 200, payload
+
+        def _route(self, method, ep, q):
+            uni = state.universe
+            if ep == 'token/auth_refresh' and method == 'POST':
+                return 200, {'idToken': MOCK_ID_TOKEN}
+            if ep == 'token/auth_user' and method == 'POST':
+                return 200, {'refreshToken': MOCK_REFRESH_TOKEN}
+            if not (self.headers.get('Authorization') or '').startswith('Bearer '):
+                return 401, {'message': 'The incoming token is invalid or expired.'}
+            if ep == 'listed/info':
+                return self._page('info', uni.listed_info(), q)
+            if ep == 'prices/daily_quotes':
+                if 'code' not in q:
+                    if 'date' not in q:
+                        return 400, {'message': 'code or date is required'}
+                    return self._page('daily_quotes', [r for code in uni.codes for r in uni.daily_quotes(code, q['date'])], q)
+                return self._page('daily_quotes', uni.daily_quotes(q['code'], q.get('date'), q.get('from'), q.get('to')), q)
+            if ep == 'markets/trading_calendar':
+                return self._page('trading_calendar', uni.trading_calendar(q.get('from'), q.get('to')), q)
+            if ep == 'fins/statements':
+                if 'date' in q and 'code' not in q:
+                    return self._page('statements', uni.statements_by_date(q['date']), q)
+                return self._page('statements', uni.statements(q.get('code', '')), q)
+            if ep == 'fins/announcement':
+                return self._page('announcement', uni.announcements(), q)
+            if ep == 'fins/fs_details':
+                return self._page('fs_details', uni.fs_details(q.get('code', ''), q.get('date', '19700101')), q)
+            return 404, {'message': f'unknown endpoint: {ep}'}
+
+        def do_GET(self):
+            self._dispatch('GET')
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length') or 0)
+            if length:
+                self.rfile.read(length)
+            self._dispatch('POST')
+
+    return Handler
+
+
+def start_server(universe, faults, host='127.0.0.1', port=0, page_size=0):
+    """バックグラウンドスレッドでサーバを起動する。戻り値: (server, state, base_url)"""
+    state = MockState(universe, faults, page_size)
+    server = ThreadingHTTPServer((host, port), make_handler(state))
+    server.daemon_threads = True
+    t = threading.Thread(target=server.serve_forever, daemon=True)
+    t.start()
+    base_url = f"http://{host}:{server.server_address[1]}/v1"
+    return server, state, base_url
+
+
+def build_arg_parser():
+    parser = argparse.ArgumentParser(description='J-Quants mock server for benchmarks')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--codes', type=int, default=600, help='合成ユニバースの銘柄数 (600〜4000程度)')
+    parser.add_argument('--years', type=float, default=2, help='株価履歴の年数')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--new-high-ratio', type=float, default=0.05, help='最終日に高値更新する銘柄の割合')
+    parser.add_argument('--end-date', default=None, help='最終営業日 YYYY-MM-DD（既定: 今日）')
+    parser.add_argument('--latency-ms', type=float, default=0.0)
+    parser.add_argument('--jitter-ms', type=float, default=0.0)
+    parser.add_argument('--rate-429', type=float, default=0.0, help='429 を返す確率')
+    parser.add_argument('--rate-5xx', type=float, default=0.0, help='503 を返す確率')
+    parser.add_argument('--page-size', type=int, default=0, help='一覧系応答の1ページ件数（0: 分割しない）')
+    return parser
+
+
+def universe_from_args(args):
+    end = datetime.strptime(args.end_date, '%Y-%m-%d').date() if args.end_date else None
+    return SyntheticUniverse(n_codes=args.codes, years=args.years, seed=args.seed,
+                             new_high_ratio=args.new_high_ratio, end_date=end)
+
+
+def faults_from_args(args):
+    return FaultConfig(latency_ms=args.latency_ms, jitter_ms=args.jitter_ms,
+                       rate_429=args.rate_429, rate_5xx=args.rate_5xx, seed=args.seed)
+
+
+if __name__ == '__main__':
+    args = build_arg_parser().parse_args()
+    server, state, base_url = start_server(universe_from_args(args), faults_from_args(args), args.host, args.port,
+                                           args.page_size)
+    print(f"mock J-Quants server: {base_url} ({args.codes} codes, {args.years} years)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+"""
+パイプライン全体（step1 → step2 → step3）のスループット計測
+
+モックサーバ（benchmarks/mock_jquants_server.py）を同一プロセス内で起動し、各ステップを
+一時作業ディレクトリでサブプロセスとして実行する。ステップごとにリクエスト数・所要時間・
+ピークRSSを計測して表とJSONで出力する。実トークン・ネットワークは不要。
+
+使い方例:
+  python benchmarks/run_pipeline_benchmark.py --codes 600 --years 2
+  python benchmarks/run_pipeline_benchmark.py --codes 4000 --latency-ms 30 --rate-429 0.02 --output bench.json
+"""
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import requests
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO_ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+
+import mock_jquants_server as mock  # noqa: E402
+
+STEP_SCRIPTS = {
+    '1': 'step1_stock_scanner.py',
+    '2': 'step2_metrics_analysis.py',
+    '3': 'step3_chart_creation.py',
+}
+
+
+def _server_stats(base_url):
+    root = base_url.rsplit('/v1', 1)[0]
+    return requests.get(f"{root}/__stats", timeout=10).json()
+
+
+def _diff_stats(before, after):
+    out = {}
+    for ep, statuses in after['endpoints'].items():
+        prev = before['endpoints'].get(ep, {})
+        d = {st: n - prev.get(st, 0) for st, n in statuses.items() if n - prev.get(st, 0)}
+        if d:
+            out[ep] = d
+    return out
+
+
+def run_step(step, workdir, env, log_path):
+    """ステップを1つ実行し、(returncode, wall_s, peak_rss_mb) を返す"""
+    script = os.path.join(REPO_ROOT, STEP_SCRIPTS[step])
+    t0 = time.perf_counter()
+    with open(log_path, 'w', encoding='utf-8') as log:
+        proc = subprocess.Popen([sys.executable, script], cwd=workdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        if hasattr(os, 'wait4'):
+            _pid, status, rusage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            # Linux は KB、macOS はバイト単位
+            rss_mb = rusage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+        else:
+            proc.wait()
+            rss_mb = None
+    return proc.returncode, time.perf_counter() - t0, rss_mb
+
+
+def main(argv=None):
+    parser = mock.build_arg_parser()
+    parser.description = 'End-to-end pipeline benchmark against the local mock server'
+    parser.set_defaults(port=0)
+    parser.add_argument('--steps', default='1,2,3', help='実行するステップ（例: 1,2）')
+    parser.add_argument('--holdings', type=int, default=2, help='保有銘柄として扱う合成銘柄数')
+    parser.add_argument('--workdir', default=None, help='作業ディレクトリ（既定: 一時ディレクトリ、終了時に削除）')
+    parser.add_argument('--output', default=None, help='結果JSONの出力先')
+    args = parser.parse_args(argv)
+
+    universe = mock.universe_from_args(args)
+    server, _state, base_url = mock.start_server(universe, mock.faults_from_args(args), args.host, args.port,
+                                           args.page_size)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='stock_bench_')
+    os.makedirs(workdir, exist_ok=True)
+    env = dict(os.environ)
+    env.update({
+        'JQUANTS_API_BASE': base_url,
+        'JQUANTS_TOKEN': mock.MOCK_REFRESH_TOKEN,
+        'HOLDING_CODES': ','.join(universe.codes[:args.holdings]),
+        'METRICS_DIR': os.path.join(workdir, 'metrics'),
+        'MPLBACKEND': 'Agg',
+        'PYTHONPATH': REPO_ROOT + os.pathsep + env.get('PYTHONPATH', ''),
+    })
+    for k in ('GMAIL_TOKEN', 'TO_EMAIL'):
+        env.pop(k, None)
+
+    print(f"mock server: {base_url} / {args.codes} codes, {args.years} years, workdir: {workdir}")
+    results = []
+    try:
+        for step in [s.strip() for s in args.steps.split(',') if s.strip()]:
+            before = _server_stats(base_url)
+            rc, wall, rss = run_step(step, workdir, env, os.path.join(workdir, f'step{step}.log'))
+            after = _server_stats(base_url)
+            per_ep = _diff_stats(before, after)
+            n_req = after['total'] - before['total']
+            results.append({
+                'step': step,
+                'returncode': rc,
+                'wall_s': round(wall, 3),
+                'peak_rss_mb': round(rss, 1) if rss is not None else None,
+                'requests': n_req,
+                'requests_per_s': round(n_req / wall, 2) if wall > 0 else None,
+                'endpoints': per_ep,
+            })
+            rss_s = f"{rss:8.1f}" if rss is not None else '     n/a'
+            print(f"step{step}: rc={rc} wall={wall:8.2f}s rss={rss_s}MB requests={n_req}")
+            if rc != 0:
+                print(f"  step{step} failed, see {os.path.join(workdir, f'step{step}.log')}")
+                break
+    finally:
+        server.shutdown()
+
+    report = {
+        'config': {
+            'codes': args.codes, 'years': args.years, 'seed': args.seed,
+            'latency_ms': args.latency_ms, 'jitter_ms': args.jitter_ms,
+            'rate_429': args.rate_429, 'rate_5xx': args.rate_5xx, 'page_size': args.page_size,
+        },
+        'steps': results,
+        'total_wall_s': round(sum(r['wall_s'] for r in results), 3),
+        'total_requests': sum(r['requests'] for r in results),
+    }
+    print(f"\n{'step':>5} {'wall_s':>9} {'rss_mb':>8} {'requests':>9} {'req/s':>8}")
+    for r in results:
+        rss_s = f"{r['peak_rss_mb']:8.1f}" if r['peak_rss_mb'] is not None else '     n/a'
+        print(f"{r['step']:>5} {r['wall_s']:9.2f} {rss_s} {r['requests']:9d} {r['requests_per_s'] or 0:8.1f}")
+    print(f"total {report['total_wall_s']:9.2f} {'':8} {report['total_requests']:9d}")
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"結果保存: {args.output}")
+    if not args.workdir:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0 if all(r['returncode'] == 0 for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
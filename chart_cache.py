@@ -0,0 +1,146 @@
+# 新高値ブレイク法システム - チャートキャッシュ（入力データのハッシュで再描画を省略）
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+import instrumentation
+
+# キャッシュ設定（環境変数で上書き可能）
+CACHE_DIR = os.environ.get('CHART_CACHE_DIR', '.chart_cache')
+CACHE_MAX_AGE_DAYS = float(os.environ.get('CHART_CACHE_MAX_AGE_DAYS', '30'))
+CACHE_MAX_MB = float(os.environ.get('CHART_CACHE_MAX_MB', '200'))
+# CHART_CACHE=0 でキャッシュを無効化（常に再描画）
+CACHE_ENABLED = os.environ.get('CHART_CACHE', '1') not in ('0', 'false', 'False', '')
+
+
+def _json_default(o):
+    """Helper: make numpy / pandas values hashable through json.dumps"""
+    if isinstance(o, np.bool_):
+        return bool(o)
+    if isinstance(o, np.integer):
+        return int(o)
+    if isinstance(o, np.floating):
+        return float(o)
+    if isinstance(o, np.ndarray):
+        return digest_arrays(o)
+    if isinstance(o, (tuple, set)):
+        return list(o)
+    if hasattr(o, 'isoformat'):
+        return o.isoformat()
+    return str(o)
+
+
+def digest_arrays(*arrays):
+    """Hash numpy arrays by dtype/shape/raw bytes (avoids converting long series to lists)."""
+    h = hashlib.sha256()
+    for a in arrays:
+        a = np.ascontiguousarray(a)
+        h.update(str(a.dtype).encode('ascii'))
+        h.update(str(a.shape).encode('ascii'))
+        h.update(a.tobytes())
+    return h.hexdigest()
+
+
+def chart_key(kind, data, profile):
+    """Content address of a chart: sha256 over its kind, input data and render profile."""
+    payload = json.dumps({'kind': kind, 'data': data, 'profile': profile},
+                         sort_keys=True, ensure_ascii=False, separators=(',', ':'),
+                         default=_json_default)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class ChartCache:
+    """Content-addressed store of rendered chart files.
+
+    Entries live under ``<cache_dir>/<key[:2]>/<key><ext>``. A hit copies the cached
+    file to the requested output path; the entry mtime is refreshed so eviction
+    by size drops the least recently used entries first.
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, enabled=CACHE_ENABLED):
+        self.cache_dir = cache_dir
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+
+    def _entry_path(self, key, ext):
+        return os.path.join(self.cache_dir, key[:2], key + ext)
+
+    def fetch(self, key, dest):
+        """Copy a cached chart to dest. Returns True on a hit."""
+        if not self.enabled:
+            return False
+        path = self._entry_path(key, os.path.splitext(dest)[1] or '.png')
+        if not os.path.exists(path):
+            self.misses += 1
+            instrumentation.record_cache('chart', False)
+            return False
+        try:
+            shutil.copyfile(path, dest)
+            os.utime(path, None)
+        except OSError as e:
+            print(f"  chart cache read failed ({e}), re-rendering")
+            self.misses += 1
+            instrumentation.record_cache('chart', False)
+            return False
+        self.hits += 1
+        instrumentation.record_cache('chart', True)
+        return True
+
+    def store(self, key, src):
+        """Save a freshly rendered chart under its key (atomic replace)."""
+        if not self.enabled or not os.path.exists(src):
+            return
+        path = self._entry_path(key, os.path.splitext(src)[1] or '.png')
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp = f"{path}.{os.getpid()}.tmp"
+            shutil.copyfile(src, tmp)
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"  chart cache write failed: {e}")
+
+    def evict(self, max_age_days=CACHE_MAX_AGE_DAYS, max_mb=CACHE_MAX_MB):
+        """Remove entries older than max_age_days, then oldest entries until under max_mb.
+
+        Returns the number of removed files.
+        """
+        if not os.path.isdir(self.cache_dir):
+            return 0
+        now = time.time()
+        entries = []
+        removed = 0
+        for root, _dirs, files in os.walk(self.cache_dir):
+            for fn in files:
+                path = os.path.join(root, fn)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                if fn.endswith('.tmp') or (max_age_days is not None and now - st.st_mtime > max_age_days * 86400):
+                    try:
+                        os.remove(path)
+                        removed += 1
+                    except OSError:
+                        pass
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+
+        if max_mb is not None:
+            budget = max_mb * 1024 * 1024
+            total = sum(size for _, size, _ in entries)
+            for _mtime, size, path in sorted(entries):
+                if total <= budget:
+                    break
+                try:
+                    os.remove(path)
+                    removed += 1
+                    total -= size
+                except OSError:
+                    pass
+        return removed
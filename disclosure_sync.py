@@ -0,0 +1,172 @@
+# 新高値ブレイク法システム - 開示スケジュールに基づく財務キャッシュの無効化と再取得キュー
+#
+# fins/statements?date=YYYYMMDD（その日に開示された決算短信の一覧）と fins/announcement
+# （決算発表予定）を読み、実際に開示のあった銘柄の statements キャッシュだけを無効化して
+# 再取得キューに優先度付きで積む。statements から求める EPS・ROE 系列はこの無効化で
+# 取り直しになる。fs_details は開示日ごとに別エントリのため無効化しない。
+
+import json
+import os
+from datetime import datetime, timedelta
+
+import fundamentals_cache
+from instrumentation import incr
+from jquants_http import API_BASE, JQuantsError, iter_records
+
+STATE_FILE = os.path.join(fundamentals_cache.CACHE_DIR, 'disclosures.json')
+# 前回確認日から遡って確認する最大日数（長期間止まっていた場合は期限切れで取り直される）
+SYNC_MAX_DAYS = 14
+# 開示番号・発表予定を保持する日数
+KEEP_DAYS = 14
+
+# 再取得の優先度（小さいほど先）
+PRIORITY_HOLDING = 0      # 保有銘柄
+PRIORITY_ANNUAL = 1       # 本決算（FY）・予定されていた決算発表
+PRIORITY_OTHER = 2        # 四半期決算・訂正・予想修正など
+
+
+def load_state(path=None):
+    try:
+        with open(path or STATE_FILE, 'r', encoding='utf-8') as f:
+            state = json.load(f)
+    except (OSError, ValueError):
+        state = {}
+    state.setdefault('last_checked', None)
+    state.setdefault('seen', {})
+    state.setdefault('announced', {})
+    state.setdefault('queue', {})
+    return state
+
+
+def save_state(state, path=None):
+    path = path or STATE_FILE
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False, indent=1)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"開示状態の保存に失敗: {e}")
+
+
+def fetch_disclosed(headers, day):
+    """day（datetime）に開示された statements の一覧"""
+    return list(iter_records(f"{API_BASE}/fins/statements", 'statements',
+                             params={'date': day.strftime('%Y%m%d')}, headers=headers))
+
+
+def fetch_announcements(headers):
+    """決算発表予定（翌営業日分）"""
+    return list(iter_records(f"{API_BASE}/fins/announcement", 'announcement', headers=headers))
+
+
+def _dates_to_check(state, today):
+    """前回確認日（当日中の追加開示に備えて再確認する）から today まで"""
+    start = today
+    if state['last_checked']:
+        try:
+            start = max(datetime.strptime(state['last_checked'], '%Y-%m-%d'), today - timedelta(days=SYNC_MAX_DAYS))
+        except ValueError:
+            pass
+    days = []
+    d = start
+    while d <= today:
+        days.append(d)
+        d += timedelta(days=1)
+    return days
+
+
+def _code4(code):
+    """'56210' -> '5621'（J-Quants の5桁コードは末尾0付き。保有銘柄などは4桁で指定される）"""
+    code = str(code)
+    return code[:4] if len(code) == 5 and code.endswith('0') else code
+
+
+def _target_code(code, targets):
+    """開示行のコード（5桁）-> 呼び出し側が使うコード（キャッシュ・再取得キューのキー）。対象外なら None"""
+    if targets is None or code in targets:
+        return code
+    if _code4(code) in targets:
+        return _code4(code)
+    return None
+
+
+def _priority(code, row, state, holdings):
+    if _code4(code) in holdings:
+        return PRIORITY_HOLDING
+    if row.get('TypeOfCurrentPeriod') == 'FY' or code in state['announced']:
+        return PRIORITY_ANNUAL
+    return PRIORITY_OTHER
+
+
+def sync(headers, codes=None, holdings=(), today=None, state=None):
+    """開示一覧を確認し、開示のあった銘柄の statements を無効化して再取得キューに積む。
+
+    codes を指定するとその銘柄（グロース市場 + 保有銘柄など）だけを対象にする。
+    戻り値: 今回新たに無効化したコードのリスト
+    """
+    state = state if state is not None else load_state()
+    today = (today or datetime.now()).replace(hour=0, minute=0, second=0, microsecond=0)
+    targets = set(codes) if codes is not None else None
+    holdings = {_code4(c) for c in holdings}
+
+    # 決算発表予定（優先度付けに使う）
+    try:
+        for row in fetch_announcements(headers):
+            code = _target_code(row.get('Code'), targets) if row.get('Code') else None
+            if code:
+                state['announced'][code] = {'date': row.get('Date'), 'quarter': row.get('FiscalQuarter')}
+    except JQuantsError as e:
+        print(f"決算発表予定の取得エラー: {e}")
+
+    invalidated = []
+    for day in _dates_to_check(state, today):
+        key = day.strftime('%Y-%m-%d')
+        try:
+            rows = fetch_disclosed(headers, day)
+        except JQuantsError as e:
+            print(f"開示一覧の取得エラー ({key}): {e}")
+            # 取得できなかった日から次回やり直す
+            break
+        seen = set(state['seen'].get(key, []))
+        for row in rows:
+            code = row.get('LocalCode') or row.get('Code')
+            number = row.get('DisclosureNumber') or f"{code}:{row.get('DisclosedTime')}:{row.get('TypeOfDocument')}"
+            if not code or number in seen:
+                continue
+            seen.add(number)
+            code = _target_code(code, targets)
+            if code is None:
+                continue
+            fundamentals_cache.invalidate('statements', code)
+            prio = _priority(code, row, state, holdings)
+            entry = state['queue'].get(code)
+            if entry is None or prio < entry['priority']:
+                state['queue'][code] = {'priority': prio, 'disclosed': key, 'type': row.get('TypeOfDocument')}
+            if code not in invalidated:
+                invalidated.append(code)
+        state['seen'][key] = sorted(seen)
+        state['last_checked'] = key
+
+    # 古い開示番号・発表予定を捨てる
+    cutoff = (today - timedelta(days=KEEP_DAYS)).strftime('%Y-%m-%d')
+    state['seen'] = {k: v for k, v in state['seen'].items() if k >= cutoff}
+    state['announced'] = {c: a for c, a in state['announced'].items() if (a.get('date') or '9999') >= cutoff}
+    save_state(state)
+    incr('disclosure_invalidated', len(invalidated))
+    print(f"開示確認: {len(invalidated)}銘柄の財務キャッシュを無効化, 再取得待ち {len(state['queue'])}銘柄")
+    return invalidated
+
+
+def pending(state=None):
+    """再取得キューのコード（優先度順、同じ優先度では開示日の新しい順）"""
+    state = state if state is not None else load_state()
+    items = sorted(state['queue'].items(), key=lambda kv: kv[0])
+    items.sort(key=lambda kv: kv[1].get('disclosed') or '', reverse=True)
+    items.sort(key=lambda kv: kv[1]['priority'])
+    return [code for code, _ in items]
+
+
+def mark_done(state, code):
+    state['queue'].pop(code, None)
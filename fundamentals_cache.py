@@ -0,0 +1,163 @@
+# 新高値ブレイク法システム - 財務データ・銘柄マスタのローカルキャッシュ（時間外の事前取得用）
+
+import json
+import os
+from datetime import datetime
+
+import instrumentation
+
+# キャッシュ設定（環境変数で上書き可能）
+CACHE_DIR = os.environ.get('FUNDAMENTALS_CACHE_DIR', '.fundamentals_cache')
+# 銘柄マスタの有効期間（時間）。fs_details は開示日ごとに内容が変わらないため期限なし
+MAX_AGE_HOURS = float(os.environ.get('FUNDAMENTALS_MAX_AGE_HOURS', '24'))
+# statements は開示のあった銘柄だけ disclosure_sync が無効化するため、期限は取りこぼし対策の上限
+STATEMENTS_MAX_AGE_HOURS = float(os.environ.get('FUNDAMENTALS_STATEMENTS_MAX_AGE_HOURS', str(24 * 7)))
+# FUNDAMENTALS_CACHE=0 でキャッシュを無効化（常にAPIから取得）
+CACHE_ENABLED = os.environ.get('FUNDAMENTALS_CACHE', '1') not in ('0', 'false', 'False', '')
+
+# 種別ごとの有効期間（None: 期限なし）
+KIND_MAX_AGE = {
+    'statements': STATEMENTS_MAX_AGE_HOURS,
+    'listed_info': MAX_AGE_HOURS,
+    'fs_details': None,
+}
+
+
+def _path(kind, name):
+    return os.path.join(CACHE_DIR, kind, f"{name}.json")
+
+
+def _read(kind, name):
+    try:
+        with open(_path(kind, name), 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def age_hours(doc, now=None):
+    """エントリの経過時間（時間）"""
+    try:
+        fetched = datetime.fromisoformat(doc['fetched_at'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    return ((now or datetime.now()) - fetched).total_seconds() / 3600.0
+
+
+def is_fresh(doc, kind, now=None):
+    if doc is None:
+        return False
+    limit = KIND_MAX_AGE.get(kind, MAX_AGE_HOURS)
+    if limit is None:
+        return True
+    age = age_hours(doc, now)
+    return age is not None and age <= limit
+
+
+def get(kind, name):
+    """有効期間内のキャッシュ値を返す（無い・古い場合は None）"""
+    if not CACHE_ENABLED:
+        return None
+    doc = _read(kind, name)
+    hit = is_fresh(doc, kind)
+    instrumentation.record_cache(f'fundamentals.{kind}', hit)
+    return doc['data'] if hit else None
+
+
+def get_stale(kind, name):
+    """有効期間を問わずキャッシュ値を返す（API障害・実行期限切れ時の縮退用）"""
+    if not CACHE_ENABLED:
+        return None
+    doc = _read(kind, name)
+    return doc['data'] if doc else None
+
+
+def has(kind, name):
+    """有効期間内のエントリがあるか（ヒット/ミスは記録しない。取得コストの見積り用）"""
+    return CACHE_ENABLED and is_fresh(_read(kind, name), kind)
+
+
+def put(kind, name, data):
+    if not CACHE_ENABLED:
+        return
+    path = _path(kind, name)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'fetched_at': datetime.now().isoformat(timespec='seconds'), 'data': data}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"財務キャッシュ保存に失敗 ({kind}/{name}): {e}")
+
+
+def invalidate(kind, name):
+    """エントリを削除する（次回参照時にAPIから取り直す）。削除したら True"""
+    try:
+        os.remove(_path(kind, name))
+        return True
+    except OSError:
+        return False
+
+
+def cached_codes(kind='statements'):
+    try:
+        return sorted(os.path.splitext(n)[0] for n in os.listdir(os.path.join(CACHE_DIR, kind)) if n.endswith('.json'))
+    except OSError:
+        return []
+
+
+def freshness_report(codes=None, now=None):
+    """コードごとのキャッシュ鮮度（statements の経過時間・fs_details 件数・stale 判定）"""
+    now = now or datetime.now()
+    codes = sorted(set(codes) if codes is not None else cached_codes('statements'))
+    fs_counts = {}
+    for name in cached_codes('fs_details'):
+        code = name.split('_', 1)[0]
+        fs_counts[code] = fs_counts.get(code, 0) + 1
+
+    rows = {}
+    for code in codes:
+        doc = _read('statements', code)
+        age = age_hours(doc, now) if doc else None
+        rows[code] = {
+            'statements_fetched_at': doc.get('fetched_at') if doc else None,
+            'statements_age_h': round(age, 2) if age is not None else None,
+            'fs_details_cached': fs_counts.get(code, 0),
+            'stale': not is_fresh(doc, 'statements', now),
+        }
+    listed = _read('listed_info', 'all')
+    listed_age = age_hours(listed, now) if listed else None
+    stale = [c for c, r in rows.items() if r['stale']]
+    return {
+        'generated_at': now.isoformat(timespec='seconds'),
+        'max_age_hours': STATEMENTS_MAX_AGE_HOURS,
+        'listed_info': {
+            'fetched_at': listed.get('fetched_at') if listed else None,
+            'age_h': round(listed_age, 2) if listed_age is not None else None,
+            'stale': not is_fresh(listed, 'listed_info', now),
+        },
+        'summary': {'codes': len(rows), 'fresh': len(rows) - len(stale), 'stale': len(stale)},
+        'stale_codes': stale,
+        'codes': rows,
+    }
+
+
+def write_freshness_report(codes=None, path=None):
+    """鮮度レポートを METRICS_DIR/fundamentals_freshness.json に保存して要約を表示する"""
+    report = freshness_report(codes)
+    s = report['summary']
+    print(f"財務キャッシュ鮮度: {s['fresh']}/{s['codes']}銘柄が有効（{STATEMENTS_MAX_AGE_HOURS:g}時間以内）, stale {s['stale']}件, "
+          f"銘柄マスタ: {'stale' if report['listed_info']['stale'] else 'fresh'}")
+    if not path:
+        if not instrumentation.METRICS_DIR:
+            return report
+        path = os.path.join(instrumentation.METRICS_DIR, 'fundamentals_freshness.json')
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"  詳細: {path}")
+    except OSError as e:
+        print(f"鮮度レポート保存に失敗: {e}")
+    return report
@@ -0,0 +1,137 @@
+# 新高値ブレイク法システム - HTTPカセット（J-Quants応答の記録・再生）
+
+import atexit
+import gzip
+import hashlib
+import json
+import os
+import sys
+from urllib.parse import parse_qsl, urlsplit
+
+import requests
+
+import instrumentation
+
+# JQUANTS_CASSETTE=record で実APIの応答を保存、replay で保存済み応答のみを返す（ネットワーク・トークン不要）
+MODE = (os.environ.get('JQUANTS_CASSETTE') or 'off').lower()
+CASSETTE_DIR = os.environ.get('JQUANTS_CASSETTE_DIR', 'cassettes')
+
+# 認証系エンドポイントはトークンを含むため記録しない（再生時はダミートークンを返す）
+AUTH_ENDPOINTS = ('token/auth_refresh', 'token/auth_user')
+REPLAY_ID_TOKEN = 'cassette-replay-token'
+# クエリに含まれうる秘匿パラメータはキーから除外する
+SECRET_PARAMS = {'refreshtoken', 'refresh_token', 'token', 'idtoken'}
+
+_misses = []
+
+
+class CassetteMiss(Exception):
+    """再生モードで該当する記録が存在しない"""
+
+
+def is_recording():
+    return MODE == 'record'
+
+
+def is_replaying():
+    return MODE == 'replay'
+
+
+def request_key(method, url, params=None):
+    """メソッド・エンドポイント・パラメータ（秘匿値除く）から決定的なキーを作る"""
+    parts = urlsplit(url)
+    endpoint = instrumentation.endpoint_of(url)
+    items = [(k, str(v)) for k, v in parse_qsl(parts.query)]
+    if params:
+        items += [(k, str(v)) for k, v in params.items() if v is not None]
+    items = sorted((k, v) for k, v in items if k.lower() not in SECRET_PARAMS)
+    return {'method': method.upper(), 'endpoint': endpoint, 'params': items}
+
+
+def _recordable(status):
+    """429・5xx などの一時的な失敗は記録しない"""
+    return status < 500 and status != 429
+
+
+def _entry_path(key):
+    digest = hashlib.sha256(json.dumps(key, sort_keys=True).encode('utf-8')).hexdigest()[:32]
+    return os.path.join(CASSETTE_DIR, key['endpoint'].replace('/', '_'), digest + '.json.gz')
+
+
+def _build_response(status, body, url, content_type='application/json'):
+    resp = requests.models.Response()
+    resp.status_code = status
+    resp._content = body if isinstance(body, bytes) else body.encode('utf-8')
+    resp.headers['Content-Type'] = content_type
+    resp.encoding = 'utf-8'
+    resp.url = url
+    return resp
+
+
+def replay(method, url, params=None):
+    """記録済み応答を requests.Response として返す。無ければ CassetteMiss。"""
+    key = request_key(method, url, params)
+    if key['endpoint'] in AUTH_ENDPOINTS:
+        return _build_response(200, json.dumps({'idToken': REPLAY_ID_TOKEN, 'refreshToken': REPLAY_ID_TOKEN}), url)
+    path = _entry_path(key)
+    try:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            entry = json.load(f)
+    except FileNotFoundError:
+        _record_miss(key)
+        raise CassetteMiss(f"cassette miss: {key['method']} {key['endpoint']} {dict(key['params'])}")
+    instrumentation.record_cache('cassette', True)
+    return _build_response(entry['status'], entry['body'], url, entry.get('content_type') or 'application/json')
+
+
+def record(method, url, params, resp):
+    """応答を圧縮して保存する（認証系・一時的な失敗は保存しない）"""
+    key = request_key(method, url, params)
+    if key['endpoint'] in AUTH_ENDPOINTS or not _recordable(resp.status_code):
+        return
+    path = _entry_path(key)
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with gzip.open(tmp, 'wt', encoding='utf-8', compresslevel=6) as f:
+            json.dump({
+                **key,
+                'status': resp.status_code,
+                'content_type': resp.headers.get('Content-Type'),
+                'body': resp.text,
+            }, f, ensure_ascii=False)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"cassette write failed ({key['endpoint']}): {e}")
+
+
+def _record_miss(key):
+    instrumentation.record_cache('cassette', False)
+    if not _misses:
+        atexit.register(_report_misses)
+    _misses.append(key)
+
+
+def misses():
+    return list(_misses)
+
+
+def _report_misses():
+    """再生モードで記録が無かったリクエストを表示し、<CASSETTE_DIR>/misses_<script>.json に保存する"""
+    if not _misses:
+        return
+    script = os.path.splitext(os.path.basename(sys.argv[0] or 'python'))[0] or 'python'
+    print(f"\n⚠ カセット未記録のリクエスト: {len(_misses)}件（結果は不完全です）")
+    by_ep = {}
+    for k in _misses:
+        by_ep[k['endpoint']] = by_ep.get(k['endpoint'], 0) + 1
+    for ep, n in sorted(by_ep.items()):
+        print(f"  - {ep}: {n}件")
+    try:
+        os.makedirs(CASSETTE_DIR, exist_ok=True)
+        path = os.path.join(CASSETTE_DIR, f'misses_{script}.json')
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({'count': len(_misses), 'misses': _misses}, f, ensure_ascii=False, indent=2)
+        print(f"  詳細: {path}")
+    except OSError:
+        pass
@@ -0,0 +1,99 @@
+# 新高値ブレイク法システム - 起動時間（import）の計測
+#
+# 各ステップを --profile-imports 付きで起動すると、別プロセスで `python -X importtime` を使って
+# そのスクリプトの import だけを計測し、直接 import しているモジュールごとの累積時間を表示する。
+# METRICS_DIR/import_profile_<名前>.json に保存する。IMPORT_BUDGET_MS を超えたら失敗扱い。
+#
+# 使い方例:
+#   python step3_chart_creation.py --profile-imports
+#   python import_profile.py step1_stock_scanner step2_metrics_analysis step3_chart_creation
+
+import json
+import os
+import subprocess
+import sys
+
+import instrumentation
+
+# import 時間の上限（ミリ秒、0 で判定しない）
+IMPORT_BUDGET_MS = float(os.environ.get('IMPORT_BUDGET_MS', '0'))
+TOP_N = 12
+# モジュール名 -> レポート名（write_report と同じ名前）
+STEPS = {'step1_stock_scanner': 'step1', 'step2_metrics_analysis': 'step2', 'step3_chart_creation': 'step3'}
+
+
+def parse_importtime(stderr):
+    """-X importtime の出力 -> [(深さ, モジュール名, 自身のμs, 累積μs)]（import の完了順）"""
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:'):
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3:
+            continue
+        try:
+            self_us, cum_us = int(parts[0]), int(parts[1])
+        except ValueError:
+            continue  # 見出し行
+        name = parts[2].rstrip()
+        stripped = name.lstrip(' ')
+        rows.append(((len(name) - len(stripped) - 1) // 2, stripped, self_us, cum_us))
+    return rows
+
+
+def profile(module):
+    """module を新しいプロセスで import して計測する"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                          cwd=here, capture_output=True, text=True, timeout=120)
+    rows = parse_importtime(proc.stderr)
+    total = next((cum for depth, name, _, cum in reversed(rows) if depth == 0 and name == module), None)
+    if proc.returncode != 0 or total is None:
+        raise RuntimeError(f"{module} を import できません: {proc.stderr.strip().splitlines()[-1:]}")
+    # 対象モジュールの行より前の、直前の深さ0の行より後にある深さ1の行 = 対象が直接 import したモジュール
+    end = max(i for i, r in enumerate(rows) if r[0] == 0 and r[1] == module)
+    start = max((i for i in range(end) if rows[i][0] == 0), default=-1) + 1
+    direct = sorted(((name, cum) for depth, name, _, cum in rows[start:end] if depth == 1),
+                    key=lambda r: r[1], reverse=True)
+    return {
+        'module': module,
+        'total_ms': round(total / 1000.0, 1),
+        'modules_loaded': end - start + 1,
+        'budget_ms': IMPORT_BUDGET_MS or None,
+        'direct': [{'module': name, 'cumulative_ms': round(cum / 1000.0, 1)} for name, cum in direct],
+    }
+
+
+def report(module, name=None):
+    """計測結果を表示・保存する。予算内（または予算なし）なら True"""
+    try:
+        result = profile(module)
+    except (RuntimeError, subprocess.SubprocessError) as e:
+        print(f"import 計測エラー: {e}")
+        return False
+    print(f"=== import 時間: {module} {result['total_ms']:.1f}ms（{result['modules_loaded']}モジュール） ===")
+    for r in result['direct'][:TOP_N]:
+        print(f"  {r['cumulative_ms']:8.1f}ms  {r['module']}")
+    if instrumentation.METRICS_DIR:
+        path = os.path.join(instrumentation.METRICS_DIR, f"import_profile_{name or module}.json")
+        try:
+            os.makedirs(instrumentation.METRICS_DIR, exist_ok=True)
+            with open(path, 'w', encoding='utf-8') as f:
+                json.dump(result, f, ensure_ascii=False, indent=2)
+            print(f"  詳細: {path}")
+        except OSError as e:
+            print(f"import 計測結果の保存に失敗: {e}")
+    if IMPORT_BUDGET_MS and result['total_ms'] > IMPORT_BUDGET_MS:
+        print(f"✗ import 時間が上限を超えています: {result['total_ms']:.1f}ms > {IMPORT_BUDGET_MS:g}ms")
+        return False
+    return True
+
+
+def main(argv=None):
+    modules = argv if argv is not None else sys.argv[1:]
+    modules = modules or list(STEPS)
+    return all([report(m, STEPS.get(m)) for m in modules])
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,229 @@
+# 新高値ブレイク法システム - 計測（ステージ別処理時間・エンドポイント別リクエスト数）
+
+import functools
+import json
+import os
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+# レポート出力先（METRICS_DIR= で変更、空文字で出力しない）
+METRICS_DIR = os.environ.get('METRICS_DIR', 'metrics')
+PROM_PREFIX = 'stock_pipeline'
+
+_http = defaultdict(lambda: {'count': 0, 'errors': 0, 'retries': 0, 'status': defaultdict(int), 'latencies': []})
+_stages = defaultdict(lambda: {'calls': 0, 'errors': 0, 'latencies': []})
+_caches = defaultdict(lambda: {'hits': 0, 'misses': 0})
+_counters = defaultdict(int)
+_started_at = time.time()
+
+
+def endpoint_of(url):
+    """'https://api.jquants.com/v1/prices/daily_quotes?x=1' -> 'prices/daily_quotes'"""
+    path = url.split('?', 1)[0]
+    if '://' in path:
+        path = path.split('://', 1)[1]
+        path = path.split('/', 1)[1] if '/' in path else ''
+    parts = [p for p in path.split('/') if p]
+    if parts and parts[0] in ('v1', 'v2'):
+        parts = parts[1:]
+    return '/'.join(parts) or '/'
+
+
+def record_request(endpoint, status, elapsed, error=False):
+    """HTTP 1回分（リトライの各試行を含む）の結果を記録する"""
+    e = _http[endpoint]
+    e['count'] += 1
+    e['latencies'].append(elapsed)
+    if error:
+        e['errors'] += 1
+        e['status']['error'] += 1
+    else:
+        e['status'][str(status)] += 1
+
+
+def request_total():
+    """これまでに送信したリクエスト数（全エンドポイント、リトライ含む）"""
+    return sum(e['count'] for e in _http.values())
+
+
+def mean_latency(default=None):
+    """全リクエストの平均レイテンシ（秒）。まだ1件も無ければ default"""
+    n = request_total()
+    if not n:
+        return default
+    return sum(sum(e['latencies']) for e in _http.values()) / n
+
+
+def record_retry(endpoint):
+    _http[endpoint]['retries'] += 1
+
+
+def record_cache(name, hit):
+    """キャッシュのヒット/ミスを記録する"""
+    _caches[name]['hits' if hit else 'misses'] += 1
+
+
+def incr(name, value=1):
+    """任意のカウンタ（スキャン銘柄数など）を加算する"""
+    _counters[name] += value
+
+
+@contextmanager
+def stage_timer(name):
+    """with stage_timer('scan'): ... の形でブロックの所要時間を記録する"""
+    t0 = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except BaseException:
+        failed = True
+        raise
+    finally:
+        s = _stages[name]
+        s['calls'] += 1
+        s['latencies'].append(time.perf_counter() - t0)
+        if failed:
+            s['errors'] += 1
+
+
+def stage(name=None):
+    """関数デコレータ版の stage_timer（name 省略時は関数名）"""
+    def decorator(func):
+        label = name or func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage_timer(label):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def _summary(latencies):
+    if not latencies:
+        return {'total_s': 0.0, 'mean_s': 0.0, 'p50_s': 0.0, 'p90_s': 0.0, 'p99_s': 0.0, 'max_s': 0.0}
+    xs = sorted(latencies)
+
+    def q(p):
+        return xs[min(len(xs) - 1, int(round(p * (len(xs) - 1))))]
+    total = sum(xs)
+    return {
+        'total_s': round(total, 6),
+        'mean_s': round(total / len(xs), 6),
+        'p50_s': round(q(0.50), 6),
+        'p90_s': round(q(0.90), 6),
+        'p99_s': round(q(0.99), 6),
+        'max_s': round(xs[-1], 6),
+    }
+
+
+def snapshot():
+    """現時点の計測値を JSON 化可能な dict で返す"""
+    http = {}
+    for ep, e in sorted(_http.items()):
+        http[ep] = {
+            'count': e['count'],
+            'errors': e['errors'],
+            'retries': e['retries'],
+            'status': dict(e['status']),
+            **_summary(e['latencies']),
+        }
+    stages = {}
+    for name, s in sorted(_stages.items()):
+        stages[name] = {'calls': s['calls'], 'errors': s['errors'], **_summary(s['latencies'])}
+    caches = {}
+    for name, c in sorted(_caches.items()):
+        total = c['hits'] + c['misses']
+        caches[name] = {**c, 'hit_rate': round(c['hits'] / total, 4) if total else None}
+    return {
+        'http': http,
+        'stages': stages,
+        'caches': caches,
+        'counters': dict(_counters),
+        'totals': {
+            'requests': sum(e['count'] for e in _http.values()),
+            'retries': sum(e['retries'] for e in _http.values()),
+            'wall_s': round(time.time() - _started_at, 3),
+        },
+    }
+
+
+def _prom_label(v):
+    return str(v).replace('\\', '\\\\').replace('"', '\\"')
+
+
+def to_prometheus(script, snap):
+    """Prometheus textfile collector 形式に変換する"""
+    p = PROM_PREFIX
+    s = _prom_label(script)
+    lines = [
+        f'# HELP {p}_http_requests_total J-Quants HTTP attempts per endpoint and status.',
+        f'# TYPE {p}_http_requests_total counter',
+    ]
+    for ep, e in snap['http'].items():
+        for status, n in e['status'].items():
+            lines.append(f'{p}_http_requests_total{{script="{s}",endpoint="{_prom_label(ep)}",status="{_prom_label(status)}"}} {n}')
+    lines += [f'# TYPE {p}_http_retries_total counter']
+    for ep, e in snap['http'].items():
+        lines.append(f'{p}_http_retries_total{{script="{s}",endpoint="{_prom_label(ep)}"}} {e["retries"]}')
+    lines += [f'# TYPE {p}_http_latency_seconds summary']
+    for ep, e in snap['http'].items():
+        ep_l = _prom_label(ep)
+        for qname, key in (('0.5', 'p50_s'), ('0.9', 'p90_s'), ('0.99', 'p99_s')):
+            lines.append(f'{p}_http_latency_seconds{{script="{s}",endpoint="{ep_l}",quantile="{qname}"}} {e[key]}')
+        lines.append(f'{p}_http_latency_seconds_sum{{script="{s}",endpoint="{ep_l}"}} {e["total_s"]}')
+        lines.append(f'{p}_http_latency_seconds_count{{script="{s}",endpoint="{ep_l}"}} {e["count"]}')
+    lines += [f'# TYPE {p}_stage_seconds summary']
+    for name, st in snap['stages'].items():
+        n = _prom_label(name)
+        for qname, key in (('0.5', 'p50_s'), ('0.9', 'p90_s'), ('0.99', 'p99_s')):
+            lines.append(f'{p}_stage_seconds{{script="{s}",stage="{n}",quantile="{qname}"}} {st[key]}')
+        lines.append(f'{p}_stage_seconds_sum{{script="{s}",stage="{n}"}} {st["total_s"]}')
+        lines.append(f'{p}_stage_seconds_count{{script="{s}",stage="{n}"}} {st["calls"]}')
+    lines += [f'# TYPE {p}_cache_events_total counter']
+    for name, c in snap['caches'].items():
+        n = _prom_label(name)
+        lines.append(f'{p}_cache_events_total{{script="{s}",cache="{n}",result="hit"}} {c["hits"]}')
+        lines.append(f'{p}_cache_events_total{{script="{s}",cache="{n}",result="miss"}} {c["misses"]}')
+    lines += [f'# TYPE {p}_counter gauge']
+    for name, v in snap['counters'].items():
+        lines.append(f'{p}_counter{{script="{s}",name="{_prom_label(name)}"}} {v}')
+    lines += [
+        f'# TYPE {p}_run_wall_seconds gauge',
+        f'{p}_run_wall_seconds{{script="{s}"}} {snap["totals"]["wall_s"]}',
+        f'# TYPE {p}_run_finished_timestamp_seconds gauge',
+        f'{p}_run_finished_timestamp_seconds{{script="{s}"}} {int(time.time())}',
+    ]
+    return '\n'.join(lines) + '\n'
+
+
+def write_report(script, metrics_dir=None):
+    """<metrics_dir>/<script>_timing.json と <script>.prom を書き出す。
+
+    戻り値: (json_path, prom_path) / 出力無効時は None
+    """
+    metrics_dir = METRICS_DIR if metrics_dir is None else metrics_dir
+    if not metrics_dir:
+        return None
+    try:
+        os.makedirs(metrics_dir, exist_ok=True)
+        snap = snapshot()
+        snap['script'] = script
+        snap['generated_at'] = datetime.now().isoformat(timespec='seconds')
+        json_path = os.path.join(metrics_dir, f'{script}_timing.json')
+        prom_path = os.path.join(metrics_dir, f'{script}.prom')
+        with open(json_path, 'w', encoding='utf-8') as f:
+            json.dump(snap, f, ensure_ascii=False, indent=2)
+        # textfile collector が書きかけを読まないように一時ファイル経由で置き換える
+        tmp = prom_path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(to_prometheus(script, snap))
+        os.replace(tmp, prom_path)
+        t = snap['totals']
+        print(f"計測レポート: {json_path} (リクエスト{t['requests']}件, リトライ{t['retries']}件, {t['wall_s']:.1f}秒)")
+        return json_path, prom_path
+    except Exception as e:
+        print(f"計測レポート出力失敗: {e}")
+        return None
@@ -0,0 +1,235 @@
+# 新高値ブレイク法システム - 取引時間中の増分再スキャン（ループモード）
+#
+# 引け後のスキャン（step1）を待たずに、取引時間中に65週新高値ブレイクを検知する。
+# 開始時に株価行列（price_matrix、前営業日まで追記済み）から各銘柄の65週高値（当日を除く窓内の日中高値の最大）を
+# 1回だけ求め、以降は INTRADAY_INTERVAL_S ごとに最新の足を取得して、新しい足のあった銘柄の当日高値だけを更新する。
+# 当日高値が65週高値を初めて上回った銘柄はその場で出力する（標準出力と INTRADAY_BREAKOUT_FILE の JSONL）。
+#
+# 足の取得元（--feed）:
+#   api  : J-Quants の prices/prices_am（前場の四本値、前場終了後に取得可能）と daily_quotes?date=当日（引け後）
+#   file : ローカルの代替フィード。別プロセスが JSONL（{"Code": "12340", "High": 1234.0, ...} の行）を追記し、
+#          前回読んだ位置より後の行だけを読む
+#
+# 使い方例:
+#   python price_matrix.py --update                                   # 前営業日までを行列に追記しておく
+#   python intraday_scan.py --feed file --feed-file bars.jsonl --interval 5
+#   python intraday_scan.py --feed api --until 15:30
+
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+
+import jquants_http
+import price_matrix
+import trading_calendar
+from instrumentation import incr, stage_timer, write_report
+from jquants_http import API_BASE, JQuantsError, iter_records
+from quotes_decoder import date_ordinal, ordinal_to_str
+
+INTERVAL_S = float(os.environ.get('INTRADAY_INTERVAL_S', '60'))
+BREAKOUT_FILE = os.environ.get('INTRADAY_BREAKOUT_FILE', 'intraday_breakouts.jsonl')
+# 既定の終了時刻（JST、大引け）
+SESSION_END = os.environ.get('INTRADAY_UNTIL', '15:30')
+
+
+class RollingHighState:
+    """銘柄ごとの65週高値（固定）と当日高値（増分更新）、ブレイク済みフラグ"""
+
+    def __init__(self, codes, past_max):
+        self.codes = list(codes)
+        self.past_max = np.asarray(past_max, dtype='float64')
+        self.day_high = np.full(len(self.codes), np.nan)
+        self.triggered = np.zeros(len(self.codes), dtype=bool)
+        # 4桁・5桁（末尾0）どちらのコードでも引けるよう、4桁に揃えたコードで索引する
+        self.index = {}
+        for i, code in enumerate(self.codes):
+            self.index.setdefault(price_matrix.code4(code), i)
+
+    @classmethod
+    def from_matrix(cls, matrix, calendar, today):
+        """株価行列から today（日数）を除く65週窓の日中高値の最大を全銘柄まとめて求める"""
+        start = calendar.window_start(today)
+        lo = int(np.searchsorted(matrix.dates, start)) if start is not None else 0
+        hi = int(np.searchsorted(matrix.dates, today))  # today の列は含めない
+        highs = price_matrix.as_float64(matrix.field('High')[:, lo:hi])
+        highs = np.where(np.asarray(matrix.valid[:, lo:hi]), highs, np.nan)
+        with np.errstate(all='ignore'):
+            past_max = np.fmax.reduce(highs, axis=1) if highs.shape[1] else np.full(len(matrix), np.nan)
+        prev = calendar.previous_session(today)
+        if prev is not None and (hi == 0 or int(matrix.dates[hi - 1]) < prev):
+            print(f"⚠ 株価行列が前営業日（{ordinal_to_str(prev)}）まで追記されていません。"
+                  f"python price_matrix.py --update を先に実行してください")
+        return cls(matrix.codes, past_max)
+
+    def arrays(self, records, field='High'):
+        """足のレコード -> (行番号, 高値) の配列（行列に無い銘柄・欠損値は除く）"""
+        idx, highs = [], []
+        for r in records:
+            i = self.index.get(price_matrix.code4(r.get('Code')))
+            v = r.get(field)
+            if i is None or v in (None, ''):
+                continue
+            idx.append(i)
+            highs.append(float(v))
+        return np.array(idx, dtype='int64'), np.array(highs, dtype='float64')
+
+    def apply(self, idx, highs):
+        """新しい足を反映し、今回初めて65週高値を上回った行番号を返す"""
+        if not len(idx):
+            return idx
+        np.fmax.at(self.day_high, idx, highs)
+        touched = np.unique(idx)
+        hit = touched[(self.day_high[touched] > self.past_max[touched]) & ~self.triggered[touched]]
+        self.triggered[hit] = True
+        return hit
+
+
+class FileFeed:
+    """ローカルの代替フィード: JSONL を前回読んだ位置から読む（書きかけの最終行は次回に回す）"""
+
+    def __init__(self, path):
+        self.path = path
+        self.offset = 0
+
+    def poll(self):
+        try:
+            with open(self.path, 'rb') as f:
+                f.seek(self.offset)
+                data = f.read()
+        except OSError:
+            return []
+        end = data.rfind(b'\n') + 1
+        self.offset += end
+        return [json.loads(line) for line in data[:end].splitlines() if line.strip()]
+
+
+class ApiFeed:
+    """J-Quants: 前場の四本値（prices_am）→ 引け後は当日の日足。前回から高値が変わった銘柄だけを返す"""
+
+    def __init__(self, headers, day):
+        self.headers = headers
+        self.day = ordinal_to_str(day, compact=True)
+        self.last = {}
+
+    def _fetch(self):
+        rows = []
+        try:
+            rows = list(iter_records(f"{API_BASE}/prices/daily_quotes", 'daily_quotes',
+                                     params={'date': self.day}, headers=self.headers))
+        except JQuantsError as e:
+            print(f"当日の日足を取得できません: {e}")
+        if rows:
+            return [{'Code': r.get('Code'), 'High': r.get('High')} for r in rows]
+        try:
+            rows = list(iter_records(f"{API_BASE}/prices/prices_am", 'prices_am', headers=self.headers))
+        except JQuantsError as e:
+            print(f"前場の四本値を取得できません: {e}")
+            return []
+        return [{'Code': r.get('Code'), 'High': r.get('MorningHigh')} for r in rows
+                if str(r.get('Date', '')).replace('-', '') == self.day]
+
+    def poll(self):
+        changed = []
+        for r in self._fetch():
+            if r['High'] is not None and self.last.get(r['Code']) != r['High']:
+                self.last[r['Code']] = r['High']
+                changed.append(r)
+        return changed
+
+
+def emit(state, hits, out=None):
+    """ブレイクした銘柄を出力する（標準出力 + JSONL）"""
+    now = datetime.now().isoformat(timespec='seconds')
+    lines = []
+    for i in hits.tolist():
+        rec = {'time': now, 'code': state.codes[i], 'high': float(state.day_high[i]), 'past_max_65w': float(state.past_max[i])}
+        print(f"★ 65週新高値ブレイク: {rec['code']} 高値{rec['high']:g} > 65週高値{rec['past_max_65w']:g}（{now}）", flush=True)
+        lines.append(json.dumps(rec, ensure_ascii=False))
+    if lines and out:
+        with open(out, 'a', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+    incr('intraday_breakouts', len(lines))
+
+
+def run(state, feed, interval=INTERVAL_S, cycles=None, until=None, out=BREAKOUT_FILE):
+    """until（JST の datetime）または cycles 回まで、interval 秒ごとに足を取得して判定する。戻り値: 各周期の処理時間（秒）"""
+    latencies = []
+    n = 0
+    while True:
+        t0 = time.perf_counter()
+        with stage_timer('intraday_cycle'):
+            records = feed.poll()
+            idx, highs = state.arrays(records)
+            hits = state.apply(idx, highs)
+        latencies.append(time.perf_counter() - t0)
+        if len(hits):
+            emit(state, hits, out)
+        n += 1
+        incr('intraday_bars', len(idx))
+        if (cycles and n >= cycles) or (until and trading_calendar.now_jst() >= until):
+            return latencies
+        time.sleep(max(interval - (time.perf_counter() - t0), 0))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Poll intraday bars and report 65-week breakouts as they happen')
+    parser.add_argument('--feed', choices=('api', 'file'), default='api')
+    parser.add_argument('--feed-file', default='intraday_bars.jsonl', help='--feed file の JSONL')
+    parser.add_argument('--interval', type=float, default=INTERVAL_S, help='取得間隔（秒）')
+    parser.add_argument('--cycles', type=int, default=None, help='この回数で終了する（--until より優先）')
+    parser.add_argument('--until', default=SESSION_END, help='終了時刻（JST, HH:MM）')
+    parser.add_argument('--date', default=None, help='対象日（YYYYMMDD、既定: 今日）')
+    args = parser.parse_args(argv)
+
+    matrix = price_matrix.PriceMatrix.attach()
+    if matrix is None:
+        print(f"株価行列がありません（{price_matrix.MATRIX_DIR}）。先に step1 または python price_matrix.py --update を実行してください")
+        return False
+    now = trading_calendar.now_jst()
+    day = datetime.strptime(args.date, '%Y%m%d') if args.date else now
+    today = date_ordinal(day)
+    headers = {}
+    if args.feed == 'api':
+        import step1_stock_scanner as scanner
+        token = scanner.resolve_id_token()
+        if not token:
+            print("警告: JQUANTS_TOKEN が未設定です。環境変数を確認してください。")
+            return False
+        headers = {"Authorization": f"Bearer {token}"}
+    calendar = trading_calendar.load_calendar(headers, today=day)
+    if not calendar.is_session(today):
+        print(f"{ordinal_to_str(today)} は営業日ではありません")
+        return True
+
+    with stage_timer('intraday_init'):
+        state = RollingHighState.from_matrix(matrix, calendar, today)
+    feed = FileFeed(args.feed_file) if args.feed == 'file' else ApiFeed(headers, today)
+    hh, mm = (int(x) for x in args.until.split(':'))
+    # --cycles を指定した場合は回数だけで終了する（時間外の動作確認用）
+    until = None if args.cycles else now.replace(hour=hh, minute=mm, second=0, microsecond=0)
+    # 実行期限（RUN_DEADLINE_S、既定1時間）は日次バッチ向け。ループ中の取得が途中で打ち切られないよう、
+    # 期限を終了時刻 + 1周期分に合わせる（--cycles の場合は期限なし）
+    if until is None:
+        jquants_http.set_deadline(0)
+    else:
+        jquants_http.set_deadline(max((until - now).total_seconds(), 0) + args.interval + jquants_http.DEFAULT_TIMEOUT)
+    print(f"=== 取引時間中の再スキャン: {ordinal_to_str(today)}, {len(state.codes)}銘柄, "
+          f"{args.interval:g}秒間隔, 〜{args.until}（feed={args.feed}） ===")
+    latencies = run(state, feed, args.interval, args.cycles, until)
+    ms = np.array(latencies) * 1000
+    print(f"終了: {len(ms)}周期, ブレイク{int(state.triggered.sum())}銘柄, "
+          f"1周期 p50 {np.percentile(ms, 50):.2f}ms / 最大 {ms.max():.2f}ms")
+    return True
+
+
+if __name__ == '__main__':
+    try:
+        success = main()
+    finally:
+        write_report('intraday')
+    sys.exit(0 if success else 1)
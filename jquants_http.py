@@ -0,0 +1,234 @@
+# 新高値ブレイク法システム - J-Quants HTTP 共通処理（全リクエストはここを経由する）
+
+import os
+import time
+
+import requests
+
+import http_cassette
+import instrumentation
+from http_cassette import CassetteMiss
+from quotes_decoder import loads, quote_decoder
+
+# APIのベースURL（ローカルのモックサーバ等に向ける場合は JQUANTS_API_BASE で上書き）
+API_BASE = os.environ.get('JQUANTS_API_BASE', 'https://api.jquants.com/v1').rstrip('/')
+
+# 1リクエストのタイムアウト（秒）。呼び出し側が timeout を省略しても必ず適用する
+DEFAULT_TIMEOUT = float(os.environ.get('JQUANTS_TIMEOUT_S', '20'))
+# 実行全体の期限（プロセス開始からの秒数、0: 期限なし）。期限後のリクエストは即座に失敗する
+RUN_DEADLINE_S = float(os.environ.get('RUN_DEADLINE_S', '3600'))
+# 連続 BREAKER_FAILURES 回の失敗（接続エラー・タイムアウト・5xx）で遮断し、BREAKER_COOLDOWN_S 秒は即座に失敗させる
+BREAKER_FAILURES = int(os.environ.get('JQUANTS_BREAKER_FAILURES', '5'))
+BREAKER_COOLDOWN_S = float(os.environ.get('JQUANTS_BREAKER_COOLDOWN_S', '60'))
+# リトライ対象のステータス（それ以外の 4xx はリトライしても結果が変わらない）
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+_deadline = time.monotonic() + RUN_DEADLINE_S if RUN_DEADLINE_S > 0 else None
+
+
+class JQuantsError(Exception):
+    """ページ取得の失敗（途中ページの失敗で結果が欠けるのを黙って返さないために送出する）"""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class CircuitOpen(JQuantsError):
+    """サーキットブレーカーが開いている（API障害とみなして即座に失敗させる）"""
+
+
+class DeadlineExceeded(JQuantsError):
+    """実行全体の期限を過ぎた"""
+
+
+class CircuitBreaker:
+    """連続失敗が threshold 回に達したら開き、cooldown_s 経過後に1回だけ試行を通す（半開）"""
+
+    def __init__(self, threshold=BREAKER_FAILURES, cooldown_s=BREAKER_COOLDOWN_S):
+        self.threshold = threshold
+        self.cooldown_s = cooldown_s
+        self.failures = 0
+        self.opened_at = None
+        self.trips = 0
+
+    @property
+    def is_open(self):
+        return self.opened_at is not None and time.monotonic() - self.opened_at < self.cooldown_s
+
+    def before_request(self, endpoint):
+        if self.is_open:
+            instrumentation.incr('circuit_rejected')
+            raise CircuitOpen(f"{endpoint}: circuit open after {self.failures} consecutive failures")
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self, endpoint):
+        self.failures += 1
+        if self.threshold and self.failures >= self.threshold and not self.is_open:
+            # 初回の遮断、または半開状態での試行失敗
+            self.opened_at = time.monotonic()
+            self.trips += 1
+            instrumentation.incr('circuit_trips')
+            print(f"⚠ API連続失敗{self.failures}回（{endpoint}）: {self.cooldown_s:g}秒間リクエストを遮断します")
+
+
+breaker = CircuitBreaker()
+
+
+def set_deadline(seconds):
+    """実行全体の期限を今から seconds 秒後に設定する（0 以下で期限なし）"""
+    global _deadline
+    _deadline = time.monotonic() + seconds if seconds and seconds > 0 else None
+
+
+def time_left():
+    """期限までの残り秒数（期限なしなら None）"""
+    return None if _deadline is None else _deadline - time.monotonic()
+
+
+def deadline_exceeded():
+    left = time_left()
+    return left is not None and left <= 0
+
+
+def degraded_reason():
+    """新たなAPIリクエストを行うべきでない理由（期限切れ・遮断中）。正常なら None"""
+    if deadline_exceeded():
+        return '実行期限超過'
+    if breaker.is_open:
+        return 'API障害（サーキットブレーカー遮断中）'
+    return None
+
+
+def send(method, url, params=None, headers=None, timeout=None, **kwargs):
+    """requests.request の薄いラッパー。エンドポイント別に件数・レイテンシ・ステータスを記録する。
+
+    例外は呼び出し側にそのまま送出する（従来の requests.get と同じ挙動）。
+    カセット再生モードでは記録済み応答を返し、未記録なら CassetteMiss を送出する。
+    """
+    endpoint = instrumentation.endpoint_of(url)
+    if deadline_exceeded():
+        instrumentation.incr('deadline_rejected')
+        raise DeadlineExceeded(f"{endpoint}: run deadline exceeded")
+    breaker.before_request(endpoint)
+    # タイムアウトは必須（省略時は既定値）、期限が近ければ残り時間まで短縮する
+    timeout = timeout or DEFAULT_TIMEOUT
+    left = time_left()
+    if left is not None:
+        timeout = max(min(timeout, left), 0.1)
+    t0 = time.perf_counter()
+    try:
+        if http_cassette.is_replaying():
+            resp = http_cassette.replay(method, url, params)
+        else:
+            resp = requests.request(method.upper(), url, params=params, headers=headers, timeout=timeout, **kwargs)
+    except CassetteMiss:
+        instrumentation.record_request(endpoint, None, time.perf_counter() - t0, error=True)
+        raise
+    except Exception:
+        instrumentation.record_request(endpoint, None, time.perf_counter() - t0, error=True)
+        breaker.record_failure(endpoint)
+        raise
+    instrumentation.record_request(endpoint, resp.status_code, time.perf_counter() - t0)
+    if resp.status_code >= 500:
+        breaker.record_failure(endpoint)
+    elif resp.status_code != 429:
+        breaker.record_success()
+    if http_cassette.is_recording():
+        http_cassette.record(method, url, params, resp)
+    return resp
+
+
+def get(url, params=None, headers=None, timeout=None, **kwargs):
+    return send('get', url, params=params, headers=headers, timeout=timeout, **kwargs)
+
+
+def post(url, params=None, headers=None, timeout=None, **kwargs):
+    return send('post', url, params=params, headers=headers, timeout=timeout, **kwargs)
+
+
+def request_with_retry(url, params=None, headers=None, method='get', max_retries=3, backoff=1.0, timeout=None):
+    """Simple retry wrapper around requests.get/post. Returns requests.Response or None.
+
+    接続エラー・タイムアウトと RETRY_STATUSES の応答だけをリトライする。遮断中・期限切れは
+    CircuitOpen / DeadlineExceeded をそのまま送出する（リトライしても待つだけなので）。
+    """
+    resp = None
+    for attempt in range(1, max_retries + 1):
+        try:
+            resp = send(method, url, params=params, headers=headers, timeout=timeout)
+            if resp.status_code not in RETRY_STATUSES:
+                return resp
+        except CassetteMiss:
+            # 再生モードの未記録はリトライしても変わらない（未記録一覧は終了時に報告）
+            return None
+        except (CircuitOpen, DeadlineExceeded):
+            raise
+        except Exception:
+            resp = None
+        if attempt == max_retries:
+            return resp
+        instrumentation.record_retry(instrumentation.endpoint_of(url))
+        wait = backoff * attempt
+        left = time_left()
+        if left is not None:
+            wait = min(wait, max(left, 0))
+        throttle(wait)
+
+
+def throttle(seconds):
+    """API制限対策の待機。カセット再生時はネットワークを使わないので待たない。"""
+    if seconds > 0 and not http_cassette.is_replaying():
+        time.sleep(seconds)
+
+
+def _json_page(content):
+    doc = loads(content)
+    return doc, (doc.get('pagination_key') if isinstance(doc, dict) else None)
+
+
+def iter_pages(url, params=None, headers=None, decode=None, max_retries=3, timeout=None):
+    """pagination_key を辿りながら1ページずつ yield するジェネレータ。
+
+    decode(content) -> (page, pagination_key)。既定は JSON 全体（dict）を返す。
+    途中のページが取得できなかった場合は JQuantsError を送出する。
+    """
+    decode = decode or _json_page
+    params = dict(params or {})
+    seen_keys = set()
+    while True:
+        resp = request_with_retry(url, params=params, headers=headers, max_retries=max_retries, timeout=timeout)
+        if resp is None:
+            raise JQuantsError(f"{instrumentation.endpoint_of(url)}: request failed")
+        if resp.status_code != 200:
+            raise JQuantsError(f"{instrumentation.endpoint_of(url)}: status {resp.status_code}", resp.status_code)
+        page, key = decode(resp.content)
+        yield page
+        if not key or key in seen_keys:
+            return
+        seen_keys.add(key)
+        params['pagination_key'] = key
+        instrumentation.incr('pagination_follow')
+
+
+def iter_records(url, list_keys, params=None, headers=None, max_retries=3, timeout=None):
+    """各ページの list_keys（例: 'statements'、('statements', 'data')）のレコードを1件ずつ yield する"""
+    if isinstance(list_keys, str):
+        list_keys = (list_keys,)
+    for doc in iter_pages(url, params=params, headers=headers, max_retries=max_retries, timeout=timeout):
+        if isinstance(doc, list):
+            yield from doc
+            continue
+        for k in list_keys:
+            if isinstance(doc.get(k), list):
+                yield from doc[k]
+                break
+
+
+def iter_quote_pages(params, headers=None, fields=('High', 'Close'), max_retries=3, timeout=None):
+    """prices/daily_quotes をページ単位で yield する（各ページは必要列だけの配列 dict）"""
+    yield from iter_pages(f"{API_BASE}/prices/daily_quotes", params=params, headers=headers,
+                          decode=quote_decoder(fields), max_retries=max_retries, timeout=timeout)
@@ -0,0 +1,217 @@
+# 新高値ブレイク法システム - 構造化ログ（レベル・銘柄コードの文脈・繰り返しメッセージの間引き・一括出力）
+#
+# 銘柄ごと・年度ごとに繰り返す行（ROE計算・スキャン・指標取得）は、イベント名ごとに最初の LOG_SAMPLE_FIRST 件と
+# LOG_SAMPLE_EVERY 件おきだけをコンソールに出し、残りは件数を数えて終了時にまとめて表示する。
+# 出力はバックグラウンドのスレッドが一定間隔・一定件数ごとにまとめて書き込む（1行ごとの書き込み・flush をしない）。
+# 全件（DEBUG を含み間引かない）は LOG_JSONL のファイルに JSON Lines で書き出せる（LOG_LEVEL=DEBUG なら既定で
+# METRICS_DIR/log_<名前>.jsonl）。
+#
+# 使い方例:
+#   log = pipeline_log.get_logger('roe')
+#   with pipeline_log.context(code=code):
+#       log.debug('roe.year', "{code}: computed ROE year {year} = {roe:.4f}", year=i, roe=roe)
+
+import atexit
+import contextvars
+import json
+import os
+import queue
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime
+
+import instrumentation
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+_LEVELS = {v: k for k, v in LEVEL_NAMES.items()}
+
+# コンソールに出す最低レベル（LOG_LEVEL=DEBUG / INFO / WARNING / ERROR）
+LOG_LEVEL = _LEVELS.get(os.environ.get('LOG_LEVEL', 'INFO').upper(), INFO)
+# 同じイベントをコンソールに出す件数（最初の N 件 + EVERY 件おき、0 で間引かない）。WARNING 以上は間引かない
+LOG_SAMPLE_FIRST = int(os.environ.get('LOG_SAMPLE_FIRST', '5'))
+LOG_SAMPLE_EVERY = int(os.environ.get('LOG_SAMPLE_EVERY', '100'))
+# 全件を書き出す JSONL ファイル（空なら LOG_LEVEL=DEBUG のときだけ METRICS_DIR/log_<名前>.jsonl）
+LOG_JSONL = os.environ.get('LOG_JSONL', '')
+# バックグラウンド書き込みの間隔（秒）と1回あたりの最大行数
+FLUSH_INTERVAL_S = 0.5
+BATCH_SIZE = 500
+
+_context = contextvars.ContextVar('pipeline_log_context', default={})
+_lock = threading.Lock()
+_counts = defaultdict(int)       # イベント名 -> 発生件数
+_shown = defaultdict(int)        # イベント名 -> コンソールに出した件数
+_run_name = None
+_writer = None
+
+
+class _Writer(threading.Thread):
+    """キューに積まれた行をまとめて書き込むスレッド。flush() で書き込み完了まで待つ"""
+
+    def __init__(self, jsonl_path):
+        super().__init__(name='pipeline-log', daemon=True)
+        self.queue = queue.Queue()
+        self.jsonl = None
+        if jsonl_path:
+            try:
+                os.makedirs(os.path.dirname(jsonl_path) or '.', exist_ok=True)
+                self.jsonl = open(jsonl_path, 'a', encoding='utf-8')
+                self.jsonl_path = jsonl_path
+            except OSError as e:
+                print(f"ログファイルを開けません ({jsonl_path}): {e}")
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            batch = [item]
+            deadline = time.monotonic() + FLUSH_INTERVAL_S
+            while item is not None and not isinstance(item, threading.Event) and len(batch) < BATCH_SIZE:
+                try:
+                    item = self.queue.get(timeout=max(deadline - time.monotonic(), 0))
+                except queue.Empty:
+                    break
+                batch.append(item)
+            self._write(batch)
+            for item in batch:
+                if isinstance(item, threading.Event):
+                    item.set()
+            if batch[-1] is None:
+                return
+
+    def _write(self, batch):
+        console = [line for kind, line in (b for b in batch if isinstance(b, tuple)) if kind == 'console']
+        records = [line for kind, line in (b for b in batch if isinstance(b, tuple)) if kind == 'jsonl']
+        if console:
+            sys.stdout.write('\n'.join(console) + '\n')
+            sys.stdout.flush()
+        if records and self.jsonl is not None:
+            self.jsonl.write('\n'.join(records) + '\n')
+            self.jsonl.flush()
+
+
+def configure(name):
+    """実行名（JSONL の既定ファイル名に使う）を設定する。各ステップの main の最初に呼ぶ"""
+    global _run_name
+    _run_name = name
+
+
+def _jsonl_path():
+    if LOG_JSONL:
+        return LOG_JSONL
+    if LOG_LEVEL <= DEBUG and instrumentation.METRICS_DIR:
+        name = _run_name or os.path.splitext(os.path.basename(sys.argv[0] or 'run'))[0]
+        return os.path.join(instrumentation.METRICS_DIR, f"log_{name}.jsonl")
+    return None
+
+
+def _get_writer():
+    global _writer
+    if _writer is None:
+        with _lock:
+            if _writer is None:
+                w = _Writer(_jsonl_path())
+                w.start()
+                atexit.register(close)
+                _writer = w
+    return _writer
+
+
+@contextmanager
+def context(**fields):
+    """この with ブロック内のログに fields（code など）を付ける"""
+    token = _context.set({**_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _context.reset(token)
+
+
+class Logger:
+    """イベント名付きの構造化ログ。msg は fields で str.format する（出力しない行は整形しない）"""
+
+    def __init__(self, name, fields=None):
+        self.name = name
+        self.fields = fields or {}
+
+    def bind(self, **fields):
+        return Logger(self.name, {**self.fields, **fields})
+
+    def debug(self, event, msg, **fields):
+        self.log(DEBUG, event, msg, **fields)
+
+    def info(self, event, msg, **fields):
+        self.log(INFO, event, msg, **fields)
+
+    def warning(self, event, msg, **fields):
+        self.log(WARNING, event, msg, **fields)
+
+    def error(self, event, msg, **fields):
+        self.log(ERROR, event, msg, **fields)
+
+    def log(self, level, event, msg, **fields):
+        with _lock:
+            _counts[event] += 1
+            n = _counts[event]
+            show = level >= LOG_LEVEL and (
+                level >= WARNING or not LOG_SAMPLE_FIRST or n <= LOG_SAMPLE_FIRST
+                or (LOG_SAMPLE_EVERY and n % LOG_SAMPLE_EVERY == 0))
+            if show:
+                _shown[event] += 1
+        writer = _get_writer()
+        if not show and writer.jsonl is None:
+            return
+        fields = {**_context.get(), **self.fields, **fields}
+        try:
+            text = msg.format(**fields) if fields else msg
+        except (KeyError, IndexError, ValueError):
+            text = msg
+        if show:
+            prefix = '' if level == INFO else f"[{LEVEL_NAMES[level]}] "
+            writer.queue.put(('console', prefix + text))
+        if writer.jsonl is not None:
+            record = {'ts': datetime.now().isoformat(timespec='milliseconds'), 'level': LEVEL_NAMES[level],
+                      'logger': self.name, 'event': event, 'msg': text, **fields}
+            writer.queue.put(('jsonl', json.dumps(record, ensure_ascii=False, default=str)))
+
+
+def get_logger(name):
+    return Logger(name)
+
+
+def flush():
+    """積まれている行を書き込み終わるまで待つ（print と順序を揃えたい区切りで呼ぶ）"""
+    if _writer is None or not _writer.is_alive():
+        return
+    done = threading.Event()
+    _writer.queue.put(done)
+    done.wait(timeout=10)
+
+
+def summary():
+    """イベントごとの件数のうち、コンソールに出さなかった件数 {event: (件数, 出力件数)}"""
+    with _lock:
+        return {e: (n, _shown[e]) for e, n in sorted(_counts.items()) if n > _shown[e]}
+
+
+def close():
+    """間引いた件数をまとめて表示し、書き込みスレッドを止める"""
+    global _writer
+    if _writer is None:
+        return
+    hidden = summary()
+    if hidden:
+        lines = [f"  {e}: {n}件（表示 {shown}件）" for e, (n, shown) in hidden.items()]
+        _writer.queue.put(('console', "ログ集計（間引き・非表示の件数）:\n" + '\n'.join(lines)))
+    for e, (n, shown) in hidden.items():
+        instrumentation.incr('log_suppressed', n - shown)
+    path = getattr(_writer, 'jsonl_path', None) if _writer.jsonl is not None else None
+    if path:
+        _writer.queue.put(('console', f"  詳細ログ: {path}"))
+    _writer.queue.put(None)
+    _writer.join(timeout=10)
+    if _writer.jsonl is not None:
+        _writer.jsonl.close()
+    _writer = None
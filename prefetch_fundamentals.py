@@ -0,0 +1,113 @@
+# 新高値ブレイク法システム - 財務データ・銘柄マスタの事前取得（取引時間外に実行）
+#
+# 引け後のスキャン（step1）では当日の株価だけを取得すればよいように、変化の少ない
+# 銘柄マスタ（listed/info）・財務（fins/statements, fins/fs_details）を深夜・早朝や
+# 適時開示の後にキャッシュへ取得しておく。開示のあった銘柄は disclosure_sync が無効化して
+# 再取得キューに積むため、キュー（優先度順）→ 期限切れ・未取得の銘柄の順に取得する。
+#
+# 使い方例:
+#   python prefetch_fundamentals.py                # 期限切れ・未取得の銘柄だけ取得
+#   python prefetch_fundamentals.py --mode full    # 全銘柄を取り直す
+#   python prefetch_fundamentals.py --report-only  # 鮮度レポートのみ
+
+import argparse
+import sys
+
+import disclosure_sync
+import fundamentals_cache
+import jquants_http
+import step1_stock_scanner as scanner
+from instrumentation import incr, stage_timer, write_report
+from jquants_http import JQuantsError
+
+def target_codes(listed):
+    """事前取得の対象: グロース市場の銘柄 + 保有銘柄"""
+    codes = [s['Code'] for s in listed if s.get('MarketCodeName') == 'グロース']
+    for code in scanner.HOLDING_CODES:
+        if code not in codes:
+            codes.append(code)
+    return codes
+
+
+def prefetch_code(code, headers, refresh):
+    """1銘柄分の statements と ROE 計算に使う fs_details をキャッシュする"""
+    rows = scanner.fetch_statements(code, headers, refresh=refresh)
+    fy = [r for r in rows if r.get('TypeOfCurrentPeriod') == 'FY']
+    fy.sort(key=lambda r: (r.get('CurrentPeriodEndDate') or '', r.get('DisclosedDate') or ''))
+    for row in fy[-scanner.ROE_FY_ROWS:]:
+        disclosed = row.get('DisclosedDate') or row.get('CurrentPeriodEndDate')
+        if disclosed:
+            scanner.fetch_fs_details_by_date(code, disclosed, headers)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Warm the fundamentals / securities-master caches off hours')
+    parser.add_argument('--mode', choices=('stale', 'full'), default='stale',
+                        help='stale: 期限切れ・未取得のみ / full: 全銘柄を取り直す')
+    parser.add_argument('--codes', default=None, help='対象コード（カンマ区切り、既定: グロース市場 + 保有銘柄）')
+    parser.add_argument('--report-only', action='store_true', help='取得せずに鮮度レポートだけ出力する')
+    parser.add_argument('--skip-disclosures', action='store_true', help='開示一覧による無効化を行わない')
+    args = parser.parse_args(argv)
+
+    if args.report_only:
+        codes = [c.strip() for c in args.codes.split(',')] if args.codes else None
+        fundamentals_cache.write_freshness_report(codes)
+        return True
+
+    if not fundamentals_cache.CACHE_ENABLED:
+        print("FUNDAMENTALS_CACHE=0 のため事前取得を行いません")
+        return False
+
+    token = scanner.resolve_id_token()
+    if not token:
+        print("警告: JQUANTS_TOKEN が未設定です。環境変数を確認してください。")
+        return False
+    headers = {"Authorization": f"Bearer {token}"}
+
+    print(f"=== 財務データ事前取得（mode={args.mode}） ===")
+    try:
+        with stage_timer('listed_info'):
+            listed = scanner.fetch_listed_info(headers, refresh=(args.mode == 'full'))
+    except JQuantsError as e:
+        print(f"銘柄マスタ取得エラー: {e}")
+        return False
+
+    codes = [c.strip() for c in args.codes.split(',') if c.strip()] if args.codes else target_codes(listed)
+    state = disclosure_sync.load_state()
+    if not args.skip_disclosures:
+        with stage_timer('disclosures'):
+            disclosure_sync.sync(headers, codes=codes, holdings=scanner.HOLDING_CODES, state=state)
+    if args.mode == 'stale':
+        # 開示のあった銘柄（優先度順）→ 期限切れ・未取得の銘柄
+        queued = [c for c in disclosure_sync.pending(state) if c in set(codes)]
+        stale = fundamentals_cache.freshness_report(codes)['stale_codes']
+        codes = queued + [c for c in stale if c not in set(queued)]
+    print(f"取得対象: {len(codes)}銘柄")
+
+    failed = 0
+    for i, code in enumerate(codes):
+        try:
+            with stage_timer('prefetch'):
+                prefetch_code(code, headers, refresh=True)
+            disclosure_sync.mark_done(state, code)
+            incr('prefetched_codes')
+        except JQuantsError as e:
+            failed += 1
+            incr('prefetch_failed')
+            print(f"  {code}: 取得エラー: {e}")
+        if (i + 1) % 100 == 0:
+            print(f"  {i + 1}/{len(codes)} 完了")
+        jquants_http.throttle(0.1)  # API制限対策
+
+    disclosure_sync.save_state(state)
+    print(f"事前取得完了: {len(codes) - failed}/{len(codes)}銘柄")
+    fundamentals_cache.write_freshness_report(target_codes(listed))
+    return failed == 0
+
+
+if __name__ == '__main__':
+    try:
+        success = main()
+    finally:
+        write_report('prefetch')
+    sys.exit(0 if success else 1)
@@ -0,0 +1,131 @@
+# 新高値ブレイク法システム - 株価行列から求める指標（出来高急増率・実現ボラティリティ・ATR・高値からの距離）
+#
+# 株価行列（銘柄数 × 営業日数）の基準日までの窓を全銘柄まとめて切り出し、欠損（valid=False）を除いた
+# 窓平均・標準偏差で計算する（銘柄ごとの DataFrame は作らない）。step1 が当日分を行列へ追記した直後に1回だけ呼ぶ。
+#
+#   volume_ratio     当日出来高 / 直近20営業日（当日を除く）の平均出来高
+#   volume_ratio_50  当日出来高 / 直近50営業日（当日を除く）の平均出来高
+#   volatility       直近20営業日の日次対数収益率の標準偏差（年率換算）
+#   atr_pct          直近14営業日の平均 True Range / 当日終値
+#   distance_from_high  当日終値 / 65週（窓内）高値 - 1（0 が高値圏、負の値ほど高値から遠い）
+#
+# 使い方例:
+#   python price_features.py              # 行列の最終営業日の指標を要約表示
+
+import sys
+
+import numpy as np
+
+import price_matrix
+
+VOLUME_WINDOWS = (20, 50)
+VOLATILITY_WINDOW = 20
+ATR_WINDOW = 14
+ANNUALIZATION = 250
+# 窓内の有効日数がこの割合未満の銘柄は NaN とする
+MIN_COVERAGE = 0.5
+FEATURES = ('volume_ratio', 'volume_ratio_50', 'volatility', 'atr_pct', 'distance_from_high')
+
+
+def _masked(matrix, name, lo, hi, rows):
+    values = price_matrix.as_float64(matrix.field(name)[rows, lo:hi])
+    return np.where(np.asarray(matrix.valid[rows, lo:hi]), values, np.nan)
+
+
+def _window_mean(values, n):
+    """末尾 n 列の NaN を除いた平均（有効日数が n * MIN_COVERAGE 未満なら NaN）"""
+    w = values[:, -n:]
+    count = np.count_nonzero(~np.isnan(w), axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = np.nansum(w, axis=1) / count
+    return np.where(count >= n * MIN_COVERAGE, mean, np.nan)
+
+
+def compute(matrix, day=None, codes=None):
+    """day（既定: 行列の最終営業日）時点の指標を全銘柄（codes 指定時はその銘柄）まとめて計算する。
+
+    戻り値: (行列上のコードのリスト, {指標名: float64 配列})
+    """
+    if matrix is None or matrix.n_sessions == 0:
+        return [], {f: np.empty(0) for f in FEATURES}
+    c = matrix.n_sessions - 1 if day is None else matrix.col(day)
+    if c is None:
+        return [], {f: np.empty(0) for f in FEATURES}
+    if codes is None:
+        keys = list(matrix.codes)
+    else:
+        keys = [k for k in (matrix.code_for(str(code)) for code in codes) if k is not None]
+    rows = np.array([matrix.row(k) for k in keys], dtype='int64')
+    # 出来高は当日を除く窓、収益率・True Range は前日終値を使うため、いずれも窓 + 1 列が要る
+    lookback = max(max(VOLUME_WINDOWS), VOLATILITY_WINDOW, ATR_WINDOW) + 1
+    lo = max(c + 1 - lookback, 0)
+
+    volume = _masked(matrix, 'Volume', lo, c + 1, rows)
+    close = _masked(matrix, 'Close', lo, c + 1, rows)
+    high = _masked(matrix, 'High', lo, c + 1, rows)
+    low = _masked(matrix, 'Low', lo, c + 1, rows)
+    today_volume, today_close = volume[:, -1], close[:, -1]
+
+    out = {}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        for n, name in zip(VOLUME_WINDOWS, ('volume_ratio', 'volume_ratio_50')):
+            avg = _window_mean(volume[:, :-1], n)
+            out[name] = np.where(avg > 0, today_volume / avg, np.nan)
+
+        # 欠損日をまたぐ収益率は NaN のまま（前日が欠損なら計算しない）
+        returns = np.log(close[:, 1:] / close[:, :-1])
+        r = returns[:, -VOLATILITY_WINDOW:]
+        count = np.count_nonzero(~np.isnan(r), axis=1)
+        std = np.sqrt(np.nansum((r - _window_mean(r, VOLATILITY_WINDOW)[:, None]) ** 2, axis=1) / (count - 1))
+        out['volatility'] = np.where(count >= VOLATILITY_WINDOW * MIN_COVERAGE, std * np.sqrt(ANNUALIZATION), np.nan)
+
+        prev_close = close[:, :-1]
+        true_range = np.fmax(high[:, 1:] - low[:, 1:],
+                             np.fmax(np.abs(high[:, 1:] - prev_close), np.abs(low[:, 1:] - prev_close)))
+        # 前日終値が欠損の日は高値 - 安値
+        true_range = np.where(np.isnan(prev_close), high[:, 1:] - low[:, 1:], true_range)
+        out['atr_pct'] = _window_mean(true_range, ATR_WINDOW) / today_close
+
+    # 高値からの距離は65週窓（行列の保持期間）全体の高値に対して
+    window_high = _masked(matrix, 'High', max(c + 1 - price_matrix.MAX_SESSIONS, 0), c + 1, rows)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        out['distance_from_high'] = today_close / np.fmax.reduce(window_high, axis=1) - 1.0
+    return keys, out
+
+
+def lookup(matrix, keys, values, codes):
+    """compute の結果から {code: {指標名: 値（欠損は None）}} を作る（codes は4桁・5桁どちらでもよく、渡したコードをキーにする）"""
+    row_of = {k: i for i, k in enumerate(keys)}
+    out = {}
+    for code in codes:
+        i = row_of.get(matrix.code_for(str(code)))
+        if i is None:
+            continue
+        out[code] = {name: (None if np.isnan(values[name][i]) else round(float(values[name][i]), 6)) for name in FEATURES}
+    return out
+
+
+def finite(values, names):
+    """{指標名: 有限値のリスト}（ステップ2の分位点スケッチを全銘柄の分布で更新するため）"""
+    return {name: np.round(values[name][np.isfinite(values[name])], 6).tolist() for name in names}
+
+
+def main():
+    matrix = price_matrix.PriceMatrix.attach()
+    if matrix is None:
+        print(f"株価行列がありません（{price_matrix.MATRIX_DIR}）")
+        return False
+    keys, values = compute(matrix)
+    print(f"{matrix.describe()}")
+    for name in FEATURES:
+        v = values[name][~np.isnan(values[name])]
+        if len(v):
+            print(f"  {name:18s}: n={len(v)}, p10={np.percentile(v, 10):.4g}, p50={np.percentile(v, 50):.4g}, "
+                  f"p90={np.percentile(v, 90):.4g}")
+        else:
+            print(f"  {name:18s}: n=0")
+    return True
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,391 @@
+# 新高値ブレイク法システム - 銘柄 × 営業日の株価行列（メモリマップ .npy、ワーカープロセスとコピーなしで共有）
+#
+# High/Low/Close/Volume を float32 の（銘柄数, 営業日数）行列として MATRIX_DIR に保存し、有効値マスク
+# （valid）と、コード→行・日付→列の索引（index.json）を持つ。読み手は attach() で読み取り専用の
+# メモリマップとして開くだけなので、プロセスプールの各ワーカーでもページキャッシュを共有し RSS が増えない。
+# PriceMatrix を pickle するとパスと世代だけが渡り、ワーカー側で開き直す。
+#
+# 書き込み:
+#   - MatrixWriter: スキャン中に銘柄ごとの日足を行へ直接書き込み、commit で新しい世代として公開する
+#   - append_session: 新しい営業日の日足（daily_quotes?date=）を空き列へ追記する（増分）。
+#     空き列が尽きた・新規銘柄がある場合だけ、古い営業日を落として新しい世代に作り直す
+# 世代ごとに別ファイルへ書いてから index.json を置き換えるため、既に開いている読み手は旧世代を使い続けられる。
+# 索引の complete には全期間を書き込めた銘柄を記録する（取得に失敗した銘柄の行は増分更新の対象にしない）。
+#
+# 使い方例:
+#   python price_matrix.py              # 行列の概要を表示
+#   python price_matrix.py --update     # 最終列の翌営業日から最新営業日までを追記
+
+import argparse
+import json
+import os
+import sys
+from datetime import datetime
+
+import numpy as np
+from numpy.lib.format import open_memmap
+
+import instrumentation
+from jquants_http import API_BASE, iter_records
+from quotes_decoder import date_ordinal, ordinal_to_str
+from trading_calendar import WINDOW_SESSIONS_65W
+
+MATRIX_DIR = os.environ.get('PRICE_MATRIX_DIR', '.price_matrix')
+# PRICE_MATRIX=0 でスキャン時の書き込みを行わない
+MATRIX_ENABLED = os.environ.get('PRICE_MATRIX', '1') not in ('0', 'false', 'False', '')
+# 保持する営業日数（既定: 65週窓 + 当日）と、増分追記のために確保しておく空き列数
+MAX_SESSIONS = int(os.environ.get('PRICE_MATRIX_SESSIONS', str(WINDOW_SESSIONS_65W + 1)))
+SPARE_SESSIONS = 20
+
+FIELDS = ('High', 'Low', 'Close', 'Volume')
+SCHEMA_VERSION = 1
+INDEX_FILE = 'index.json'
+
+
+def _ordinal(day):
+    if isinstance(day, (int, np.integer)):
+        return int(day)
+    return date_ordinal(day)
+
+
+def code4(code):
+    """'56210' -> '5621'（API の5桁コードは末尾0付き。保有銘柄は4桁で指定される）"""
+    code = str(code)
+    return code[:4] if len(code) == 5 and code.endswith('0') else code
+
+
+def as_float64(values):
+    """float32 の値を有効数字7桁に丸めて float64 に戻す（2461.7 が 2461.699951... にならないように）"""
+    x = np.asarray(values, dtype='float64')
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mag = np.floor(np.log10(np.abs(x)))
+        scale = np.where(np.isfinite(mag), 10.0 ** (6 - mag), 1.0)
+        return np.round(x * scale) / scale
+
+
+def _file(path, name, generation):
+    return os.path.join(path, f"{name}.{generation}.npy")
+
+
+def _index_file(path, generation=None):
+    return os.path.join(path, INDEX_FILE if generation is None else f"index.{generation}.json")
+
+
+def read_index(path=None, generation=None):
+    try:
+        with open(_index_file(path or MATRIX_DIR, generation), 'r', encoding='utf-8') as f:
+            index = json.load(f)
+    except (OSError, ValueError):
+        return None
+    return index if index.get('version') == SCHEMA_VERSION else None
+
+
+def _write_json(path, doc):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(doc, f, ensure_ascii=False)
+    os.replace(tmp, path)
+
+
+def _publish(path, index):
+    """世代別の索引を書いてから index.json を置き換える"""
+    index = dict(index, updated_at=datetime.now().isoformat(timespec='seconds'))
+    _write_json(_index_file(path, index['generation']), index)
+    _write_json(_index_file(path), index)
+
+
+def _remove_old_generations(path, keep_from):
+    """keep_from より古い世代のファイルを削除する（直前の世代は開いている読み手のために残す）"""
+    for name in os.listdir(path):
+        parts = name.split('.')
+        if len(parts) == 3 and parts[1].isdigit() and int(parts[1]) < keep_from:
+            try:
+                os.remove(os.path.join(path, name))
+            except OSError:
+                pass
+
+
+def _reattach(path, generation):
+    return PriceMatrix.attach(path, generation=generation)
+
+
+class PriceMatrix:
+    """メモリマップした株価行列（読み取り専用が既定）"""
+
+    def __init__(self, path, index, mode='r'):
+        self.path = path
+        self.mode = mode
+        self.generation = index['generation']
+        self.capacity = index['capacity']
+        self.codes = list(index['codes'])
+        self.dates = np.array([date_ordinal(d) for d in index['dates']], dtype='int32')
+        self.complete = set(index.get('complete') or ())
+        self._rows = {code: i for i, code in enumerate(self.codes)}
+        self._arrays = {name: np.load(_file(path, name, self.generation), mmap_mode=mode)
+                        for name in FIELDS + ('valid',)}
+
+    @classmethod
+    def attach(cls, path=None, mode='r', generation=None):
+        """行列を開く（無い・壊れている場合は None）。generation を指定するとその世代を開く"""
+        path = path or MATRIX_DIR
+        index = read_index(path, generation)
+        if index is None:
+            return None
+        try:
+            return cls(path, index, mode)
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def __reduce__(self):
+        # ワーカーへはパスと世代だけを渡し、配列はメモリマップで開き直す（コピーしない）
+        return (_reattach, (self.path, self.generation))
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __contains__(self, code):
+        return code in self._rows
+
+    @property
+    def n_sessions(self):
+        return len(self.dates)
+
+    @property
+    def valid(self):
+        return self._arrays['valid'][:, :self.n_sessions]
+
+    def field(self, name):
+        """（銘柄数, 営業日数）の float32 ビュー（欠損は NaN）"""
+        return self._arrays[name][:, :self.n_sessions]
+
+    def row(self, code):
+        return self._rows.get(code)
+
+    def code_for(self, code):
+        """API の5桁コード（末尾0）と4桁コードのどちらで登録されていても行列上のコードを返す"""
+        if code in self._rows:
+            return code
+        if code4(code) in self._rows:
+            return code4(code)
+        if len(code) == 4 and code + '0' in self._rows:
+            return code + '0'
+        return None
+
+    def col(self, day):
+        d = _ordinal(day)
+        i = int(np.searchsorted(self.dates, d))
+        return i if i < len(self.dates) and int(self.dates[i]) == d else None
+
+    def history(self, code, name='Close'):
+        """1銘柄の（日付の日数, 値（float64））。有効な日だけ"""
+        r = self.row(code)
+        if r is None:
+            return np.empty(0, dtype='int32'), np.empty(0, dtype='float64')
+        ok = self.valid[r]
+        return self.dates[ok], as_float64(self.field(name)[r][ok])
+
+    def describe(self):
+        first = ordinal_to_str(self.dates[0]) if len(self.dates) else '-'
+        last = ordinal_to_str(self.dates[-1]) if len(self.dates) else '-'
+        filled = float(self.valid.mean()) if self.valid.size else 0.0
+        return (f"{len(self.codes)}銘柄 × {self.n_sessions}営業日（{first}〜{last}, 空き列{self.capacity - self.n_sessions}）, "
+                f"世代{self.generation}, 充填率{filled:.1%}")
+
+
+class MatrixWriter:
+    """新しい世代の行列を作り、銘柄ごとの日足を書き込む（commit で公開するまで読み手には見えない）"""
+
+    def __init__(self, codes, dates, path=None, spare=SPARE_SESSIONS):
+        self.path = path or MATRIX_DIR
+        os.makedirs(self.path, exist_ok=True)
+        prev = read_index(self.path)
+        self.generation = (prev['generation'] + 1) if prev else 1
+        self.codes = list(dict.fromkeys(codes))
+        self.dates = np.unique(np.array([_ordinal(d) for d in dates], dtype='int32'))
+        self.capacity = len(self.dates) + spare
+        self._rows = {code: i for i, code in enumerate(self.codes)}
+        self.complete = set()
+        shape = (len(self.codes), self.capacity)
+        self._arrays = {}
+        for name in FIELDS:
+            arr = open_memmap(_file(self.path, name, self.generation), mode='w+', dtype='float32', shape=shape)
+            arr[:] = np.nan
+            self._arrays[name] = arr
+        self._arrays['valid'] = open_memmap(_file(self.path, 'valid', self.generation), mode='w+', dtype='bool', shape=shape)
+
+    def add(self, code, quotes):
+        """quotes（quotes_from_rows と同じ形 {'date': int32[], 'High': ..., ...}）を code の行に書き込む"""
+        r = self._rows.get(code)
+        dates = np.asarray(quotes.get('date', ()), dtype='int32')
+        if r is None or len(dates) == 0 or len(self.dates) == 0:
+            return
+        cols = np.searchsorted(self.dates, dates)
+        ok = cols < len(self.dates)
+        ok[ok] = self.dates[cols[ok]] == dates[ok]
+        cols = cols[ok]
+        for name in FIELDS:
+            if name in quotes:
+                self._arrays[name][r, cols] = np.asarray(quotes[name])[ok]
+        present = quotes.get('Close', quotes.get('High'))
+        if present is not None:
+            self._arrays['valid'][r, cols] = ~np.isnan(np.asarray(present, dtype='float64')[ok])
+
+    def mark_complete(self, code):
+        """code の全期間を書き込めた（取得が途中で失敗していない）ことを記録する"""
+        if code in self._rows:
+            self.complete.add(code)
+
+    def copy_from(self, matrix):
+        """既存の行列から共通する銘柄・営業日の値を写す。
+
+        この行列の先頭営業日が既存の行列の範囲内なら、既存で complete の銘柄は引き続き complete とする
+        （それより後の営業日は日単位の追記で全銘柄分が埋まるため）。
+        """
+        if matrix is None or matrix.n_sessions == 0 or len(self.dates) == 0:
+            return
+        keep = np.isin(matrix.dates, self.dates)
+        src_cols = np.flatnonzero(keep)
+        dst_cols = np.searchsorted(self.dates, matrix.dates[keep])
+        pairs = [(self._rows[c], matrix.row(c)) for c in matrix.codes if c in self._rows]
+        if not pairs or len(src_cols) == 0:
+            return
+        dst_rows = np.array([p[0] for p in pairs], dtype='int64')
+        src_rows = np.array([p[1] for p in pairs], dtype='int64')
+        for name in FIELDS + ('valid',):
+            self._arrays[name][np.ix_(dst_rows, dst_cols)] = matrix._arrays[name][np.ix_(src_rows, src_cols)]
+        if int(self.dates[0]) >= int(matrix.dates[0]):
+            self.complete.update(c for c in matrix.complete if c in self._rows)
+
+    def commit(self):
+        """書き込みを確定して index.json を置き換え、古い世代を削除する。開いた PriceMatrix を返す"""
+        for arr in self._arrays.values():
+            arr.flush()
+        self._arrays = {}
+        _publish(self.path, {
+            'version': SCHEMA_VERSION,
+            'generation': self.generation,
+            'capacity': self.capacity,
+            'codes': self.codes,
+            'dates': [ordinal_to_str(d) for d in self.dates],
+            'fields': list(FIELDS),
+            'complete': sorted(self.complete),
+        })
+        _remove_old_generations(self.path, self.generation - 1)
+        instrumentation.incr('price_matrix_rebuilds')
+        return PriceMatrix.attach(self.path)
+
+
+def _as_float(v):
+    try:
+        return float(v)
+    except (TypeError, ValueError):
+        return np.nan
+
+
+def append_session(day, quotes_by_code, path=None, max_sessions=MAX_SESSIONS):
+    """1営業日分の日足 {code: {'High': .., 'Low': .., 'Close': .., 'Volume': ..}} を追記する。
+
+    既存の列（同じ日）は上書き、最終列より後の日は空き列へ追記する。空き列が無い・新規銘柄がある・
+    最終列より前の日が欠けている場合は、max_sessions 営業日に切り詰めて新しい世代に作り直す。
+    """
+    path = path or MATRIX_DIR
+    day = _ordinal(day)
+    m = PriceMatrix.attach(path, mode='r+')
+    new_codes = [c for c in quotes_by_code if m is None or c not in m]
+    col = m.col(day) if m is not None else None
+    appendable = (m is not None and col is None and m.n_sessions < m.capacity
+                  and (m.n_sessions == 0 or day > int(m.dates[-1])))
+
+    if m is not None and not new_codes and (col is not None or appendable):
+        if col is None:
+            col = m.n_sessions
+        codes = list(quotes_by_code)
+        rows = np.array([m.row(c) for c in codes], dtype='int64')
+        for name in FIELDS:
+            m._arrays[name][rows, col] = np.array([_as_float(quotes_by_code[c].get(name)) for c in codes], dtype='float32')
+        close = m._arrays['Close'][rows, col]
+        m._arrays['valid'][rows, col] = ~np.isnan(close)
+        for arr in m._arrays.values():
+            arr.flush()
+        if appendable:
+            index = read_index(path)
+            index['dates'] = index['dates'] + [ordinal_to_str(day)]
+            _publish(path, index)
+        instrumentation.incr('price_matrix_appends')
+        return PriceMatrix.attach(path)
+
+    # 作り直し: 既存の列（新しい方から max_sessions 営業日）を新しい世代へ写してから追記する
+    old_dates = m.dates if m is not None else np.empty(0, dtype='int32')
+    dates = np.union1d(old_dates, [day])[-max_sessions:]
+    writer = MatrixWriter((m.codes if m is not None else []) + new_codes, dates, path)
+    writer.copy_from(m)
+    for code, q in quotes_by_code.items():
+        quotes = {'date': np.array([day], dtype='int32')}
+        quotes.update({name: np.array([_as_float(q.get(name))]) for name in FIELDS})
+        writer.add(code, quotes)
+    del m
+    return writer.commit()
+
+
+def fetch_session(headers, day):
+    """daily_quotes?date= で1営業日分の全銘柄の日足を取得する {code: {field: value}}"""
+    out = {}
+    params = {'date': ordinal_to_str(_ordinal(day), compact=True)}
+    for r in iter_records(f"{API_BASE}/prices/daily_quotes", 'daily_quotes', params=params, headers=headers):
+        code = r.get('Code')
+        if code:
+            out[code] = {name: r.get(name) for name in FIELDS}
+    return out
+
+
+def update(headers, calendar, until=None, path=None):
+    """最終列の翌営業日から until（既定: カレンダー上の今日以前の直近営業日）までを1日ずつ追記する"""
+    m = PriceMatrix.attach(path)
+    if m is None or m.n_sessions == 0:
+        print("株価行列がありません（step1 のスキャンで作成されます）")
+        return None
+    last = calendar.session_on_or_before(until if until is not None else datetime.now())
+    days = calendar.sessions_between(int(m.dates[-1]) + 1, last) if last is not None else []
+    for day in days:
+        quotes = fetch_session(headers, day)
+        if not quotes:
+            # 日足が未公開（空の列を作ると以後その日を取り直さなくなる）
+            print(f"  {ordinal_to_str(day)}: 日足が未公開のため追記しません")
+            break
+        # 対象銘柄（グロース市場 + 保有銘柄）の入れ替えは step1 の再構築で反映する
+        rows = {}
+        for code, q in quotes.items():
+            key = m.code_for(code)
+            if key is not None:
+                rows[key] = q
+        m = append_session(day, rows, path)
+        print(f"  {ordinal_to_str(day)}: {len(rows)}銘柄を追記")
+    return m
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Inspect or incrementally update the memory-mapped price matrix')
+    parser.add_argument('--update', action='store_true', help='最新営業日までの日足を追記する')
+    parser.add_argument('--path', default=None, help=f'行列のディレクトリ（既定: {MATRIX_DIR}）')
+    args = parser.parse_args(argv)
+
+    if args.update:
+        import step1_stock_scanner as scanner
+        import trading_calendar
+        token = scanner.resolve_id_token()
+        if not token:
+            print("警告: JQUANTS_TOKEN が未設定です。環境変数を確認してください。")
+            return False
+        headers = {"Authorization": f"Bearer {token}"}
+        update(headers, trading_calendar.load_calendar(headers), path=args.path)
+
+    m = PriceMatrix.attach(args.path)
+    if m is None:
+        print("株価行列がありません")
+        return False
+    print(f"株価行列: {m.describe()}")
+    return True
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
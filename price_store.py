@@ -0,0 +1,85 @@
+# 新高値ブレイク法システム - 取得済み終値のローカルストアと as-of 結合
+
+from collections import defaultdict
+
+import numpy as np
+
+from quotes_decoder import date_ordinal
+
+# as-of で許容する最大の遡り日数（従来の get_close_on_date の7日範囲フォールバックと同じ）
+ASOF_MAX_GAP_DAYS = 7
+
+
+def _ordinal(day):
+    if isinstance(day, (int, np.integer)):
+        return int(day)
+    return date_ordinal(day)
+
+
+class PriceStore:
+    """コードごとに取得済みの（日付, 終値）を保持する。
+
+    add でページ単位に追加し、mark_covered で取得済み期間を登録する。取得済み期間外の日付は
+    ローカルでは決まらない（API で補う）。
+    """
+
+    def __init__(self):
+        self._parts = defaultdict(list)
+        self._coverage = {}
+        self._series = {}
+
+    def __contains__(self, code):
+        return code in self._coverage
+
+    def __len__(self):
+        return len(self._coverage)
+
+    def add(self, code, dates, close):
+        self._parts[code].append((np.asarray(dates, dtype='int32'), np.asarray(close, dtype='float64')))
+        self._series.pop(code, None)
+
+    def mark_covered(self, code, first, last):
+        self._coverage[code] = (_ordinal(first), _ordinal(last))
+
+    def series(self, code):
+        """（日付昇順の日数, 終値）。欠損値は除く"""
+        if code not in self._series:
+            parts = self._parts.get(code) or []
+            if parts:
+                dates = np.concatenate([p[0] for p in parts])
+                close = np.concatenate([p[1] for p in parts])
+                if len(dates) > 1 and np.any(dates[1:] < dates[:-1]):
+                    order = np.argsort(dates, kind='stable')
+                    dates, close = dates[order], close[order]
+                valid = ~np.isnan(close)
+                self._series[code] = (dates[valid], close[valid])
+            else:
+                self._series[code] = (np.empty(0, dtype='int32'), np.empty(0, dtype='float64'))
+        return self._series[code]
+
+
+def asof_join(store, codes, days, max_gap_days=ASOF_MAX_GAP_DAYS):
+    """(code, day) の組ごとに day 以前の直近の有効終値を返す（float64 配列、ローカルで決まらなければ NaN）
+
+    コードごとに日付昇順の配列へ二分探索するだけなので、全銘柄分を1パスで解決できる。
+    """
+    codes = list(codes)
+    days = np.array([_ordinal(d) for d in days], dtype='int64')
+    out = np.full(len(codes), np.nan)
+    rows = defaultdict(list)
+    for i, code in enumerate(codes):
+        rows[code].append(i)
+    for code, idx in rows.items():
+        if code not in store:
+            continue
+        first, last = store._coverage[code]
+        dates, close = store.series(code)
+        if len(dates) == 0:
+            continue
+        idx = np.asarray(idx)
+        q = days[idx]
+        pos = np.searchsorted(dates, q, side='right') - 1
+        at = np.clip(pos, 0, None)
+        ok = (pos >= 0) & (q >= first) & (q <= last) & (q - dates[at] <= max_gap_days)
+        out[idx[ok]] = close[at[ok]]
+    return out
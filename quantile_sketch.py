@@ -0,0 +1,187 @@
+# 新高値ブレイク法システム - 指標ごとの分位点スケッチ（KLL、マージ可能・永続化）
+#
+# ステップ2の正規化を「その日の候補銘柄だけの Min-Max」ではなく「これまでの全観測に対するパーセンタイル」で
+# 行うためのスケッチ。1指標あたりの保持点数は k に対して有界（観測数に依存しない）で、JSON 1ファイルに保存して
+# 翌日そのまま読み込める。compactor の間引き位置は乱数ではなく交互に切り替える（同じ入力なら同じ結果）。
+#
+# 使い方例:
+#   python quantile_sketch.py            # 保存済みスケッチの要約（件数・分位点）を表示
+
+import json
+import math
+import os
+import sys
+
+import numpy as np
+
+SKETCH_DIR = os.environ.get('QUANTILE_SKETCH_DIR', '.quantile_sketches')
+SKETCH_FILE = os.path.join(SKETCH_DIR, 'sketches.json')
+FORMAT_VERSION = 1
+# 最上位 compactor の容量（大きいほど精度が高い。順位誤差はおおよそ 1.7/k）
+SKETCH_K = int(os.environ.get('QUANTILE_SKETCH_K', '200'))
+# 下位 compactor ほど容量を C 倍ずつ小さくする
+C = 2.0 / 3.0
+
+
+class KLLSketch:
+    """KLL 分位点スケッチ。update / merge / cdf / quantile"""
+
+    def __init__(self, k=SKETCH_K):
+        self.k = k
+        self.n = 0
+        self.min = None
+        self.max = None
+        self.compactors = [[]]
+        self.offsets = [0]
+
+    def _capacity(self, h):
+        depth = len(self.compactors) - h - 1
+        return max(int(math.ceil(self.k * C ** depth)), 2)
+
+    def _size(self):
+        return sum(len(c) for c in self.compactors)
+
+    def _max_size(self):
+        return sum(self._capacity(h) for h in range(len(self.compactors)))
+
+    def _grow(self):
+        self.compactors.append([])
+        self.offsets.append(0)
+
+    def _compress(self):
+        while self._size() >= self._max_size():
+            for h in range(len(self.compactors)):
+                items = self.compactors[h]
+                if len(items) < self._capacity(h):
+                    continue
+                if h + 1 >= len(self.compactors):
+                    self._grow()
+                items.sort()
+                # 奇数個なら最大の1点を残し、残りの偶数個から1つおきに上位へ（重みは2倍）
+                keep = [items.pop()] if len(items) % 2 else []
+                self.compactors[h + 1].extend(items[self.offsets[h]::2])
+                self.offsets[h] ^= 1
+                self.compactors[h] = keep
+                break
+
+    def update(self, x):
+        x = float(x)
+        if math.isnan(x):
+            return
+        self.n += 1
+        self.min = x if self.min is None else min(self.min, x)
+        self.max = x if self.max is None else max(self.max, x)
+        self.compactors[0].append(x)
+        if len(self.compactors[0]) >= self._capacity(0):
+            self._compress()
+
+    def update_many(self, values):
+        for x in values:
+            self.update(x)
+
+    def merge(self, other):
+        """other の観測を取り込む（別日・別ワーカーのスケッチの結合）"""
+        while len(self.compactors) < len(other.compactors):
+            self._grow()
+        for h, items in enumerate(other.compactors):
+            self.compactors[h].extend(items)
+        self.n += other.n
+        if other.n:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        self._compress()
+        return self
+
+    def _weighted(self):
+        values = np.array([x for c in self.compactors for x in c], dtype='float64')
+        weights = np.array([2 ** h for h, c in enumerate(self.compactors) for _ in c], dtype='float64')
+        order = np.argsort(values, kind='stable')
+        return values[order], weights[order]
+
+    def cdf(self, xs):
+        """xs の各値のパーセンタイル（0〜1）。同値は中間順位（その値未満 + 同値の半分）"""
+        xs = np.asarray(xs, dtype='float64')
+        values, weights = self._weighted()
+        total = weights.sum()
+        if total == 0:
+            return np.full(xs.shape, 0.5)
+        cum = np.concatenate(([0.0], np.cumsum(weights)))
+        below = cum[np.searchsorted(values, xs, side='left')]
+        upto = cum[np.searchsorted(values, xs, side='right')]
+        return (below + upto) / 2.0 / total
+
+    def quantile(self, q):
+        values, weights = self._weighted()
+        if not len(values):
+            return None
+        cum = np.cumsum(weights)
+        return float(values[min(np.searchsorted(cum, q * cum[-1], side='left'), len(values) - 1)])
+
+    def to_dict(self):
+        return {'k': self.k, 'n': self.n, 'min': self.min, 'max': self.max,
+                'compactors': self.compactors, 'offsets': self.offsets}
+
+    @classmethod
+    def from_dict(cls, d):
+        s = cls(d.get('k', SKETCH_K))
+        s.n = d.get('n', 0)
+        s.min = d.get('min')
+        s.max = d.get('max')
+        s.compactors = [list(map(float, c)) for c in d.get('compactors') or [[]]]
+        s.offsets = list(d.get('offsets') or [0] * len(s.compactors))
+        return s
+
+
+def load(path=None):
+    """保存済みスケッチ。無い・形式が違う場合は空の状態（version 0）"""
+    try:
+        with open(path or SKETCH_FILE, 'r', encoding='utf-8') as f:
+            doc = json.load(f)
+    except (OSError, ValueError):
+        doc = None
+    if not doc or doc.get('format_version') != FORMAT_VERSION:
+        return {'format_version': FORMAT_VERSION, 'version': 0, 'updated_through': None, 'metrics': {}}
+    doc['metrics'] = {m: KLLSketch.from_dict(d) for m, d in doc.get('metrics', {}).items()}
+    return doc
+
+
+def save(state, path=None):
+    path = path or SKETCH_FILE
+    doc = dict(state, metrics={m: s.to_dict() for m, s in state['metrics'].items()})
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump(doc, f, separators=(',', ':'))
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"分位点スケッチの保存に失敗: {e}")
+
+
+def update(state, observations, as_of):
+    """observations {指標: 値のリスト} を取り込み version を1つ進める。
+
+    同じ日（as_of）の観測を二重に取り込まないよう、updated_through 以前の日付なら何もしない。
+    戻り値: 取り込んだら True
+    """
+    if state['updated_through'] and as_of and as_of <= state['updated_through']:
+        return False
+    for metric, values in observations.items():
+        sketch = state['metrics'].setdefault(metric, KLLSketch())
+        sketch.update_many(v for v in values if v is not None)
+    state['version'] += 1
+    state['updated_through'] = as_of
+    return True
+
+
+def main():
+    state = load()
+    print(f"{SKETCH_FILE}: version {state['version']}, 更新日 {state['updated_through']}")
+    for metric, s in sorted(state['metrics'].items()):
+        qs = ', '.join(f"p{int(q * 100)}={s.quantile(q):.4g}" for q in (0.1, 0.5, 0.9)) if s.n else '-'
+        print(f"  {metric:18s}: n={s.n}, 保持{s._size()}点, min={s.min}, max={s.max}, {qs}")
+    return True
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
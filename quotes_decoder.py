@@ -0,0 +1,112 @@
+# 新高値ブレイク法システム - daily_quotes 応答の軽量デコーダ（必要な列だけを NumPy 配列へ）
+
+import json
+
+import numpy as np
+
+try:  # orjson があれば高速にパースする（任意依存）
+    import orjson as _orjson
+except ImportError:  # pragma: no cover - 標準 json にフォールバック
+    _orjson = None
+
+# 日付は 1970-01-01 からの日数（int32）で表す
+_EPOCH = np.datetime64('1970-01-01', 'D')
+_NUMERIC_FIELDS = ('Open', 'High', 'Low', 'Close', 'Volume', 'TurnoverValue', 'AdjustmentFactor',
+                   'AdjustmentOpen', 'AdjustmentHigh', 'AdjustmentLow', 'AdjustmentClose', 'AdjustmentVolume')
+
+
+def loads(content):
+    """bytes/str の JSON をパースする（orjson 優先）"""
+    if _orjson is not None:
+        return _orjson.loads(content)
+    if isinstance(content, (bytes, bytearray)):
+        content = content.decode('utf-8')
+    return json.loads(content)
+
+
+def date_ordinal(value):
+    """'YYYY-MM-DD' / 'YYYYMMDD' / datetime -> 1970-01-01 からの日数"""
+    if hasattr(value, 'strftime'):
+        value = value.strftime('%Y-%m-%d')
+    s = str(value)
+    if len(s) == 8 and s.isdigit():
+        s = f"{s[0:4]}-{s[4:6]}-{s[6:8]}"
+    return int((np.datetime64(s, 'D') - _EPOCH).astype(np.int64))
+
+
+def ordinal_to_str(ordinal, compact=False):
+    s = str(_EPOCH + np.timedelta64(int(ordinal), 'D'))
+    return s.replace('-', '') if compact else s
+
+
+def ordinals_to_datetime64(ordinals):
+    return _EPOCH + np.asarray(ordinals, dtype='int64').astype('timedelta64[D]')
+
+
+def _column(rows, field):
+    values = [r.get(field) for r in rows]
+    try:
+        return np.array(values, dtype='float64')
+    except (TypeError, ValueError):
+        # '' や文字列の数値が混在する場合のみ 1件ずつ変換
+        out = np.empty(len(values), dtype='float64')
+        for i, v in enumerate(values):
+            try:
+                out[i] = float(v)
+            except (TypeError, ValueError):
+                out[i] = np.nan
+        return out
+
+
+def quotes_from_rows(rows, fields=('High', 'Close')):
+    """daily_quotes の行リストから {'date': int32[], field: float64[] ...} を作る（日付昇順）"""
+    unknown = [f for f in fields if f not in _NUMERIC_FIELDS]
+    if unknown:
+        raise ValueError(f"unsupported quote fields: {unknown}")
+    if not rows:
+        out = {'date': np.empty(0, dtype='int32')}
+        out.update({f: np.empty(0, dtype='float64') for f in fields})
+        return out
+    dates = np.array([r.get('Date') or '1970-01-01' for r in rows], dtype='datetime64[D]')
+    out = {'date': (dates - _EPOCH).astype('int32')}
+    for f in fields:
+        out[f] = _column(rows, f)
+    d = out['date']
+    if len(d) > 1 and np.any(d[1:] < d[:-1]):
+        order = np.argsort(d, kind='stable')
+        out = {k: v[order] for k, v in out.items()}
+    return out
+
+
+def decode_daily_quotes(content, fields=('High', 'Close')):
+    """daily_quotes 応答本文から必要な列だけを取り出す。
+
+    戻り値: (quotes, pagination_key)。quotes は quotes_from_rows と同じ dict。
+    """
+    doc = loads(content)
+    if isinstance(doc, dict):
+        rows = doc.get('daily_quotes') or doc.get('data') or []
+        pagination_key = doc.get('pagination_key')
+    else:
+        rows, pagination_key = doc or [], None
+    return quotes_from_rows(rows, fields), pagination_key
+
+
+def concat_quotes(parts):
+    """ページ分割された quotes dict を結合する（日付昇順）"""
+    parts = [p for p in parts if p is not None and len(p['date'])]
+    if not parts:
+        return None
+    if len(parts) == 1:
+        return parts[0]
+    out = {k: np.concatenate([p[k] for p in parts]) for k in parts[0]}
+    d = out['date']
+    if np.any(d[1:] < d[:-1]):
+        order = np.argsort(d, kind='stable')
+        out = {k: v[order] for k, v in out.items()}
+    return out
+
+
+def quote_decoder(fields):
+    """iter_pages(decode=...) 用: 必要な列だけを取り出すデコーダ"""
+    return lambda content: decode_daily_quotes(content, fields=fields)
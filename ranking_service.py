@@ -0,0 +1,196 @@
+# 新高値ブレイク法システム - 最新ランキングの問い合わせサービス（標準ライブラリのみ）
+#
+# ステップ2の結果（step2_results.json）を読み込んで、応答本文（JSON）と ETag をあらかじめ作っておき、
+# 他のツールからの問い合わせにはファイルを読まずに辞書引きだけで答える。If-None-Match が一致すれば 304。
+# 結果ファイルの更新（mtime・サイズの変化）はバックグラウンドで検知して読み込み直し、丸ごと差し替える。
+#
+# エンドポイント:
+#   GET /top            投資推奨上位3銘柄
+#   GET /stock/{code}   銘柄ごとの総合スコア・順位・条件適合/除外理由・指標（4桁・5桁コードどちらでも可）
+#   GET /holdings       保有銘柄
+#   GET /excluded       除外銘柄と理由
+#   GET /health         読み込んだ結果の分析日・読み込み時刻
+#
+# 使い方例:
+#   python ranking_service.py --port 8765
+#   curl -i localhost:8765/stock/1234
+
+import argparse
+import hashlib
+import json
+import os
+import sys
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+RESULTS_FILE = os.environ.get('STEP2_OUTPUT_FILE', 'step2_results.json')
+# 結果ファイルの更新を確認する間隔（秒）
+RELOAD_INTERVAL_S = float(os.environ.get('RANKING_RELOAD_INTERVAL_S', '2'))
+# 応答に含めないキー（step2_results.json には API トークンが入っている）
+PRIVATE_KEYS = ('token',)
+
+
+class Response:
+    """事前に作った応答（本文・ETag）"""
+    __slots__ = ('body', 'etag')
+
+    def __init__(self, doc):
+        self.body = json.dumps(doc, ensure_ascii=False, separators=(',', ':'), default=str).encode('utf-8')
+        self.etag = '"' + hashlib.sha1(self.body).hexdigest()[:20] + '"'
+
+
+def _normalize_code(code):
+    """'1234' / '12340' -> '1234'（J-Quants の5桁コードは末尾0付き）"""
+    code = str(code)
+    return code[:4] if len(code) == 5 and code.endswith('0') else code
+
+
+class Rankings:
+    """ステップ2の結果1回分を索引化したもの（読み込み後は変更しない）"""
+
+    def __init__(self, results, source=None, mtime=None):
+        results = {k: v for k, v in results.items() if k not in PRIVATE_KEYS}
+        self.analysis_date = results.get('analysis_date')
+        self.loaded_at = datetime.now().isoformat(timespec='seconds')
+        self.source = source
+        self.mtime = mtime
+        meta = {'analysis_date': self.analysis_date, 'scan_status': results.get('scan_status')}
+
+        top3 = results.get('top3_stocks', [])
+        holdings = results.get('holding_stocks', [])
+        qualified = results.get('qualified_stocks', [])
+        excluded = results.get('excluded_stocks', [])
+        metrics = results.get('metrics_data', {})
+
+        stocks = {}
+        ranked = [s for s in qualified if not s.get('is_holding')]
+        for i, s in enumerate(ranked):
+            stocks[s['code']] = dict(s, status='qualified', rank=i + 1)
+        # 保有銘柄の順位はステップ2の表示と同じく、条件適合銘柄（保有銘柄を含む総合スコア順）の中の位置
+        qualified_rank = {s['code']: i + 1 for i, s in enumerate(qualified)}
+        holdings = [dict(s, rank=qualified_rank.get(s['code'])) for s in holdings]
+        for s in holdings:
+            stocks[s['code']] = dict(s, status='holding')
+        for s in excluded:
+            stocks.setdefault(s['code'], dict(s, status='excluded', rank=None))
+        for code, entry in stocks.items():
+            entry['in_top3'] = any(t['code'] == code for t in top3)
+            if code in metrics:
+                entry['metrics'] = metrics[code]
+
+        self.responses = {
+            '/top': Response(dict(meta, stocks=top3)),
+            '/holdings': Response(dict(meta, stocks=holdings)),
+            '/excluded': Response(dict(meta, stocks=excluded)),
+            '/health': Response(dict(meta, loaded_at=self.loaded_at, source=source, stocks=len(stocks))),
+        }
+        self.stocks = {}
+        for code, entry in stocks.items():
+            r = Response(dict(meta, stock=entry))
+            self.stocks[str(code)] = r
+            self.stocks.setdefault(_normalize_code(code), r)
+
+    def lookup(self, path):
+        """パス -> Response（無ければ None）"""
+        if path.startswith('/stock/'):
+            code = path[len('/stock/'):]
+            return self.stocks.get(code) or self.stocks.get(_normalize_code(code))
+        return self.responses.get(path)
+
+
+def load(path=None):
+    path = path or RESULTS_FILE
+    st = os.stat(path)
+    with open(path, 'r', encoding='utf-8') as f:
+        return Rankings(json.load(f), source=path, mtime=(st.st_mtime_ns, st.st_size))
+
+
+class Store:
+    """最新の Rankings を保持し、結果ファイルが置き換わったら読み込み直す"""
+
+    def __init__(self, path=None):
+        self.path = path or RESULTS_FILE
+        self.current = None
+        self.reload()
+
+    def reload(self):
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return False
+        if self.current is not None and self.current.mtime == (st.st_mtime_ns, st.st_size):
+            return False
+        try:
+            rankings = load(self.path)
+        except (OSError, ValueError) as e:
+            # 書き込み途中などで読めない場合は前回の結果で応答を続ける
+            print(f"結果ファイルを読み込めません（前回の結果で継続）: {e}")
+            return False
+        self.current = rankings
+        print(f"読み込み: {self.path}（分析日 {rankings.analysis_date}, {len(rankings.stocks)}キー）")
+        return True
+
+    def watch(self, interval=RELOAD_INTERVAL_S):
+        def loop():
+            while True:
+                time.sleep(interval)
+                self.reload()
+        threading.Thread(target=loop, name='ranking-reload', daemon=True).start()
+
+
+class Handler(BaseHTTPRequestHandler):
+    store = None
+    server_version = 'RankingService/1'
+
+    def do_GET(self):
+        rankings = self.store.current
+        if rankings is None:
+            return self._send(503, b'{"error":"no results loaded"}')
+        response = rankings.lookup(self.path.split('?', 1)[0].rstrip('/') or '/')
+        if response is None:
+            return self._send(404, b'{"error":"not found"}')
+        if self.headers.get('If-None-Match') == response.etag:
+            return self._send(304, None, response.etag)
+        return self._send(200, response.body, response.etag)
+
+    def _send(self, status, body, etag=None):
+        self.send_response(status)
+        if etag:
+            self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        if body is not None:
+            self.send_header('Content-Type', 'application/json; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if body is not None:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # 1リクエストごとのアクセスログは出さない
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the latest step2 rankings over HTTP')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--file', default=None, help=f'ステップ2の結果ファイル（既定: {RESULTS_FILE}）')
+    args = parser.parse_args(argv)
+
+    store = Store(args.file)
+    store.watch()
+    Handler.store = store
+    server = ThreadingHTTPServer((args.host, args.port), Handler)
+    print(f"ランキングサービス: http://{args.host}:{args.port}/top（結果ファイル: {store.path}）")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return True
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
@@ -0,0 +1,80 @@
+# 新高値ブレイク法システム - リクエスト予算（プランのリクエスト上限・引け後の時間枠）
+
+import os
+import time
+
+import instrumentation
+import jquants_http
+
+# 1回の実行で使ってよいリクエスト数（0: 上限なし）
+REQUEST_BUDGET = int(os.environ.get('JQUANTS_REQUEST_BUDGET', '0'))
+# 1回の実行に使える時間（秒, 0: 上限なし）。見積りは実測の平均レイテンシ + 呼び出し間隔で行う
+TIME_BUDGET_S = float(os.environ.get('RUN_TIME_BUDGET_S', '0'))
+# 平均レイテンシが未計測の場合の仮定値（秒/リクエスト）
+DEFAULT_REQUEST_S = 0.3
+
+
+class RequestBudget:
+    """実行全体のリクエスト数・経過時間を追跡し、見積りコストを払えるか判定する"""
+
+    def __init__(self, max_requests=REQUEST_BUDGET, time_budget_s=TIME_BUDGET_S, pacing_s=0.0):
+        self.max_requests = max_requests
+        self.time_budget_s = time_budget_s
+        self.pacing_s = pacing_s
+        self._start_requests = instrumentation.request_total()
+        self._t0 = time.monotonic()
+
+    def used(self):
+        return instrumentation.request_total() - self._start_requests
+
+    def remaining(self):
+        """残りリクエスト数（上限なしなら None）"""
+        if not self.max_requests:
+            return None
+        return max(self.max_requests - self.used(), 0)
+
+    def elapsed(self):
+        return time.monotonic() - self._t0
+
+    def estimate_seconds(self, cost):
+        return cost * (instrumentation.mean_latency(DEFAULT_REQUEST_S) + self.pacing_s)
+
+    def shortfall(self, cost):
+        """cost リクエストを払えない理由（払えるなら None）"""
+        if cost:
+            # API障害（サーキットブレーカー遮断中）・実行期限切れの間はキャッシュで賄える分だけ進める
+            degraded = jquants_http.degraded_reason()
+            if degraded:
+                return degraded
+        remaining = self.remaining()
+        if remaining is not None and cost > remaining:
+            return f"リクエスト予算不足（必要{cost}件 > 残り{remaining}件）"
+        if self.time_budget_s:
+            left = self.time_budget_s - self.elapsed()
+            need = self.estimate_seconds(cost)
+            if need > left:
+                return f"時間枠不足（見積り{need:.1f}秒 > 残り{max(left, 0):.1f}秒）"
+        return None
+
+    def can_afford(self, cost):
+        return self.shortfall(cost) is None
+
+    def summary(self):
+        return {
+            'max_requests': self.max_requests or None,
+            'used_requests': self.used(),
+            'remaining_requests': self.remaining(),
+            'time_budget_s': self.time_budget_s or None,
+            'elapsed_s': round(self.elapsed(), 2),
+        }
+
+
+def priority_order(holdings, candidates, score_key='new_high_count'):
+    """取得順: 保有銘柄 → 候補を安価な事前スコア（新高値更新回数）の高い順"""
+    order = list(dict.fromkeys(holdings))
+    seen = set(order)
+    for s in sorted(candidates, key=lambda s: s.get(score_key) or 0, reverse=True):
+        if s['code'] not in seen:
+            seen.add(s['code'])
+            order.append(s['code'])
+    return order
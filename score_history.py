@@ -0,0 +1,259 @@
+# 新高値ブレイク法システム - 日次スコア履歴（日付パーティションの列指向ストア + 銘柄コード索引）
+#
+# ステップ2のスコア表（総合・面積・形状スコア、7指標スコア、条件適合・上位3・保有・新高値の区分、除外理由）を
+# 分析日ごとのディレクトリに列ごとの .npy として追記する（同じ日を再実行した場合はその日のパーティションだけを
+# 置き換える）。index.npz はコード → (日付, 行, 区分, 順位) の索引で、銘柄ごとの推移や「今四半期の上位3入り日数」は
+# 索引（総合スコアは索引だけ）と必要なパーティションの列（メモリマップ）だけを読んで答える。
+#
+# 使い方例:
+#   python score_history.py                     # 概要（パーティション数・銘柄数）
+#   python score_history.py 1234 --days 180     # 1234 の総合スコア推移と今四半期の上位3入り日数
+
+import argparse
+import json
+import os
+import shutil
+import sys
+from datetime import datetime, timedelta
+
+import numpy as np
+
+HISTORY_DIR = os.environ.get('SCORE_HISTORY_DIR', '.score_history')
+SCHEMA_VERSION = 1
+INDEX_FILE = 'index.npz'
+
+# 区分（flags のビット）
+QUALIFIED = 1
+TOP3 = 2
+HOLDING = 4
+NEW_HIGH = 8
+
+# 列名 -> dtype（scores は 7指標分の2次元配列）
+COLUMNS = {
+    'code': 'U8',
+    'name': 'U',
+    'comprehensive': 'float64',
+    'area': 'float64',
+    'shape': 'float64',
+    'scores': 'float32',
+    'flags': 'uint8',
+    'rank': 'int16',
+    'reason': 'U',
+}
+# 索引には総合スコアも持たせ、最もよく使う推移の問い合わせはパーティションを開かずに答える
+INDEX_DTYPE = np.dtype([('date', 'i4'), ('row', 'i4'), ('flags', 'u1'), ('rank', 'i2'), ('score', 'f8')])
+
+
+def _day(day):
+    """'20261019' / '2026-10-19' / datetime -> 20261019"""
+    if isinstance(day, datetime):
+        return int(day.strftime('%Y%m%d'))
+    return int(str(day).replace('-', '')[:8])
+
+
+def _partition_dir(path, day):
+    return os.path.join(path, str(_day(day)))
+
+
+def quarter_start(day):
+    """day を含む四半期の初日（YYYYMMDD の int）"""
+    d = _day(day)
+    year, month = divmod(d // 100, 100)
+    return year * 10000 + ((month - 1) // 3 * 3 + 1) * 100 + 1
+
+
+def _read_index(path):
+    try:
+        with np.load(os.path.join(path, INDEX_FILE)) as z:
+            if int(z['version']) != SCHEMA_VERSION:
+                return None
+            return {'codes': z['codes'], 'offsets': z['offsets'], 'entries': z['entries']}
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def _write_index(path, codes, offsets, entries):
+    tmp = os.path.join(path, f"index.{os.getpid()}.tmp.npz")
+    np.savez(tmp, version=np.array(SCHEMA_VERSION), codes=codes, offsets=offsets, entries=entries)
+    os.replace(tmp, os.path.join(path, INDEX_FILE))
+
+
+def append(day, rows, path=None):
+    """1日分のスコア表（rows: dict のリスト）をパーティションとして書き、索引を更新する。戻り値: 行数
+
+    rows のキー: code, name, comprehensive, area, shape, scores（7要素）, flags, rank（上位からの順位、0: 順位なし）, reason
+    """
+    path = path or HISTORY_DIR
+    d = _day(day)
+    os.makedirs(path, exist_ok=True)
+
+    # パーティション: 一時ディレクトリに列を書いてから置き換える
+    final = _partition_dir(path, d)
+    tmp = f"{final}.{os.getpid()}.tmp"
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for col, dtype in COLUMNS.items():
+        values = [r.get(col) for r in rows]
+        if col == 'scores':
+            arr = np.array([v if v is not None else [np.nan] * 7 for v in values], dtype=dtype).reshape(len(rows), 7)
+        elif dtype == 'U':
+            arr = np.array(['' if v is None else str(v) for v in values], dtype=str)
+        elif dtype.startswith('U'):
+            arr = np.array(['' if v is None else str(v) for v in values], dtype=dtype)
+        else:
+            arr = np.array([0 if v is None else v for v in values], dtype=dtype)
+        np.save(os.path.join(tmp, f"{col}.npy"), arr)
+    with open(os.path.join(tmp, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump({'version': SCHEMA_VERSION, 'date': d, 'rows': len(rows),
+                   'written_at': datetime.now().isoformat(timespec='seconds')}, f)
+    if os.path.isdir(final):
+        old = f"{final}.{os.getpid()}.old"
+        os.replace(final, old)
+        os.replace(tmp, final)
+        shutil.rmtree(old, ignore_errors=True)
+    else:
+        os.replace(tmp, final)
+
+    # 索引: その日のエントリを差し替えて (コード, 日付) 順に並べ直す
+    index = _read_index(path)
+    if index is not None:
+        counts = np.diff(index['offsets'])
+        old_codes = np.repeat(index['codes'], counts)
+        keep = index['entries']['date'] != d
+        entry_codes = old_codes[keep]
+        entries = index['entries'][keep]
+    else:
+        entry_codes = np.array([], dtype='U8')
+        entries = np.empty(0, dtype=INDEX_DTYPE)
+    new = np.empty(len(rows), dtype=INDEX_DTYPE)
+    new['date'] = d
+    new['row'] = np.arange(len(rows))
+    new['flags'] = [r.get('flags') or 0 for r in rows]
+    new['rank'] = [r.get('rank') or 0 for r in rows]
+    new['score'] = [np.nan if r.get('comprehensive') is None else r['comprehensive'] for r in rows]
+    entry_codes = np.concatenate([entry_codes.astype('U8'), np.array([str(r['code']) for r in rows], dtype='U8')])
+    entries = np.concatenate([entries, new])
+    order = np.lexsort((entries['date'], entry_codes))
+    entry_codes, entries = entry_codes[order], entries[order]
+    codes, starts = np.unique(entry_codes, return_index=True)
+    offsets = np.append(starts, len(entries)).astype('int64')
+    _write_index(path, codes, offsets, entries)
+    return len(rows)
+
+
+class ScoreHistory:
+    """索引を読み込んだ履歴ストア。パーティションの列は必要になったときにメモリマップで開く"""
+
+    def __init__(self, path=None):
+        self.path = path or HISTORY_DIR
+        index = _read_index(self.path)
+        if index is None:
+            index = {'codes': np.array([], dtype='U8'), 'offsets': np.zeros(1, dtype='int64'),
+                     'entries': np.empty(0, dtype=INDEX_DTYPE)}
+        self.codes = index['codes']
+        self.offsets = index['offsets']
+        self.entries = index['entries']
+        self._columns = {}
+
+    def dates(self):
+        return sorted(set(self.entries['date'].tolist()))
+
+    def entries_for(self, code, since=None, until=None):
+        """code の索引エントリ（日付昇順）。since / until は YYYYMMDD（両端を含む）"""
+        i = int(np.searchsorted(self.codes, str(code)))
+        if i >= len(self.codes) or self.codes[i] != str(code):
+            return self.entries[:0]
+        e = self.entries[self.offsets[i]:self.offsets[i + 1]]
+        lo = np.searchsorted(e['date'], _day(since)) if since is not None else 0
+        hi = np.searchsorted(e['date'], _day(until), side='right') if until is not None else len(e)
+        return e[lo:hi]
+
+    def column(self, day, col):
+        key = (int(day), col)
+        if key not in self._columns:
+            self._columns[key] = np.load(os.path.join(_partition_dir(self.path, day), f"{col}.npy"), mmap_mode='r')
+        return self._columns[key]
+
+    def trajectory(self, code, days=180, until=None, col='comprehensive'):
+        """直近 days 日（暦日）の col の推移。戻り値: (日付のリスト, 値の配列)"""
+        until = _day(until) if until is not None else (int(self.entries['date'].max()) if len(self.entries) else None)
+        if until is None:
+            return [], np.array([])
+        since = _day(datetime.strptime(str(until), '%Y%m%d') - timedelta(days=days))
+        e = self.entries_for(code, since, until)
+        if col == 'comprehensive':
+            return e['date'].tolist(), e['score'].copy()
+        values = np.array([self.column(d, col)[r] for d, r in zip(e['date'].tolist(), e['row'].tolist())])
+        return e['date'].tolist(), values
+
+    def days_with(self, code, flag, since=None, until=None):
+        """区分 flag（TOP3 など）に該当した日数（索引だけで数える）"""
+        e = self.entries_for(code, since, until)
+        return int(np.count_nonzero(e['flags'] & flag))
+
+    def summary(self):
+        return {'partitions': len(self.dates()), 'codes': len(self.codes), 'rows': len(self.entries)}
+
+
+def record_step2(day, final_scores, qualified_stocks, excluded_stocks, top3, path=None):
+    """ステップ2の結果から1日分のスコア表を作って追記する"""
+    qualified = {s['code'] for s in qualified_stocks}
+    top_codes = [s['code'] for s in top3]
+    reasons = {s['code']: s.get('reason') for s in excluded_stocks}
+    ranked = [s['code'] for s in qualified_stocks if not s.get('is_holding')]
+    rows = []
+    for s in final_scores:
+        code = s['code']
+        flags = ((QUALIFIED if code in qualified else 0) | (TOP3 if code in top_codes else 0)
+                 | (HOLDING if s.get('is_holding') else 0) | (NEW_HIGH if s.get('is_new_high_today') else 0))
+        rows.append({
+            'code': code,
+            'name': s.get('name'),
+            'comprehensive': s.get('comprehensive_score'),
+            'area': s.get('area_score'),
+            'shape': s.get('shape_score'),
+            'scores': s.get('scores'),
+            'flags': flags,
+            'rank': ranked.index(code) + 1 if code in ranked else 0,
+            'reason': reasons.get(code),
+        })
+    return append(day, rows, path)
+
+
+def sparkline(values):
+    """値の推移を ▁▂▃▄▅▆▇█ の文字列にする（メール本文用）"""
+    values = np.asarray(values, dtype='float64')
+    if not len(values):
+        return ''
+    lo, hi = np.nanmin(values), np.nanmax(values)
+    bars = '▁▂▃▄▅▆▇█'
+    if not np.isfinite(lo) or hi - lo == 0:
+        return bars[3] * len(values)
+    idx = np.clip(((values - lo) / (hi - lo) * (len(bars) - 1)).round(), 0, len(bars) - 1)
+    return ''.join(bars[int(i)] if np.isfinite(i) else ' ' for i in idx)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Query the per-day score history')
+    parser.add_argument('code', nargs='?', default=None, help='銘柄コード（省略時は概要のみ）')
+    parser.add_argument('--days', type=int, default=180, help='推移の期間（暦日）')
+    parser.add_argument('--path', default=None, help=f'履歴のディレクトリ（既定: {HISTORY_DIR}）')
+    args = parser.parse_args(argv)
+
+    history = ScoreHistory(args.path)
+    s = history.summary()
+    print(f"{history.path}: {s['partitions']}日分, {s['codes']}銘柄, {s['rows']}行")
+    if args.code:
+        dates, values = history.trajectory(args.code, args.days)
+        if not dates:
+            print(f"{args.code}: 履歴がありません")
+            return True
+        print(f"{args.code} 総合スコア（{len(dates)}日分）: {sparkline(values)}")
+        for d, v in zip(dates, values):
+            print(f"  {d}: {v:.4f}")
+        print(f"今四半期の上位3入り: {history.days_with(args.code, TOP3, since=quarter_start(dates[-1]))}日")
+    return True
+
+
+if __name__ == '__main__':
+    sys.exit(0 if main() else 1)
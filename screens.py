@@ -0,0 +1,41 @@
+# 新高値ブレイク法システム - 時価総額・PER スクリーニング条件（step1・step2 で共有）
+
+import os
+
+# 条件（環境変数で上書き可能）: 時価総額 SCREEN_MAX_MARKET_CAP 億円以下 AND PER SCREEN_MIN_PER 倍以上
+MAX_MARKET_CAP = float(os.environ.get('SCREEN_MAX_MARKET_CAP', '200'))
+MIN_PER = float(os.environ.get('SCREEN_MIN_PER', '10'))
+
+
+def describe():
+    return f"時価総額{MAX_MARKET_CAP:g}億円以下 AND PER{MIN_PER:g}倍以上"
+
+
+def passes(market_cap, per):
+    """時価総額（億円）・PER が条件を満たすか（どちらかが不明なら満たさない）"""
+    return market_cap is not None and per is not None and market_cap <= MAX_MARKET_CAP and per >= MIN_PER
+
+
+def format_market_cap(market_cap):
+    """表示用（不明なら 'N/A'）。公表値が無い銘柄・取得を保留した銘柄は None になる"""
+    return f"{market_cap:.0f}億円" if market_cap is not None else 'N/A'
+
+
+def format_per(per):
+    """表示用（不明なら 'N/A'）"""
+    return f"{per:.1f}倍" if per is not None else 'N/A'
+
+
+def failure_reasons(market_cap, per):
+    """条件を満たさない理由のリスト"""
+    reasons = []
+    if market_cap is None:
+        reasons.append("時価総額N/A")
+    try:
+        if market_cap is not None and market_cap > MAX_MARKET_CAP:
+            reasons.append(f"時価総額{market_cap:.0f}億円>{MAX_MARKET_CAP:g}億円")
+    except Exception:
+        pass
+    if per is None or per < MIN_PER:
+        reasons.append(f"PER{format_per(per)}<{MIN_PER:g}倍")
+    return reasons
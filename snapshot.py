@@ -0,0 +1,285 @@
+# 新高値ブレイク法システム - ローカル状態のスナップショット（エフェメラルなランナー間での持ち越し）
+#
+# GitHub-hosted ランナーは毎回まっさらなため、株価行列・財務キャッシュ・取引カレンダー・チャートキャッシュ・
+# HTTPカセット（トークンを含まない記録）・分位点スケッチ・スコア履歴を1つの圧縮ファイル（tar.gz）にまとめて持ち越す。
+# 先頭の manifest.json に形式バージョン・ソースごとのスキーマバージョン・全ファイルの SHA-256 を持ち、
+# 取り込み時は一時ディレクトリへ展開して全件を検証してから置き換える（検証に失敗したら何も変更しない）。
+# 取り込んだ後は、株価は株価行列の不足営業日だけ、財務は期限切れの銘柄だけが API から取得される。
+#
+# 使い方例:
+#   python snapshot.py export                    # .snapshot/state.tar.gz に書き出す
+#   python snapshot.py import                    # 検証して取り込む（ファイルが無ければ何もしない）
+#   python snapshot.py info                      # 内容を表示する
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import shutil
+import sys
+import tarfile
+from datetime import datetime
+
+import chart_cache
+import fundamentals_cache
+import http_cassette
+import price_matrix
+import quantile_sketch
+import score_history
+import trading_calendar
+from instrumentation import incr, stage_timer, write_report
+
+SNAPSHOT_FILE = os.environ.get('SNAPSHOT_FILE', os.path.join('.snapshot', 'state.tar.gz'))
+FORMAT = 'jquants-state-snapshot'
+FORMAT_VERSION = 1
+MANIFEST = 'manifest.json'
+
+# ソース名 -> (ディレクトリ, スキーマバージョン)。スキーマが変わったソースは取り込まない（コールドスタート）
+SOURCES = {
+    'price_matrix': (price_matrix.MATRIX_DIR, price_matrix.SCHEMA_VERSION),
+    'fundamentals': (fundamentals_cache.CACHE_DIR, 1),
+    # カレンダーはキャッシュファイルそのもの（TRADING_CALENDAR_CACHE が作業ディレクトリ直下でも周りを巻き込まない）
+    'calendar': (trading_calendar.CALENDAR_CACHE_FILE, 1),
+    'charts': (chart_cache.CACHE_DIR, 1),
+    'http_cache': (http_cassette.CASSETTE_DIR, 1),
+    'sketches': (quantile_sketch.SKETCH_DIR, quantile_sketch.FORMAT_VERSION),
+    'score_history': (score_history.HISTORY_DIR, score_history.SCHEMA_VERSION),
+}
+# ディレクトリではなく1ファイルのソース
+FILE_SOURCES = ('calendar',)
+# 書き出し前に、これらの環境変数の値（トークン類）がファイルに含まれていないことを確認する
+SECRET_ENV = ('JQUANTS_TOKEN', 'JQUANTS_ACCESS_TOKEN', 'ID_TOKEN', 'JQUANTS_REFRESH_TOKEN', 'GMAIL_TOKEN', 'OPENAI_API_KEY')
+
+
+class SnapshotError(Exception):
+    """スナップショットが壊れている・互換性が無い"""
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _check_root(root):
+    """丸ごと走査・置き換えてよいディレクトリか（作業ディレクトリ・その親・ルートは不可）"""
+    real = os.path.realpath(root)
+    cwd = os.path.realpath(os.getcwd())
+    if real == os.path.dirname(real) or real == cwd or cwd.startswith(real.rstrip(os.sep) + os.sep):
+        raise SnapshotError(f"{root} は作業ディレクトリ（またはその親）のため対象にできません。専用のディレクトリを指定してください")
+
+
+def _source_path(name, rel):
+    root = SOURCES[name][0]
+    return root if name in FILE_SOURCES else os.path.join(root, rel)
+
+
+def _source_files(name, root):
+    """ソースに含めるファイル（root からの相対パス）。株価行列は現在の世代だけを含める"""
+    if name in FILE_SOURCES:
+        return [os.path.basename(root)] if os.path.isfile(root) else []
+    if not os.path.isdir(root):
+        return []
+    _check_root(root)
+    if name == 'price_matrix':
+        index = price_matrix.read_index(root)
+        if index is None:
+            return []
+        g = index['generation']
+        names = ['index.json', f'index.{g}.json'] + [f'{f}.{g}.npy' for f in price_matrix.FIELDS + ('valid',)]
+        return [n for n in names if os.path.isfile(os.path.join(root, n))]
+    out = []
+    for dirpath, _, filenames in os.walk(root):
+        for fn in filenames:
+            if fn.endswith('.tmp'):
+                continue
+            out.append(os.path.relpath(os.path.join(dirpath, fn), root))
+    return sorted(out)
+
+
+def _secrets():
+    return [v.encode() for v in (os.environ.get(k) for k in SECRET_ENV) if v and len(v) >= 16]
+
+
+def export(path=None, sources=None):
+    """ローカル状態をスナップショットに書き出す。戻り値: manifest"""
+    path = path or SNAPSHOT_FILE
+    secrets = _secrets()
+    if not secrets:
+        print(f"注意: トークン類の環境変数（{', '.join(SECRET_ENV)}）が無いため、トークン混入の検査を行いません")
+    files = {}
+    summary = {}
+    for name, (root, schema) in SOURCES.items():
+        if sources and name not in sources:
+            continue
+        rels = _source_files(name, root)
+        size = 0
+        for rel in rels:
+            full = _source_path(name, rel)
+            if secrets:
+                with open(full, 'rb') as f:
+                    data = f.read()
+                if any(s in data for s in secrets):
+                    raise SnapshotError(f"{name}/{rel} にトークンが含まれているため書き出せません")
+            files[f"{name}/{rel}"] = _sha256(full)
+            size += os.path.getsize(full)
+        summary[name] = {'schema': schema, 'files': len(rels), 'bytes': size}
+
+    manifest = {
+        'format': FORMAT,
+        'version': FORMAT_VERSION,
+        'created_at': datetime.now().isoformat(timespec='seconds'),
+        'sources': summary,
+        'files': files,
+    }
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with tarfile.open(tmp, 'w:gz') as tar:
+        data = json.dumps(manifest, ensure_ascii=False, indent=1).encode('utf-8')
+        info = tarfile.TarInfo(MANIFEST)
+        info.size = len(data)
+        info.mtime = int(datetime.now().timestamp())
+        tar.addfile(info, io.BytesIO(data))
+        for arcname in files:
+            name, rel = arcname.split('/', 1)
+            tar.add(_source_path(name, rel), arcname=arcname, recursive=False)
+    os.replace(tmp, path)
+    incr('snapshot_files_exported', len(files))
+    print(f"スナップショット書き出し: {path}（{os.path.getsize(path) / 1e6:.1f}MB, {len(files)}ファイル）")
+    for name, s in summary.items():
+        print(f"  {name}: {s['files']}ファイル, {s['bytes'] / 1e6:.1f}MB")
+    return manifest
+
+
+def read_manifest(tar):
+    member = tar.next()
+    if member is None or member.name != MANIFEST:
+        raise SnapshotError("manifest.json がありません")
+    try:
+        manifest = json.load(tar.extractfile(member))
+    except ValueError as e:
+        raise SnapshotError(f"manifest.json を読めません: {e}")
+    if manifest.get('format') != FORMAT or manifest.get('version') != FORMAT_VERSION:
+        raise SnapshotError(f"形式が違います: {manifest.get('format')} v{manifest.get('version')}（対応: {FORMAT} v{FORMAT_VERSION}）")
+    return manifest
+
+
+def _safe_arcname(name):
+    parts = name.split('/')
+    return not name.startswith('/') and '..' not in parts and len(parts) >= 2 and parts[0] in SOURCES
+
+
+def import_snapshot(path=None, sources=None, verify_only=False):
+    """スナップショットを検証して取り込む。戻り値: 取り込んだソース名のリスト
+
+    チェックサム・形式バージョンのどれかが合わなければ SnapshotError を送出し、何も変更しない。
+    スキーマバージョンが現行と違うソースは取り込まずに飛ばす。
+    """
+    path = path or SNAPSHOT_FILE
+    staging = f".snapshot_import.{os.getpid()}"
+    try:
+        with tarfile.open(path, 'r:gz') as tar:
+            manifest = read_manifest(tar)
+            expected = manifest.get('files', {})
+            wanted = []
+            for name, info in manifest.get('sources', {}).items():
+                if name not in SOURCES or (sources and name not in sources):
+                    continue
+                if info.get('schema') != SOURCES[name][1]:
+                    print(f"  {name}: スキーマが違うため取り込みません（{info.get('schema')} != {SOURCES[name][1]}）")
+                    continue
+                wanted.append(name)
+            seen = set()
+            for member in tar:
+                if member.name == MANIFEST:
+                    continue
+                if not member.isfile() or not _safe_arcname(member.name) or member.name not in expected:
+                    raise SnapshotError(f"想定外のエントリ: {member.name}")
+                source = member.name.split('/', 1)[0]
+                h = hashlib.sha256()
+                dest = os.path.join(staging, member.name)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                with tar.extractfile(member) as src, open(dest, 'wb') as out:
+                    for chunk in iter(lambda: src.read(1 << 20), b''):
+                        h.update(chunk)
+                        out.write(chunk)
+                if h.hexdigest() != expected[member.name]:
+                    raise SnapshotError(f"チェックサム不一致: {member.name}")
+                if source in wanted:
+                    seen.add(member.name)
+            missing = [n for n in expected if n.split('/', 1)[0] in wanted and n not in seen]
+            if missing:
+                raise SnapshotError(f"ファイルが欠けています: {missing[:3]}")
+        if verify_only:
+            print(f"スナップショット検証OK: {path}（{manifest.get('created_at')}）")
+            return wanted
+        # 置き換え先は先に全部確かめる（途中で止まって一部だけ置き換わらないように）
+        for name in wanted:
+            if name not in FILE_SOURCES:
+                _check_root(SOURCES[name][0])
+        for name in wanted:
+            root = SOURCES[name][0]
+            staged = os.path.join(staging, name)
+            if name in FILE_SOURCES:
+                staged = os.path.join(staged, os.path.basename(root))
+                if os.path.isfile(staged):
+                    os.makedirs(os.path.dirname(os.path.abspath(root)), exist_ok=True)
+                    shutil.move(staged, root)
+                continue
+            if not os.path.isdir(staged):
+                os.makedirs(staged)
+            if os.path.isdir(root):
+                shutil.rmtree(root)
+            os.makedirs(os.path.dirname(os.path.abspath(root)), exist_ok=True)
+            shutil.move(staged, root)
+        incr('snapshot_files_imported', len(expected))
+        print(f"スナップショット取り込み: {path}（{manifest.get('created_at')} 作成）: {', '.join(wanted) or 'なし'}")
+        return wanted
+    except (tarfile.TarError, EOFError, OSError) as e:
+        raise SnapshotError(f"スナップショットを読めません: {e}")
+    finally:
+        shutil.rmtree(staging, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export / import a checksummed snapshot of local caches')
+    parser.add_argument('command', choices=('export', 'import', 'info'))
+    parser.add_argument('path', nargs='?', default=None, help=f'スナップショットのパス（既定: {SNAPSHOT_FILE}）')
+    parser.add_argument('--sources', default=None, help=f"対象ソース（カンマ区切り: {', '.join(SOURCES)}）")
+    parser.add_argument('--verify-only', action='store_true', help='import: 検証だけ行い取り込まない')
+    args = parser.parse_args(argv)
+    sources = [s.strip() for s in args.sources.split(',') if s.strip()] if args.sources else None
+    path = args.path or SNAPSHOT_FILE
+
+    try:
+        if args.command == 'export':
+            with stage_timer('snapshot_export'):
+                export(path, sources)
+            return True
+        if not os.path.exists(path):
+            print(f"スナップショットがありません: {path}（コールドスタート）")
+            return args.command == 'import'
+        if args.command == 'import':
+            with stage_timer('snapshot_import'):
+                import_snapshot(path, sources, verify_only=args.verify_only)
+            return True
+        with tarfile.open(path, 'r:gz') as tar:
+            manifest = read_manifest(tar)
+        print(f"{path}: {manifest.get('created_at')} 作成")
+        for name, s in manifest.get('sources', {}).items():
+            print(f"  {name}: schema {s.get('schema')}, {s.get('files')}ファイル, {s.get('bytes', 0) / 1e6:.1f}MB")
+        return True
+    except (SnapshotError, tarfile.TarError, OSError) as e:
+        print(f"スナップショットエラー: {e}")
+        return False
+
+
+if __name__ == '__main__':
+    try:
+        success = main()
+    finally:
+        write_report('snapshot')
+    sys.exit(0 if success else 1)
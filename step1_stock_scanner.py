@@ -1,14 +1,29 @@
 # 新高値ブレイク法システム - ステップ1: データ保存対応版スキャナー
 
-import requests
-import pandas as pd
 import numpy as np
 from datetime import datetime, timedelta
-import time
 import os
 import json
 import traceback
 import sys
+
+import http_cassette
+import fundamentals_cache
+import jquants_http
+import pipeline_log
+import price_features
+import price_matrix
+import request_budget
+import screens
+import trading_calendar
+from jquants_http import API_BASE
+from jquants_http import CircuitOpen, DeadlineExceeded, JQuantsError, iter_records
+from price_store import PriceStore, asof_join
+from quotes_decoder import concat_quotes, decode_daily_quotes, date_ordinal, ordinal_to_str
+from instrumentation import stage, stage_timer, incr, write_report
+
+log = pipeline_log.get_logger('step1')
+roe_log = pipeline_log.get_logger('roe')
 # Configuration / defaults
 # Prefer JQUANTS_TOKEN (may be access token or refresh token) from environment
 _raw_token_env = os.environ.get('JQUANTS_TOKEN')
@@ -20,8 +35,8 @@ def exchange_refresh_for_idtoken(refresh_token: str):
         return None
     try:
         # POST to /v1/token/auth_refresh?refreshtoken=...
-        url = f"https://api.jquants.com/v1/token/auth_refresh?refreshtoken={refresh_token}"
-        r = requests.post(url, timeout=15)
+        url = f"{API_BASE}/token/auth_refresh?refreshtoken={refresh_token}"
+        r = jquants_http.post(url, timeout=15)
         if r.status_code == 200:
             j = r.json()
             idt = j.get('idToken') or j.get('id_token')
@@ -32,15 +47,8 @@ def exchange_refresh_for_idtoken(refresh_token: str):
         return None
 
 
-# Resolve ID_TOKEN: try exchanging env token as a refresh token, else use as-is
+# ID_TOKEN は import 時には解決しない（起動を速くするため。main / CLI から resolve_id_token() を呼ぶ）
 ID_TOKEN = None
-if _raw_token_env:
-    exchanged = exchange_refresh_for_idtoken(_raw_token_env)
-    if exchanged:
-        ID_TOKEN = exchanged
-    else:
-        # assume env contains an access/id token already
-        ID_TOKEN = _raw_token_env
 
 # Output file for step1
 OUTPUT_FILE = os.environ.get('STEP1_OUTPUT_FILE', 'step1_results.json')
@@ -53,20 +61,13 @@ if hc_env:
     except Exception:
         HOLDING_CODES = []
 
+# 市場データ取得（時価総額・PER・ROE）のリトライ: その場では ENRICH_INLINE_RETRIES 回までに抑えて次の銘柄へ進み、
+# 失敗した段階は全銘柄の処理後に ENRICH_RETRY_ROUNDS 回まで間隔（ENRICH_RETRY_BACKOFF_S から倍々）を空けて再試行する
+ENRICH_INLINE_RETRIES = int(os.environ.get('ENRICH_INLINE_RETRIES', '1'))
+ENRICH_RETRY_ROUNDS = int(os.environ.get('ENRICH_RETRY_ROUNDS', '2'))
+ENRICH_RETRY_BACKOFF_S = float(os.environ.get('ENRICH_RETRY_BACKOFF_S', '5'))
+
 
-def request_with_retry(url, params=None, headers=None, method='get', max_retries=3, backoff=1.0, timeout=30):
-    """Simple retry wrapper around requests.get/post. Returns requests.Response or None."""
-    for attempt in range(1, max_retries + 1):
-        try:
-            if method.lower() == 'post':
-                resp = requests.post(url, params=params, headers=headers, timeout=timeout)
-            else:
-                resp = requests.get(url, params=params, headers=headers, timeout=timeout)
-            return resp
-        except Exception as e:
-            if attempt == max_retries:
-                return None
-            time.sleep(backoff * attempt)
 def get_id_token_from_credentials():
     """Obtain an id token using JQUANTS_MAIL / JQUANTS_PASSWORD if provided.
     Returns token string or None."""
@@ -86,7 +87,7 @@ def get_id_token_from_credentials():
     if not mail or not password:
         return None
     try:
-        r = requests.post('https://api.jquants.com/v1/token/auth_user',
+        r = jquants_http.post(f'{API_BASE}/token/auth_user',
                           data=json.dumps({'mailaddress': mail, 'password': password}),
                           timeout=30)
         r.raise_for_status()
@@ -94,7 +95,7 @@ def get_id_token_from_credentials():
         # exchange refresh token for idToken
         if refresh_token:
             try:
-                r2 = requests.post(f'https://api.jquants.com/v1/token/auth_refresh?refreshtoken={refresh_token}', timeout=30)
+                r2 = jquants_http.post(f'{API_BASE}/token/auth_refresh?refreshtoken={refresh_token}', timeout=30)
                 r2.raise_for_status()
                 return r2.json().get('idToken')
             except Exception:
@@ -105,6 +106,35 @@ def get_id_token_from_credentials():
         return None
 
 
+def resolve_id_token():
+    """ID_TOKEN を解決して返す（初回のみ通信する）。
+    JQUANTS_TOKEN を refresh token とみなして交換し、交換できなければそのまま使う。
+    無ければ JQUANTS_MAIL / JQUANTS_PASSWORD、カセット再生時は再生用トークン。"""
+    global ID_TOKEN
+    if ID_TOKEN:
+        return ID_TOKEN
+    if _raw_token_env:
+        # assume env contains an access/id token already if the exchange fails
+        ID_TOKEN = exchange_refresh_for_idtoken(_raw_token_env) or _raw_token_env
+        return ID_TOKEN
+    try:
+        raw = os.environ.get('JQUANTS_ACCESS_TOKEN') or os.environ.get('ID_TOKEN')
+        if raw:
+            ID_TOKEN = exchange_refresh_for_idtoken(raw)
+    except Exception:
+        pass
+    # fallback to credentials flow
+    if not ID_TOKEN:
+        try:
+            ID_TOKEN = get_id_token_from_credentials()
+        except Exception:
+            ID_TOKEN = None
+    # カセット再生時はトークン不要
+    if not ID_TOKEN and http_cassette.is_replaying():
+        ID_TOKEN = http_cassette.REPLAY_ID_TOKEN
+    return ID_TOKEN
+
+
 def latest_fy_statement(rows: list) -> dict:
     # 期末(FY)のみ、期末日→開示日の順で最新を選択
     fy = [r for r in rows if r.get('TypeOfCurrentPeriod') == 'FY']
@@ -118,36 +148,38 @@ def latest_fy_statement(rows: list) -> dict:
     return fy[-1]
 
 
+@stage()
 def get_close_on_date(code: str, date_yyyy_mm_dd: str, headers: dict) -> float:
     """Get Close price on a specific date (YYYY-MM-DD)."""
     try:
-        r = requests.get('https://api.jquants.com/v1/prices/daily_quotes', params={'code': code, 'date': date_yyyy_mm_dd}, headers=headers, timeout=30)
+        r = jquants_http.get(f'{API_BASE}/prices/daily_quotes', params={'code': code, 'date': date_yyyy_mm_dd}, headers=headers, timeout=30)
+        if r.status_code in jquants_http.RETRY_STATUSES:
+            raise JQuantsError(f"prices/daily_quotes: HTTP {r.status_code}", r.status_code)
         r.raise_for_status()
-        arr = r.json().get('daily_quotes') or r.json().get('data') or []
-        if not arr:
+        quotes, _ = decode_daily_quotes(r.content, fields=('Close',))
+        if len(quotes['date']) == 0:
             raise ValueError('No daily quote on date')
-        close = arr[0].get('Close')
-        if close in (None, '', 'NaN'):
+        close = quotes['Close'][0]
+        if np.isnan(close):
             raise ValueError('Close missing')
         return float(close)
+    except (CircuitOpen, DeadlineExceeded):
+        raise
     except Exception as e:
-        # fallback: try range search for nearby date
+        # fallback: try range search for nearby date（取得失敗は JQuantsError として呼び出し側へ）
         try:
             yyyy, mm, dd = date_yyyy_mm_dd.split('-')
             compact = yyyy + mm + dd
             to_date = compact
             from_date = (datetime.strptime(date_yyyy_mm_dd, '%Y-%m-%d') - timedelta(days=7)).strftime('%Y%m%d')
-            resp = request_with_retry('https://api.jquants.com/v1/prices/daily_quotes', params={'code': code, 'from': from_date, 'to': to_date}, headers=headers)
-            if resp and resp.status_code == 200:
-                dq = resp.json().get('daily_quotes') or []
-                if dq:
-                    df = pd.DataFrame(dq)
-                    df['Date'] = pd.to_datetime(df['Date'])
-                    df = df.sort_values('Date')
-                    df['Close'] = pd.to_numeric(df['Close'], errors='coerce')
-                    valid = df['Close'].dropna()
-                    if len(valid) > 0:
-                        return float(valid.iloc[-1])
+            quotes = concat_quotes(jquants_http.iter_quote_pages({'code': code, 'from': from_date, 'to': to_date}, headers,
+                                                                 fields=('Close',), max_retries=ENRICH_INLINE_RETRIES))
+            if quotes is not None:
+                valid = quotes['Close'][~np.isnan(quotes['Close'])]
+                if len(valid) > 0:
+                    return float(valid[-1])
+        except JQuantsError:
+            raise
         except Exception:
             pass
         raise e
@@ -177,30 +209,68 @@ def _fs_detail_dict(fs_details_item):
             return fs
     return {}
 
+# fins/statements は時価総額・PER と ROE の両方で使うため、同一実行内ではコードごとに1回だけ取得する
+_statements_by_code = {}
+
+
+def fetch_statements(code, headers, refresh=False):
+    """Fetch all fins/statements rows for a code (memoized per run; failures are not cached)
+
+    事前取得（prefetch_fundamentals.py）済みで有効期間内ならディスクキャッシュを使う。refresh=True で取り直す。
+    """
+    if refresh or code not in _statements_by_code:
+        rows = None if refresh else fundamentals_cache.get('statements', code)
+        if rows is None:
+            try:
+                rows = list(iter_records(f'{API_BASE}/fins/statements', ('statements', 'data'), params={'code': code}, headers=headers,
+                                         max_retries=ENRICH_INLINE_RETRIES))
+            except (CircuitOpen, DeadlineExceeded):
+                # API障害・期限切れの間は期限切れのキャッシュでも使う（無ければ呼び出し側で保留扱い）
+                rows = fundamentals_cache.get_stale('statements', code)
+                if rows is None:
+                    raise
+                incr('stale_statements_used')
+            else:
+                fundamentals_cache.put('statements', code, rows)
+        _statements_by_code[code] = rows
+    return _statements_by_code[code]
+
+
+@stage()
 def fetch_fy_statements(code, headers):
-    """Fetch FY statements for a code, sorted by period end date then disclosed date"""
-    resp = request_with_retry('https://api.jquants.com/v1/fins/statements', params={'code': code}, headers=headers)
-    if not resp or resp.status_code != 200:
-        print(f"[ROE DEBUG] {code}: fins/statements request failed or non-200: {getattr(resp,'status_code',None)}")
-        return []
-    
-    js = resp.json()
-    rows = js.get("statements", []) if isinstance(js, dict) else js
-    fy = [r for r in rows if r.get("TypeOfCurrentPeriod") == "FY"]
+    """Fetch FY statements for a code, sorted by period end date then disclosed date (取得失敗は JQuantsError)"""
+    fy = [r for r in fetch_statements(code, headers) if r.get("TypeOfCurrentPeriod") == "FY"]
+
     fy.sort(key=lambda r: (r.get("CurrentPeriodEndDate") or "", r.get("DisclosedDate") or ""))
     return fy  # 古→新
 
+@stage()
 def fetch_fs_details_by_date(code, disclosed_date, headers):
-    """Fetch fs_details for a specific disclosed date"""
-    resp = request_with_retry('https://api.jquants.com/v1/fins/fs_details', params={'code': code, 'date': disclosed_date}, headers=headers)
-    if not resp or resp.status_code != 200:
-        return {}
-    
-    js = resp.json()
-    arr = js.get("fs_details", []) if isinstance(js, dict) else js
-    if isinstance(arr, list) and arr:
-        return arr[0]
-    return {}
+    """Fetch fs_details for a specific disclosed date (開示済みの内容は変わらないためキャッシュは期限なし)
+
+    取得失敗は JQuantsError を送出する（失敗を「データなし」として扱わない）。
+    """
+    cache_name = f"{code}_{str(disclosed_date).replace('-', '')}"
+    cached = fundamentals_cache.get('fs_details', cache_name)
+    if cached is not None:
+        return cached
+    # 先頭の1件だけが必要なので、後続ページは取得しない
+    item = next(iter_records(f'{API_BASE}/fins/fs_details', 'fs_details', params={'code': code, 'date': disclosed_date},
+                             headers=headers, max_retries=ENRICH_INLINE_RETRIES), {})
+    if item:
+        fundamentals_cache.put('fs_details', cache_name, item)
+    return item
+
+
+def fetch_listed_info(headers, refresh=False):
+    """listed/info から銘柄マスタ（コード・銘柄名・市場区分のみ）を取得する（キャッシュ有効期間内ならディスクから）"""
+    rows = None if refresh else fundamentals_cache.get('listed_info', 'all')
+    if rows is None:
+        # 全上場銘柄の全項目は保持せず、使う項目だけをページ単位で抽出する
+        rows = [{'Code': s.get('Code'), 'CompanyName': s.get('CompanyName'), 'MarketCodeName': s.get('MarketCodeName')}
+                for s in iter_records(f"{API_BASE}/listed/info", 'info', headers=headers)]
+        fundamentals_cache.put('listed_info', 'all', rows)
+    return rows
 
 def compute_roe_series_last_n_years(code: str, headers: dict, n_years: int = 3):
     """
@@ -226,7 +296,8 @@ def compute_roe_series_last_n_years(code: str, headers: dict, n_years: int = 3):
     try:
         fy = fetch_fy_statements(code, headers)
         if len(fy) < n_years + 1:
-            print(f"[ROE DEBUG] {code}: insufficient FY rows ({len(fy)}) for {n_years}-year ROE calculation (need {n_years + 1})")
+            roe_log.debug('roe.insufficient_rows', "{code}: insufficient FY rows ({rows}) for {years}-year ROE calculation (need {need})",
+                          code=code, rows=len(fy), years=n_years, need=n_years + 1)
             return []
 
         # 直近n_years+1期分のデータを取得（平均自己資本計算に前年が必要）
@@ -258,7 +329,10 @@ def compute_roe_series_last_n_years(code: str, headers: dict, n_years: int = 3):
             
             # 必要な値がすべて揃っているかチェック
             if None in (cur["equity"], cur["nci"], prev["equity"], prev["nci"], cur["profit_to_owners"]):
-                print(f"[ROE DEBUG] {code}: missing values for year {i} - equity_prev={prev['equity']}, equity_curr={cur['equity']}, nci_prev={prev['nci']}, nci_curr={cur['nci']}, profit={cur['profit_to_owners']}")
+                roe_log.debug('roe.missing_values', "{code}: missing values for year {year} - equity_prev={equity_prev}, equity_curr={equity_curr}, "
+                              "nci_prev={nci_prev}, nci_curr={nci_curr}, profit={profit}",
+                              code=code, year=i, equity_prev=prev['equity'], equity_curr=cur['equity'],
+                              nci_prev=prev['nci'], nci_curr=cur['nci'], profit=cur['profit_to_owners'])
                 roes.append(None)
                 continue
                 
@@ -268,20 +342,24 @@ def compute_roe_series_last_n_years(code: str, headers: dict, n_years: int = 3):
             avg_equity = (owners_equity_prev + owners_equity_curr) / 2.0
             
             if avg_equity == 0:
-                print(f"[ROE DEBUG] {code}: average owners equity is zero for year {i}")
+                roe_log.debug('roe.zero_equity', "{code}: average owners equity is zero for year {year}", code=code, year=i)
                 roes.append(None)
                 continue
                 
             roe = cur["profit_to_owners"] / avg_equity
             roes.append(roe)
-            print(f"[ROE DEBUG] {code}: computed ROE year {i} = {roe:.4f} ({roe*100:.2f}%)")
+            roe_log.debug('roe.year', "{code}: computed ROE year {year} = {roe:.4f} ({roe:.2%})", code=code, year=i, roe=roe)
         
         return roes[-n_years:]  # 直近n年分を返す
         
+    except JQuantsError:
+        # 取得失敗は呼び出し側で後回しにして再試行する
+        raise
     except Exception as e:
-        print(f"[ROE DEBUG] {code}: exception during compute_roe_series: {e}")
+        roe_log.warning('roe.series_error', "{code}: exception during compute_roe_series: {error}", code=code, error=e)
         return []
 
+@stage()
 def compute_roe_from_jquants(code: str, headers: dict):
     """
     Compute average ROE for the last 3 years for use in 7-metrics analysis.
@@ -292,203 +370,246 @@ def compute_roe_from_jquants(code: str, headers: dict):
         roe_series = compute_roe_series_last_n_years(code, headers, 3)
         
         if not roe_series:
-            print(f"[ROE DEBUG] {code}: no ROE series available")
+            roe_log.debug('roe.no_series', "{code}: no ROE series available", code=code)
             return None
             
         # None でない値のみで平均を計算
         valid_roes = [r for r in roe_series if r is not None]
         
         if not valid_roes:
-            print(f"[ROE DEBUG] {code}: no valid ROE values in series")
+            roe_log.debug('roe.no_valid_values', "{code}: no valid ROE values in series", code=code)
             return None
             
         avg_roe = sum(valid_roes) / len(valid_roes)
-        print(f"[ROE DEBUG] {code}: 3-year average ROE = {avg_roe:.4f} ({avg_roe*100:.2f}%) from {len(valid_roes)} valid years")
+        roe_log.debug('roe.average', "{code}: 3-year average ROE = {roe:.4f} ({roe:.2%}) from {years} valid years",
+                      code=code, roe=avg_roe, years=len(valid_roes))
         return avg_roe
         
+    except JQuantsError:
+        raise
     except Exception as e:
-        print(f"[ROE DEBUG] {code}: exception during compute_roe_average: {e}")
+        roe_log.warning('roe.average_error', "{code}: exception during compute_roe_average: {error}", code=code, error=e)
+        return None
+
+
+def fiscal_period_end(code, headers):
+    """最新FYの期末日（YYYY-MM-DD）。statements は実行内で共有するため追加のAPI呼び出しは通常発生しない"""
+    try:
+        latest = latest_fy_statement(fetch_statements(code, headers))
+    except JQuantsError:
         return None
+    d = latest.get('CurrentPeriodEndDate') if latest else None
+    if isinstance(d, str) and len(d) == 8 and d.isdigit():
+        d = f"{d[0:4]}-{d[4:6]}-{d[6:8]}"
+    return d or None
+
+
+# ROE 計算（compute_roe_series_last_n_years）が使う FY の期数: 直近3年 + 前年
+ROE_FY_ROWS = 4
+
 
+def _statements_cached(code):
+    return code in _statements_by_code or fundamentals_cache.has('statements', code)
 
-def get_actual_market_data(code, headers):
-    """実際の時価総額・PER・EPS・発行済株式数・ROEを公表値（期末）から算出して返す。
 
-    戻り値: dict with keys: market_cap (億円), per, eps, issued_shares, latest_close, market_cap_jpy, roe
+def estimate_valuation_cost(code, resolved_closes):
+    """時価総額・PER の取得に必要なリクエスト数の見積り（キャッシュ・as-of 結合で賄える分は0）"""
+    cost = 0 if _statements_cached(code) else 1
+    if code not in resolved_closes:
+        cost += 2  # 指定日の終値 + 7日範囲のフォールバック
+    return cost
+
+
+def estimate_roe_cost(code):
+    """ROE（FY statements + fs_details × 期数）の取得に必要なリクエスト数の見積り"""
+    rows = _statements_by_code.get(code)
+    if rows is None:
+        return 1 + ROE_FY_ROWS
+    fy = [r for r in rows if r.get('TypeOfCurrentPeriod') == 'FY']
+    fy.sort(key=lambda r: (r.get('CurrentPeriodEndDate') or '', r.get('DisclosedDate') or ''))
+    cost = 0
+    for row in fy[-ROE_FY_ROWS:]:
+        disclosed = row.get('DisclosedDate') or row.get('CurrentPeriodEndDate')
+        if disclosed and not fundamentals_cache.has('fs_details', f"{code}_{str(disclosed).replace('-', '')}"):
+            cost += 1
+    return cost
+
+
+@stage()
+def resolve_period_end_closes(codes, headers, store, budget=None):
+    """各コードの最新FY期末日以前の直近終値を、取得済みの株価から一括で as-of 結合する。
+
+    戻り値: {code: close}。ローカルで決まらなかったコード（期末日がスキャン期間外など）は含めず、
+    get_actual_market_data 側で従来どおり API から取得する。budget を渡すと、statements の取得が
+    予算を超えるコードは期末日を調べずに残す。
     """
-    try:
-        # Determine token to use: prefer provided headers token, else try mail/password
-        token = None
-        try:
-            auth = headers.get('Authorization', '')
-            if auth.lower().startswith('bearer '):
-                token = auth.split(' ', 1)[1]
-            elif auth:
-                token = auth
-        except Exception:
-            token = None
-
-        if not token:
-            token = get_id_token_from_credentials()
-        used_headers = {'Authorization': f'Bearer {token}'} if token else headers
-
-        # 1) Get most recent FY statement
-        issued_shares = None
-        eps = None
-        latest_close = None
-        market_cap_jpy = None
-        roe = None
-
-        fin_resp = request_with_retry('https://api.jquants.com/v1/fins/statements', params={'code': code}, headers=used_headers)
-        if fin_resp and fin_resp.status_code == 200:
-            fj = fin_resp.json()
-            statements = []
-            if isinstance(fj, dict):
-                if 'statements' in fj and isinstance(fj['statements'], list):
-                    statements = fj['statements']
-                elif 'data' in fj and isinstance(fj['data'], list):
-                    statements = fj['data']
-                else:
-                    statements = [fj]
-            elif isinstance(fj, list):
-                statements = fj
-
-            latest = latest_fy_statement(statements)
-            if latest:
-                # try canonical keys
-                # issued shares
-                for key in ('NumberOfIssuedAndOutstandingSharesAtTheEndOfFiscalYearIncludingTreasuryStock', 'IssuedShares', 'issuedShares', 'sharesOutstanding'):
-                    if key in latest and latest.get(key) not in (None, '', 'NaN'):
-                        try:
-                            issued_shares = float(latest.get(key))
-                            break
-                        except Exception:
-                            pass
-                # diluted EPS
-                for key in ('DilutedEarningsPerShare', 'DilutedEPS', 'Diluted_EPS', 'DilutedEPSPerShare'):
-                    if key in latest and latest.get(key) not in (None, '', 'NaN'):
-                        try:
-                            eps = float(latest.get(key))
-                            break
-                        except Exception:
-                            pass
-                # equity and profit for roe
-                equity_curr = None
-                profit_to_owners = None
-                try:
-                    equity_curr = float(latest.get('Equity')) if latest.get('Equity') not in (None, '', 'NaN') else None
-                except Exception:
-                    equity_curr = None
+    if budget is not None:
+        codes = [c for c in codes if _statements_cached(c) or budget.can_afford(1)]
+    ends = {code: fiscal_period_end(code, headers) for code in codes}
+    ends = {code: d for code, d in ends.items() if d}
+    keys = list(ends)
+    closes = asof_join(store, keys, [ends[c] for c in keys])
+    resolved = {code: float(c) for code, c in zip(keys, closes) if not np.isnan(c)}
+    incr('asof_local_hits', len(resolved))
+    incr('asof_api_fallbacks', len(keys) - len(resolved))
+    return resolved
 
-                # attempt to get fs_details for profit attributable to owners and NCI
-                try:
-                    disclosed = latest.get('DisclosedDate') or latest.get('CurrentPeriodEndDate')
-                    if disclosed:
-                        fs_resp = request_with_retry('https://api.jquants.com/v1/fins/fs_details', params={'code': code, 'date': disclosed}, headers=used_headers)
-                        if fs_resp and fs_resp.status_code == 200:
-                            fdet = fs_resp.json().get('fs_details') or fs_resp.json()
-                            if isinstance(fdet, list) and fdet:
-                                fdet = fdet[0]
-                            # Drill into FinancialStatement dictionary if present
-                            finstmt = None
-                            if isinstance(fdet, dict):
-                                finstmt = fdet.get('FinancialStatement') or fdet
-                            if finstmt and isinstance(finstmt, dict):
-                                # profit attributable to owners
-                                for pkey in ('Profit (loss) attributable to owners of parent (IFRS)', 'Profit (loss) attributable to owners of parent'):
-                                    if pkey in finstmt and finstmt.get(pkey) not in (None, '', 'NaN'):
-                                        try:
-                                            profit_to_owners = float(finstmt.get(pkey))
-                                            break
-                                        except Exception:
-                                            pass
-                                # Non-controlling interests
-                                nci = None
-                                for nkey in ('Non-controlling interests (IFRS)', 'Non-controlling interests'):
-                                    if nkey in finstmt and finstmt.get(nkey) not in (None, '', 'NaN'):
-                                        try:
-                                            nci = float(finstmt.get(nkey))
-                                            break
-                                        except Exception:
-                                            pass
-                except Exception:
-                    pass
-
-        # 2) Determine close price on fiscal end date (use latest statement's CurrentPeriodEndDate if available)
+
+@stage()
+def get_actual_market_data(code, headers, close=None):
+    """実際の時価総額・PER を公表値（期末）から算出して返す。
+
+    fins/statements 1回 + 期末終値の取得だけで済む安価な段階。ROE（fs_details を年数分取得する）は
+    スクリーニング通過銘柄に対して compute_roe_from_jquants で別途取得する。
+    close に期末終値（resolve_period_end_closes で解決済み）を渡すと価格APIを呼ばない。
+
+    戻り値: (market_cap (億円), per)。公表値が無く算出できない値は None（推定値で埋めない）。
+    statements・終値の取得に失敗した場合は JQuantsError を送出する（呼び出し側で後回しにして再試行する）。
+    """
+    # Determine token to use: prefer provided headers token, else try mail/password
+    token = None
+    auth = headers.get('Authorization', '') if headers else ''
+    if auth.lower().startswith('bearer '):
+        token = auth.split(' ', 1)[1]
+    elif auth:
+        token = auth
+    if not token:
+        token = get_id_token_from_credentials()
+    used_headers = {'Authorization': f'Bearer {token}'} if token else headers
+
+    # 1) Get most recent FY statement
+    issued_shares = None
+    eps = None
+    latest = latest_fy_statement(fetch_statements(code, used_headers))
+    if latest:
+        # issued shares
+        issued_shares = _pick_first_num(latest, ('NumberOfIssuedAndOutstandingSharesAtTheEndOfFiscalYearIncludingTreasuryStock', 'IssuedShares', 'issuedShares', 'sharesOutstanding'))
+        # diluted EPS
+        eps = _pick_first_num(latest, ('DilutedEarningsPerShare', 'DilutedEPS', 'Diluted_EPS', 'DilutedEPSPerShare'))
+
+    # 2) Close price on fiscal end date (latest statement's CurrentPeriodEndDate)
+    if close is None and latest and latest.get('CurrentPeriodEndDate'):
+        d = latest.get('CurrentPeriodEndDate')
+        # normalize YYYY-MM-DD or YYYYMMDD
+        if isinstance(d, str) and len(d) == 8 and d.isdigit():
+            d = f"{d[0:4]}-{d[4:6]}-{d[6:8]}"
         try:
-            date_for_close = None
-            if 'latest' in locals() and latest and latest.get('CurrentPeriodEndDate'):
-                d = latest.get('CurrentPeriodEndDate')
-                # normalize YYYY-MM-DD or YYYYMMDD
-                if isinstance(d, str) and len(d) == 8 and d.isdigit():
-                    date_for_close = f"{d[0:4]}-{d[4:6]}-{d[6:8]}"
-                else:
-                    date_for_close = d
-            if date_for_close:
-                try:
-                    latest_close = get_close_on_date(code, date_for_close, used_headers)
-                except Exception:
-                    latest_close = None
-        except Exception:
-            latest_close = None
+            close = get_close_on_date(code, d, used_headers)
+        except ValueError:
+            # 期末前後に約定が無い（データが無いので再試行しない）
+            close = None
+        except JQuantsError:
+            raise
+        except Exception as e:
+            status = getattr(getattr(e, 'response', None), 'status_code', None)
+            raise JQuantsError(f"{code}: close on {d} failed: {e}", status)
 
-        # 3) If issued_shares and latest_close available, compute marketcap
-        market_cap_okuyen = None
-        market_cap_jpy = None
-        if issued_shares and latest_close:
-            try:
-                market_cap_jpy = issued_shares * latest_close
-                market_cap_okuyen = market_cap_jpy / 1e8
-            except Exception:
-                market_cap_okuyen = None
+    # 3) Market cap (億円) and PER from diluted EPS
+    market_cap = issued_shares * close / 1e8 if issued_shares and close else None
+    per = close / eps if close and eps else None
+    return market_cap, per
+
+
+def _enrich_stage(code, stage, headers, roe_headers, period_end_closes, market_data):
+    """1銘柄の1段階（valuation: 時価総額・PER / roe: ROE）を取得して market_data に反映する。
+
+    戻り値: 続けて取得する段階（'roe'）または None。取得失敗は JQuantsError を送出する。
+    """
+    if stage == 'valuation':
+        with stage_timer('screen'):
+            market_cap, per = get_actual_market_data(code, headers, close=period_end_closes.get(code))
+        market_data[code] = {'market_cap': market_cap, 'per': per, 'roe': None}
+        # ステップ2で除外される銘柄には ROE（statements + fs_details × 年数）を取得しない
+        if code not in HOLDING_CODES and not screens.passes(market_cap, per):
+            incr('roe_skipped_by_screen')
+            market_data[code]['screened_out'] = True
+            return None
+        return 'roe'
+    with stage_timer('enrichment'):
+        market_data[code]['roe'] = compute_roe_from_jquants(code, roe_headers)
+    return None
+
+
+def enrich_market_data(order, headers, roe_headers, period_end_closes, budget):
+    """order の順に時価総額・PER → （条件通過銘柄・保有銘柄は）ROE を取得する。
+
+    予算外・API障害中の段階は deferred に記録する。取得に失敗した段階はその場で待たずに再試行キューへ
+    積んで次の銘柄へ進み、全銘柄の処理後に間隔を空けて ENRICH_RETRY_ROUNDS 回まで再試行する。
+    それでも失敗した段階は unresolved に記録し、値は推定値で埋めない（None のまま）。
 
-        # 4) PER from diluted EPS
-        per = None
-        if eps is not None and latest_close is not None:
+    戻り値: (market_data, deferred, unresolved)
+    """
+    market_data = {}
+    deferred = []
+    failed = []
+
+    def run(code, stage, attempts):
+        while stage:
+            cost = estimate_valuation_cost(code, period_end_closes) if stage == 'valuation' else estimate_roe_cost(code)
+            reason = budget.shortfall(cost)
+            if reason:
+                deferred.append({'code': code, 'stage': stage, 'estimated_requests': cost, 'reason': reason})
+                incr('deferred_by_budget')
+                log.info('enrich.deferred', "  保留: {code} {stage} {reason}", code=code, stage=stage, reason=reason)
+                return
             try:
-                per = latest_close / eps if eps != 0 else None
-            except Exception:
-                per = None
+                stage = _enrich_stage(code, stage, headers, roe_headers, period_end_closes, market_data)
+            except (CircuitOpen, DeadlineExceeded) as e:
+                deferred.append({'code': code, 'stage': stage, 'estimated_requests': cost, 'reason': str(e)})
+                incr('deferred_by_budget')
+                return
+            except JQuantsError as e:
+                failed.append({'code': code, 'stage': stage, 'attempts': attempts, 'error': str(e)})
+                incr('enrichment_failed')
+                return
 
-        # 5) Try compute ROE using two-year average equity if possible
-        # Use a dedicated helper that implements the J-Quants recommended approach
-        try:
-            roe = compute_roe_from_jquants(code, used_headers)
-        except Exception:
-            roe = None
+    for code in order:
+        run(code, 'valuation', 1)
 
-        # Final fallbacks
-        if market_cap_okuyen is None:
-            if latest_close and issued_shares:
-                try:
-                    market_cap_jpy = issued_shares * latest_close
-                    market_cap_okuyen = market_cap_jpy / 1e8
-                except Exception:
-                    market_cap_okuyen = 50.0
-            else:
-                market_cap_okuyen = 50.0
+    for round_no in range(1, ENRICH_RETRY_ROUNDS + 1):
+        if not failed:
+            break
+        pending, failed = failed, []
+        wait = ENRICH_RETRY_BACKOFF_S * 2 ** (round_no - 1)
+        left = jquants_http.time_left()
+        if left is not None:
+            wait = min(wait, max(left, 0))
+        print(f"取得失敗の再試行 {round_no}/{ENRICH_RETRY_ROUNDS}: {len(pending)}件（{wait:g}秒後）")
+        jquants_http.throttle(wait)
+        for task in pending:
+            incr('enrichment_retried')
+            run(task['code'], task['stage'], task['attempts'] + 1)
 
-        if per is None:
-            per = 15.0 + (abs(hash(code)) % 20)
+    # 再試行しても取得できなかった段階: 値は None のまま未解決として記録する
+    for task in failed:
+        md = market_data.setdefault(task['code'], {'market_cap': None, 'per': None, 'roe': None})
+        md['unresolved'] = task['stage']
+        incr('enrichment_unresolved')
+        log.warning('enrich.unresolved', "  未解決: {code} {stage}（{error}）", code=task['code'], stage=task['stage'], error=task['error'])
+    return market_data, deferred, failed
+
+
+def count_new_highs(highs, initial_max=0.0):
+    """期間内で日中高値を更新した回数（日付昇順の高値配列を想定。欠損値は更新とみなさない）
+
+    initial_max に前ページまでの最高値を渡すとページ単位で逐次集計できる。
+    """
+    highs = np.asarray(highs, dtype='float64')
+    if len(highs) == 0:
+        return 0
+    # 直前までの最高値（初期値 initial_max、NaNは無視）と比較して更新日を数える
+    prev_max = np.fmax.accumulate(np.concatenate(([initial_max], highs[:-1])))
+    return int(np.count_nonzero(highs > prev_max))
 
-        # Return market cap (億円) and PER to match caller expectations
-        try:
-            mc_val = float(market_cap_okuyen)
-        except Exception:
-            mc_val = 50.0
-        try:
-            per_val = float(per) if per is not None else 15.0
-        except Exception:
-            per_val = 15.0
-        return mc_val, per_val
-    except Exception as e:
-        print(f"get_actual_market_data で例外発生: {e}")
-        return 50.0, 15.0
 
+@stage()
+def check_65w_high_intraday(code, today_date, start_date, headers, store=None, matrix=None):
+    """65週新高値判定（日中高値のみ）
 
-def check_65w_high_intraday(code, today_date, start_date, headers):
-    """65週新高値判定（日中高値のみ）"""
-    url = f"https://api.jquants.com/v1/prices/daily_quotes"
+    daily_quotes をページ単位で受け取りながら集計するため、全期間分を保持しない。
+    store（PriceStore）を渡すと終値も保存し、期末終値の as-of 結合に使えるようにする。
+    matrix（price_matrix.MatrixWriter）を渡すと High/Low/Close/Volume を株価行列へ書き込む。
+    """
     params = {
         'code': code,
         'from': start_date,
@@ -496,85 +617,179 @@ def check_65w_high_intraday(code, today_date, start_date, headers):
     }
     
     try:
-        response = requests.get(url, params=params, headers=headers)
-        if response.status_code == 200:
-            data = response.json()
-            if 'daily_quotes' in data and data['daily_quotes']:
-                df = pd.DataFrame(data['daily_quotes'])
-                if len(df) == 0:
-                    return False, 0, 0, 0, 0
-                
-                df['Date'] = pd.to_datetime(df['Date'])
-                df = df.sort_values('Date')
-                df['Close'] = pd.to_numeric(df['Close'], errors='coerce')
-                df['High'] = pd.to_numeric(df['High'], errors='coerce')
-                
-                # 本日のデータ
-                today_data = df[df['Date'] == today_date]
-                if len(today_data) == 0:
-                    return False, 0, 0, 0, 0
-                
-                today_high = today_data['High'].iloc[0]
-                
-                # 過去65週（本日以前）の最高値
-                past_data = df[df['Date'] < today_date]
-                if len(past_data) == 0:
-                    return False, 0, 0, 0, 0
-                
-                past_max_high = past_data['High'].max()
-                
-                # 本日が65週新高値かどうか（日中高値のみで判定）
-                is_new_high = (today_high > past_max_high)
-                
-                # 新高値更新回数をカウント
-                new_high_count = 0
-                rolling_max = 0
-                
-                for idx, row in df.iterrows():
-                    if row['High'] > rolling_max:
-                        new_high_count += 1
-                    rolling_max = max(rolling_max, row['High'])
-                
-                return is_new_high, new_high_count, len(df), today_high, past_max_high
-        
-        return False, 0, 0, 0, 0
+        today_ord = date_ordinal(today_date)
+        total_days = 0
+        new_high_count = 0
+        rolling_max = 0.0
+        past_max_high = np.nan
+        today_high = None
+
+        # 必要な列（Date, High）だけを配列として1ページずつ処理する
+        fields = ('High', 'Close') if store is not None else ('High',)
+        if matrix is not None:
+            fields = price_matrix.FIELDS
+        for quotes in jquants_http.iter_quote_pages(params, headers, fields=fields, max_retries=1):
+            dates = quotes['date']
+            highs = quotes['High']
+            if len(dates) == 0:
+                continue
+            if store is not None:
+                store.add(code, dates, quotes['Close'])
+            if matrix is not None:
+                matrix.add(code, quotes)
+            total_days += len(dates)
+
+            # 新高値更新回数をカウント（前ページまでの最高値を引き継ぐ）
+            new_high_count += count_new_highs(highs, rolling_max)
+            rolling_max = np.fmax(rolling_max, np.fmax.reduce(highs))
+
+            # 過去65週（本日以前）の最高値
+            past = highs[dates < today_ord]
+            if len(past):
+                past_max_high = np.fmax(past_max_high, np.fmax.reduce(past))
+
+            # 本日のデータ
+            today_idx = np.flatnonzero(dates == today_ord)
+            if len(today_idx) and today_high is None:
+                today_high = highs[today_idx[0]]
+
+        if store is not None:
+            store.mark_covered(code, start_date, today_date)
+        if matrix is not None:
+            matrix.mark_complete(code)
+
+        if total_days == 0 or today_high is None or np.isnan(past_max_high):
+            return False, 0, 0, 0, 0
+
+        # 本日が65週新高値かどうか（日中高値のみで判定）
+        is_new_high = (today_high > past_max_high)
+
+        return is_new_high, new_high_count, total_days, today_high, past_max_high
+    except (CircuitOpen, DeadlineExceeded):
+        # 判定できなかった銘柄として呼び出し側で未スキャンに数える
+        raise
     except Exception as e:
+        log.warning('scan.error', "  {code}: 65週新高値判定エラー: {error}", code=code, error=e)
         return False, 0, 0, 0, 0
 
+def scan_65w_from_matrix(matrix, codes, start_date, today_date, store=None):
+    """株価行列から65週新高値判定を全銘柄まとめて行う（日足の取得なし）。
+
+    戻り値: {code: check_65w_high_intraday と同じタプル}。store を渡すと終値も保存する。
+    """
+    c0, c1 = matrix.col(start_date), matrix.col(today_date)
+    if not codes or c0 is None or c1 is None:
+        return {}
+    rows = np.array([matrix.row(c) for c in codes], dtype='int64')
+    valid = np.asarray(matrix.valid[rows, c0:c1 + 1])
+    highs = np.where(valid, price_matrix.as_float64(matrix.field('High')[rows, c0:c1 + 1]), np.nan)
+
+    # count_new_highs と同じ判定を行方向にまとめて行う（初期値0、NaNは更新とみなさない）
+    prev_max = np.fmax.accumulate(np.concatenate((np.zeros((len(rows), 1), dtype=highs.dtype), highs[:, :-1]), axis=1), axis=1)
+    counts = np.count_nonzero(highs > prev_max, axis=1)
+    past_max = np.fmax.reduce(highs[:, :-1], axis=1) if highs.shape[1] > 1 else np.full(len(rows), np.nan)
+    today_high = highs[:, -1]
+    total_days = valid.sum(axis=1)
+
+    dates = matrix.dates[c0:c1 + 1]
+    closes = price_matrix.as_float64(matrix.field('Close')[rows, c0:c1 + 1]) if store is not None else None
+    results = {}
+    for i, code in enumerate(codes):
+        if store is not None:
+            store.add(code, dates[valid[i]], closes[i][valid[i]])
+            store.mark_covered(code, start_date, today_date)
+        if total_days[i] == 0 or np.isnan(today_high[i]) or np.isnan(past_max[i]):
+            results[code] = (False, 0, 0, 0, 0)
+            continue
+        results[code] = (bool(today_high[i] > past_max[i]), int(counts[i]), int(total_days[i]),
+                         float(today_high[i]), float(past_max[i]))
+    return results
+
+
+def prepare_price_matrix(headers, calendar, codes, start_date, today_date, store=None):
+    """株価行列を準備し、行列から判定できる銘柄の65週新高値判定を済ませる。
+
+    前回の行列（スナップショットから復元したものを含む）が判定窓の先頭を含んでいれば、不足している営業日だけを
+    daily_quotes?date=（1営業日1リクエスト）で追記し、全期間を取得済みの銘柄は行列から判定する。
+
+    戻り値: (results, writer)。results は {code: check_65w_high_intraday と同じタプル}、writer は残りの銘柄
+    （新規・前回取得できなかった銘柄）を銘柄ごとのスキャンで書き込む MatrixWriter（残りが無ければ None）。
+    """
+    if not price_matrix.MATRIX_ENABLED:
+        return {}, None
+    # グロース銘柄（5桁）と保有銘柄（4桁）で同じ銘柄が重複しないよう、4桁に揃えて最初のコードだけを行にする
+    requested = codes
+    canonical = {}
+    for c in requested:
+        canonical.setdefault(price_matrix.code4(c), c)
+    codes = list(canonical.values())
+    matrix = price_matrix.PriceMatrix.attach()
+    results = {}
+    if matrix is not None and matrix.col(start_date) is not None:
+        try:
+            with stage_timer('price_matrix'):
+                matrix = price_matrix.update(headers, calendar, until=date_ordinal(today_date)) or matrix
+        except JQuantsError as e:
+            print(f"株価行列の追記に失敗（銘柄ごとに取得します）: {e}")
+        if matrix.col(today_date) is not None:
+            covered = [c for c in codes if c in matrix.complete]
+            with stage_timer('scan_matrix'):
+                results = scan_65w_from_matrix(matrix, covered, start_date, today_date, store)
+            incr('codes_from_matrix', len(results))
+            print(f"株価行列から判定: {len(results)}銘柄（{matrix.describe()}）")
+    # 重複として除いたコードも、行にしたコードの判定結果で引けるようにする
+    for c in requested:
+        k = canonical[price_matrix.code4(c)]
+        if c not in results and k in results:
+            results[c] = results[k]
+            if store is not None and k in store:
+                store.add(c, *store.series(k))
+                store.mark_covered(c, start_date, today_date)
+    if all(c in results for c in codes):
+        return results, None
+    try:
+        writer = price_matrix.MatrixWriter(codes, calendar.sessions_between(start_date, today_date))
+        if results:
+            writer.copy_from(matrix)
+    except OSError as e:
+        print(f"株価行列を作成できません: {e}")
+        writer = None
+    return results, writer
+
+
 def main():
     """ステップ1: 完全版スキャン + 市場データ取得 + 結果保存"""
+    pipeline_log.configure('step1')
     
-    # Ensure ID_TOKEN is resolved: try exchanging raw env token or credentials if needed
     global ID_TOKEN
-    if not ID_TOKEN:
-        # try exchange again if raw env provided
-        try:
-            raw = os.environ.get('JQUANTS_TOKEN') or os.environ.get('JQUANTS_ACCESS_TOKEN') or os.environ.get('ID_TOKEN')
-            if raw:
-                exchanged = exchange_refresh_for_idtoken(raw)
-                if exchanged:
-                    ID_TOKEN = exchanged
-        except Exception:
-            pass
-        # fallback to credentials flow
-        if not ID_TOKEN:
-            try:
-                ID_TOKEN = get_id_token_from_credentials()
-            except Exception:
-                ID_TOKEN = None
+    ID_TOKEN = resolve_id_token()
 
     headers = {"Authorization": f"Bearer {ID_TOKEN}"}
+    # 実行全体のリクエスト予算（JQUANTS_REQUEST_BUDGET / RUN_TIME_BUDGET_S、スキャン分も含めて数える）
+    budget = request_budget.RequestBudget(pacing_s=0.1)
     
-    # 日付設定（65週前）
-    today = datetime.now()  # 実運用時は datetime.now()
-    #today = datetime(2025, 9, 25)
-    start_date_65w = today - timedelta(weeks=65)
-    today_str = today.strftime('%Y%m%d')
-    start_date_str = start_date_65w.strftime('%Y%m%d')
+    # 日付設定（取引カレンダーで分析対象の営業日と65週前を決める）
+    # SCAN_DATE=YYYYMMDD で分析対象日を固定できる（カセット再生・再現用）
+    with stage_timer('calendar'):
+        calendar = trading_calendar.load_calendar(headers)
+    session, reason = trading_calendar.plan_session(calendar, scan_date=os.environ.get('SCAN_DATE'))
+    if session is None:
+        print(f"=== ステップ1: スキップ（{reason}）===")
+        trading_calendar.export_github_output('trading_session', 'false')
+        return None
+    today_str = ordinal_to_str(session, compact=True)
+    # 65週 = WINDOW_SESSIONS_65W 営業日（カレンダーの範囲外なら暦日で代替）
+    window_start = calendar.window_start(session)
+    if window_start is not None:
+        start_date_str = ordinal_to_str(window_start, compact=True)
+    else:
+        start_date_str = (datetime.strptime(today_str, '%Y%m%d') - timedelta(weeks=65)).strftime('%Y%m%d')
+    trading_calendar.export_github_output('trading_session', 'true')
+    trading_calendar.export_github_output('scan_date', today_str)
     
     print(f"=== ステップ1: 65週新高値更新銘柄スキャン + 市場データ取得 ===")
-    print(f"分析対象日: {today_str}")
-    print(f"65週前: {start_date_str}")
+    print(f"分析対象日: {today_str}（{reason}）")
+    print(f"65週前: {start_date_str}（{trading_calendar.WINDOW_SESSIONS_65W}営業日前, カレンダー: {calendar.source}）")
     
     # 東証グロース銘柄リスト取得
     try:
@@ -591,23 +806,18 @@ def main():
         # Assume JQUANTS_TOKEN is an access token (Bearer). Use it directly.
         headers = {"Authorization": f"Bearer {ID_TOKEN}"}
 
-        response = request_with_retry("https://api.jquants.com/v1/listed/info", headers=headers)
-        if response is None:
-            print("API取得エラー: リクエストが失敗しました（タイムアウトや接続エラーの可能性）。")
-            return False
-        if response.status_code == 200:
-            try:
-                all_stocks = response.json()["info"]
-            except Exception as e:
-                print(f"レスポンスJSONパースエラー: {e}\nレスポンステキスト: {response.text[:500]}")
-                return False
-
-            growth_stocks = [s for s in all_stocks if s.get("MarketCodeName") == "グロース"]
+        try:
+            with stage_timer('listed_info'):
+                listed = fetch_listed_info(headers)
+            growth_stocks = [s for s in listed if s.get("MarketCodeName") == "グロース"]
+            company_names = {s.get('Code'): s.get('CompanyName') for s in listed}
             print(f"グロース市場銘柄数: {len(growth_stocks)}")
-        else:
-            text = response.text or ''
-            print(f"API取得エラー: ステータスコード={response.status_code}\nレスポンステキスト: {text[:500]}")
-            if response.status_code in (401, 403) or 'invalid' in text.lower() or 'expired' in text.lower():
+        except JQuantsError as e:
+            if e.status is None:
+                print("API取得エラー: リクエストが失敗しました（タイムアウトや接続エラーの可能性）。")
+                return False
+            print(f"API取得エラー: {e}")
+            if e.status in (401, 403):
                 print("認証エラー: 提供された JQUANTS_TOKEN が無効または期限切れの可能性があります。")
                 print(" - 確認手順: GitHub Secrets の値が access token (Bearer) であること、また期限内であることを確認してください。")
                 print(" - もし refresh token を使う運用に戻す場合は、環境変数に client_id/client_secret と JQUANTS_TOKEN_ENDPOINT を設定してください。")
@@ -622,7 +832,16 @@ def main():
     
     batch_size = 100
     all_new_high_stocks = []
-    market_data_dict = {}  # 実際の市場データを蓄積
+    price_store = PriceStore()  # スキャンで取得した終値（期末終値の as-of 結合に使う）
+    # 銘柄 × 営業日の株価行列（メモリマップ）: 前回分があれば不足営業日だけ追記して行列から判定し、
+    # 残りの銘柄はスキャンで取得した日足を行列へ書き込む（後段・ワーカーで共有）
+    matrix_results, matrix_writer = prepare_price_matrix(
+        headers, calendar, [s['Code'] for s in growth_stocks] + list(HOLDING_CODES), start_date_str, today_str, price_store)
+    # API障害（サーキットブレーカー）・実行期限（RUN_DEADLINE_S）でスキャンを打ち切った場合の理由と未スキャン銘柄
+    halted = None
+    unscanned = []
+    # スキャンした全銘柄の新高値更新回数（ステップ2の分位点スケッチを市場全体の分布で更新する）
+    universe_counts = []
     
     total_batches = len(growth_stocks) // batch_size + (1 if len(growth_stocks) % batch_size else 0)
     
@@ -631,22 +850,39 @@ def main():
         end_idx = min((batch_num + 1) * batch_size, len(growth_stocks))
         batch = growth_stocks[start_idx:end_idx]
         
-        print(f"第{batch_num + 1}段階: 銘柄{start_idx + 1}-{end_idx}をスキャン中...")
+        log.info('scan.batch', "第{batch}段階: 銘柄{first}-{last}をスキャン中...", batch=batch_num + 1, first=start_idx + 1, last=end_idx)
         batch_results = []
         
         for stock in batch:
             code = stock['Code']
             name = stock['CompanyName']
+            if code not in matrix_results:
+                halted = halted or jquants_http.degraded_reason()
+                if halted:
+                    unscanned.append(code)
+                    continue
             
-            # 65週新高値判定
-            is_new_high, high_count, total_days, today_high, past_max = check_65w_high_intraday(
-                code, today_str, start_date_str, headers
-            )
+            # 65週新高値判定（株価行列で判定済みならAPIを呼ばない）
+            if code in matrix_results:
+                is_new_high, high_count, total_days, today_high, past_max = matrix_results[code]
+                incr('codes_scanned')
+            else:
+                try:
+                    is_new_high, high_count, total_days, today_high, past_max = check_65w_high_intraday(
+                        code, today_str, start_date_str, headers, price_store, matrix_writer
+                    )
+                except JQuantsError as e:
+                    halted = jquants_http.degraded_reason() or str(e)
+                    unscanned.append(code)
+                    continue
+                incr('codes_scanned')
+                jquants_http.throttle(0.1)  # API制限対策
             
-            # 新高値更新銘柄の場合、市場データも取得
+            universe_counts.append(high_count)
+            log.debug('scan.code', "{code} {name}: 新高値={new_high} 更新回数={count} 日数={days}",
+                      code=code, name=name, new_high=bool(is_new_high), count=high_count, days=total_days)
             if is_new_high:
-                market_cap, per = get_actual_market_data(code, headers)
-                
+                incr('new_highs')
                 batch_results.append({
                     'code': code,
                     'name': name,
@@ -655,54 +891,38 @@ def main():
                     'past_max': past_max,
                     'total_days': total_days
                 })
-                
-                # include ROE if available
-                try:
-                    # our helper returns (market_cap, per) but roe is fetched inside and stored via compute_roe function
-                    # call compute_roe_from_jquants separately to ensure availability
-                    roe_val = compute_roe_from_jquants(code, {'Authorization': f'Bearer {ID_TOKEN}'} if ID_TOKEN else headers)
-                except Exception:
-                    roe_val = None
-
-                market_data_dict[code] = {
-                    'market_cap': market_cap,
-                    'per': per,
-                    'roe': roe_val
-                }
-            time.sleep(0.1)  # API制限対策
         
         all_new_high_stocks.extend(batch_results)
-        print(f"第{batch_num + 1}段階結果: {len(batch_results)}件")
-    
-    # 保有銘柄の65週新高値判定 + 市場データ取得
-    print(f"\n保有銘柄の65週新高値判定 + 市場データ取得")
+        log.info('scan.batch_result', "第{batch}段階結果: {found}件", batch=batch_num + 1, found=len(batch_results))
+    pipeline_log.flush()
+
+    # 保有銘柄の65週新高値判定
+    print(f"\n保有銘柄の65週新高値判定")
     holding_stock_info = []
 
     for code in HOLDING_CODES:
         print(f"確認中: {code}")
+        name = company_names.get(code) or f"保有銘柄{code}"
+        if code not in matrix_results:
+            halted = halted or jquants_http.degraded_reason()
+            if halted:
+                unscanned.append(code)
+                print(f"  - 未判定: {name}（{halted}）")
+                continue
+        incr('holdings_checked')
 
-        is_new_high, high_count, _, _, _ = check_65w_high_intraday(
-            code, today_str, start_date_str, headers
-        )
-
-        # 保有銘柄の市場データを必ず取得
-        market_cap, per = get_actual_market_data(code, headers)
         try:
-            roe_val = compute_roe_from_jquants(code, {'Authorization': f'Bearer {ID_TOKEN}'} if ID_TOKEN else headers)
-            market_data_dict[code] = {
-                'market_cap': float(market_cap),
-                'per': float(per),
-                'roe': roe_val
-            }
-        except Exception:
-            market_data_dict[code] = {
-                'market_cap': market_cap,
-                'per': per,
-                'roe': None
-            }
-
-        stock_info = next((s for s in all_stocks if s['Code'] == code), None)
-        name = stock_info['CompanyName'] if stock_info else f"保有銘柄{code}"
+            if code in matrix_results:
+                is_new_high, high_count, _, _, _ = matrix_results[code]
+            else:
+                is_new_high, high_count, _, _, _ = check_65w_high_intraday(
+                    code, today_str, start_date_str, headers, price_store, matrix_writer
+                )
+        except JQuantsError as e:
+            halted = jquants_http.degraded_reason() or str(e)
+            unscanned.append(code)
+            print(f"  - 未判定: {name}（{halted}）")
+            continue
 
         holding_stock_info.append({
             'code': code,
@@ -712,7 +932,7 @@ def main():
         })
         
         if is_new_high:
-            print(f"  ✓ 本日65週新高値: {name} (更新回数:{high_count}, 時価総額:{market_cap:.0f}億円)")
+            print(f"  ✓ 本日65週新高値: {name} (更新回数:{high_count})")
             all_new_high_stocks.append({
                 'code': code,
                 'name': name,
@@ -722,18 +942,90 @@ def main():
                 'total_days': 0
             })
         else:
-            print(f"  - 新高値なし: {name} (更新回数:{high_count}, 時価総額:{market_cap:.0f}億円)")
+            print(f"  - 新高値なし: {name} (更新回数:{high_count})")
+
+    if matrix_writer is not None:
+        try:
+            with stage_timer('price_matrix'):
+                matrix = matrix_writer.commit()
+            if matrix is not None:
+                print(f"株価行列: {matrix.describe()}")
+        except OSError as e:
+            print(f"株価行列の保存に失敗: {e}")
+
+    # 株価由来の指標（出来高急増率・実現ボラティリティ・ATR・高値からの距離）: 当日分を追記した行列から全銘柄を1回で計算
+    feature_keys, feature_values = [], {}
+    if price_matrix.MATRIX_ENABLED:
+        with stage_timer('features'):
+            feature_matrix = price_matrix.PriceMatrix.attach()
+            if feature_matrix is not None:
+                feature_keys, feature_values = price_features.compute(feature_matrix, today_str)
+        print(f"株価由来の指標: {len(feature_keys)}銘柄")
+
+    # 市場データ取得: 保有銘柄 → 新高値更新回数の多い候補の順に、見積りコストが予算内の銘柄だけ取得する。
+    # 期末終値はスキャン済みの株価から一括で as-of 結合し、安価な時価総額・PER を先に、ROE は条件通過銘柄
+    # （保有銘柄は常に）のみ取得する。予算外の銘柄は deferred に記録し、値は埋めない。
+    order = request_budget.priority_order(HOLDING_CODES, all_new_high_stocks)
+    deferred = []
+    print(f"\n市場データ取得: {len(order)}件（予算: {budget.summary()}）")
+    with stage_timer('screen'):
+        period_end_closes = resolve_period_end_closes(order, headers, price_store, budget)
+    roe_headers = {'Authorization': f'Bearer {ID_TOKEN}'} if ID_TOKEN else headers
+
+    market_data_dict, deferred, unresolved = enrich_market_data(order, headers, roe_headers, period_end_closes, budget)
+    pipeline_log.flush()
+    for code in HOLDING_CODES:
+        md = market_data_dict.get(code)
+        if md and not md.get('unresolved'):
+            print(f"  保有銘柄 {code}: 時価総額:{screens.format_market_cap(md.get('market_cap'))}, "
+                  f"PER:{screens.format_per(md.get('per'))}")
+
+    # ステップ2の get_7_metrics は market_data の volume_ratio / volatility を読む
+    if feature_keys:
+        for code, values in price_features.lookup(feature_matrix, feature_keys, feature_values, order).items():
+            market_data_dict.setdefault(code, {}).update(values)
+
+    if deferred:
+        print(f"予算超過のため保留: {len(deferred)}件（step1_results.json の deferred に記録）")
+    if unresolved:
+        print(f"取得失敗（再試行後も未解決）: {len(unresolved)}件（step1_results.json の unresolved に記録）")
+
+    # 打ち切り・保留があれば部分結果として記録する（step2・step3 はこれを見て注記する）
+    scan_status = {
+        'complete': halted is None and not deferred and not unresolved,
+        'reason': halted,
+        'unscanned_count': len(unscanned),
+        'unscanned_codes': unscanned,
+        'deferred_count': len(deferred),
+        'unresolved_count': len(unresolved),
+        'circuit_trips': jquants_http.breaker.trips,
+    }
+    trading_calendar.export_github_output('scan_status', 'complete' if scan_status['complete'] else 'partial')
+    if halted:
+        print(f"⚠ スキャン打ち切り（{halted}）: 未スキャン {len(unscanned)}銘柄。部分結果として保存します")
     
+    # ステップ2の分位点スケッチ用の全銘柄の分布（出来高比率・ボラティリティは株価行列の全銘柄）
+    universe_metrics = {'new_high_count': universe_counts}
+    if feature_keys:
+        universe_metrics.update(price_features.finite(feature_values, ('volume_ratio', 'volatility')))
+
     # 結果をJSONファイルに保存
     results = {
         'scan_date': today_str,
         'new_high_stocks': all_new_high_stocks,
         'holding_stock_info': holding_stock_info,
         'market_data': market_data_dict,
+        'deferred': deferred,
+        'unresolved': unresolved,
+        'budget': budget.summary(),
+        'scan_status': scan_status,
+        'universe_metrics': universe_metrics,
         'token': ID_TOKEN,
         'summary': {
             'total_new_high': len(all_new_high_stocks),
-            'growth_stocks_count': len(growth_stocks)
+            'growth_stocks_count': len(growth_stocks),
+            'deferred_count': len(deferred),
+            'unresolved_count': len(unresolved)
         }
     }
     
@@ -763,8 +1055,18 @@ def main():
     return True
 
 if __name__ == "__main__":
+    if '--profile-imports' in sys.argv:
+        import import_profile
+        sys.exit(0 if import_profile.report('step1_stock_scanner', 'step1') else 1)
     try:
-        success = main()
+        try:
+            success = main()
+        finally:
+            pipeline_log.close()
+            write_report('step1')
+        if success is None:
+            print(f"\n- ステップ1: 休場日のためスキャンを行いませんでした")
+            sys.exit(0)
         if success:
             print(f"\n✓ ステップ1正常完了")
             print(f"次ステップ: python step2_metrics_analysis.py")
@@ -1,8 +1,22 @@
 import json
+import os
+import sys
 import time
-import pandas as pd
 import numpy as np
 
+import pipeline_log
+import quantile_sketch
+import score_history
+import screens
+from instrumentation import stage, stage_timer, write_report
+
+log = pipeline_log.get_logger('step2')
+
+# 正規化の方式: minmax（その日の対象銘柄での Min-Max）/ sketch（分位点スケッチに蓄積した全観測でのパーセンタイル）
+NORMALIZATION = os.environ.get('SCORE_NORMALIZATION', 'minmax')
+# sketch 方式でも、観測数がこれ未満の指標は Min-Max で代替する
+SKETCH_MIN_COUNT = int(os.environ.get('SKETCH_MIN_COUNT', '50'))
+
 
 def calculate_shape_balance_score(scores):
     """正七角形に近い形状ほど高スコア"""
@@ -35,6 +49,7 @@ def calculate_shape_balance_score(scores):
     return shape_balance * balance_penalty
 
 
+@stage()
 def calculate_comprehensive_score(scores):
     """面積スコア × 形状バランススコア"""
     # 7角形面積計算
@@ -61,6 +76,60 @@ def calculate_comprehensive_score(scores):
     return comprehensive_score, area_score, shape_score
 
 
+def impute_and_scale(df_metrics, sketches=None, excluded=None):
+    """欠損補完 + Min-Maxスケーリング（sketches を渡すとスケッチ上のパーセンタイル）
+
+    excluded {列名: 銘柄コードの集合} の銘柄はその列の補完平均・Min-Max の母集団に含めず、
+    母集団の平均で補完する（ステップ1で条件外のため ROE を取得しなかった銘柄など）。
+    df_metrics は補完済みの値で上書きされる。戻り値: (df_scores, scaling_info)
+    """
+    excluded = excluded or {}
+    population = {}
+    # Better imputation strategy:
+    # - If a column is entirely missing (all NaN), fill with neutral 0.5
+    # - Otherwise fill missing values with the column mean
+    for col in df_metrics.columns:
+        col_series = df_metrics[col].astype(float)
+        outside = df_metrics.index.isin(list(excluded.get(col, ())))
+        if outside.all():
+            outside[:] = False
+        col_series[outside] = np.nan
+        population[col] = ~outside
+        if col_series[~outside].isna().all():
+            df_metrics[col] = 0.5
+        else:
+            mean_val = col_series[~outside].mean(skipna=True)
+            df_metrics[col] = col_series.fillna(mean_val)
+
+    df_scores = df_metrics.copy()
+    scaling_info = {}
+
+    for column in df_metrics.columns:
+        col_min = df_metrics.loc[population[column], column].min()
+        col_max = df_metrics.loc[population[column], column].max()
+        sketch = sketches['metrics'].get(column) if sketches else None
+
+        if sketch is not None and sketch.n >= SKETCH_MIN_COUNT:
+            df_scores[column] = sketch.cdf(df_metrics[column].to_numpy(dtype='float64'))
+            scaling_info[column] = {'min': float(col_min), 'max': float(col_max), 'mode': 'sketch',
+                                    'sketch_version': sketches['version'], 'sketch_count': sketch.n,
+                                    'sketch_median': sketch.quantile(0.5)}
+            continue
+
+        if col_max - col_min != 0:
+            df_scores[column] = (df_metrics[column] - col_min) / (col_max - col_min)
+        else:
+            df_scores[column] = 0.5
+
+        scaling_info[column] = {'min': float(col_min), 'max': float(col_max)}
+        if sketches:
+            # スケッチの観測数が足りない指標は Min-Max で代替した
+            scaling_info[column].update(mode='minmax', sketch_version=sketches['version'],
+                                        sketch_count=sketch.n if sketch is not None else 0)
+
+    return df_scores, scaling_info
+
+
 def load_step1_results(path='step1_results.json'):
     """読み込みヘルパー: ステップ1出力をロードする。"""
     try:
@@ -74,6 +143,7 @@ def load_step1_results(path='step1_results.json'):
         return None
 
 
+@stage()
 def get_7_metrics(code, headers=None):
     """ステップ1の出力 (`step1_results.json`) を参照して7指標を返す。
 
@@ -139,6 +209,7 @@ def get_7_metrics(code, headers=None):
 
 def main():
     """ステップ2: 7指標分析・スコア算出・条件フィルタ"""
+    pipeline_log.configure('step2')
 
     # ステップ1結果を読み込み
     step1_results = load_step1_results()
@@ -149,6 +220,15 @@ def main():
     new_high_stocks = step1_results.get('new_high_stocks', [])
     holding_info = step1_results.get('holding_stock_info', [])
     market_data = step1_results.get('market_data', {})
+    # step1 でリクエスト予算超過のため取得を保留した銘柄（値は埋められていない）
+    deferred = {d.get('code'): d for d in step1_results.get('deferred', [])}
+    # step1 で再試行しても取得できなかった銘柄（推定値では埋められていない）
+    unresolved = {u.get('code'): u for u in step1_results.get('unresolved', [])}
+    scan_status = step1_results.get('scan_status') or {'complete': True}
+    if not scan_status.get('complete', True):
+        print(f"⚠ ステップ1は部分結果です（{scan_status.get('reason') or '市場データ取得の保留あり'}、"
+              f"未スキャン{scan_status.get('unscanned_count', 0)}銘柄、保留{scan_status.get('deferred_count', 0)}件、"
+              f"取得失敗{scan_status.get('unresolved_count', 0)}件）")
 
     print(f"\n=== ステップ2: 7指標分析・正規化・スコア算出 ===")
 
@@ -184,12 +264,12 @@ def main():
     for i, stock in enumerate(target_stocks):
         code = stock.get('code')
         name = stock.get('name')
-        print(f"7指標取得中 {i+1}/{len(target_stocks)}: {code} {name}")
+        log.info('metrics.progress', "7指標取得中 {i}/{n}: {code} {name}", i=i + 1, n=len(target_stocks), code=code, name=name)
 
         try:
             metrics = get_7_metrics(code, headers)
         except Exception as e:
-            print(f"get_7_metrics failed for {code}: {e}")
+            log.warning('metrics.error', "get_7_metrics failed for {code}: {error}", code=code, error=e)
             metrics = {}
 
         metrics['new_high_count'] = stock.get('new_high_count', 0)  # 既知の値を使用
@@ -198,81 +278,82 @@ def main():
 
         new_high_mark = " ★65週新高値" if stock.get('is_new_high_today') else ""
         holding_mark = " (保有)" if stock.get('is_holding') else ""
-        print(f"  新高値:{metrics.get('new_high_count',0)}回, 出来高比率:{metrics.get('volume_ratio',0):.2f}{new_high_mark}{holding_mark}")
+        log.info('metrics.values', "  新高値:{new_high_count}回, 出来高比率:{volume_ratio:.2f}{marks}",
+                 code=code, new_high_count=metrics.get('new_high_count', 0), volume_ratio=metrics.get('volume_ratio', 0),
+                 marks=new_high_mark + holding_mark)
 
         time.sleep(0.2)
+    pipeline_log.flush()
 
     # DataFrameに変換してMin-Maxスケーリング
     if not all_metrics:
         print("no metrics collected, aborting")
         return False
 
-    df_metrics = pd.DataFrame(all_metrics).T
-    # Better imputation strategy:
-    # - If a column is entirely missing (all NaN), fill with neutral 0.5
-    # - Otherwise fill missing values with the column mean
-    for col in df_metrics.columns:
-        col_series = df_metrics[col]
-        if col_series.isna().all():
-            df_metrics[col] = 0.5
-        else:
-            mean_val = col_series.mean(skipna=True)
-            df_metrics[col] = col_series.fillna(mean_val)
-    print(f"\n=== Min-Maxスケーリング ===")
-
-    df_scores = df_metrics.copy()
-    scaling_info = {}
-
-    for column in df_metrics.columns:
-        col_min = df_metrics[column].min()
-        col_max = df_metrics[column].max()
-
-        if col_max - col_min != 0:
-            df_scores[column] = (df_metrics[column] - col_min) / (col_max - col_min)
-        else:
-            df_scores[column] = 0.5
-
-        scaling_info[column] = {'min': float(col_min), 'max': float(col_max)}
+    with stage_timer('normalization'):
+        import pandas as pd  # 正規化でだけ使うため、ここで読み込む（起動を速くする）
+        df_metrics = pd.DataFrame(all_metrics).T
+        # 分位点スケッチは方式によらず毎日更新する（新高値更新回数はスキャンした全銘柄、他は当日の対象銘柄）
+        sketches = quantile_sketch.load()
+        observations = {c: df_metrics[c].dropna().astype(float).tolist() for c in df_metrics.columns}
+        universe = step1_results.get('universe_metrics') or {}
+        observations.update({c: v for c, v in universe.items() if v})
+        if quantile_sketch.update(sketches, observations, step1_results.get('scan_date')):
+            quantile_sketch.save(sketches)
+        # 条件外で ROE を取得しなかった銘柄（screened_out）は ROE の母集団から外す（条件適合銘柄のスコアに影響させない）
+        screened_out = {code for code, md in market_data.items() if md.get('screened_out')}
+        df_scores, scaling_info = impute_and_scale(df_metrics, sketches if NORMALIZATION == 'sketch' else None,
+                                                   excluded={'roe': screened_out})
+
+    if NORMALIZATION == 'sketch':
+        print(f"\n=== パーセンタイル正規化（分位点スケッチ version {sketches['version']}） ===")
+    else:
+        print(f"\n=== Min-Maxスケーリング ===")
+    for column, info in scaling_info.items():
         try:
-            print(f"{column:18s}: Min={col_min:8.1f}, Max={col_max:8.1f}")
+            mode = f", パーセンタイル（n={info['sketch_count']}）" if info.get('mode') == 'sketch' else ''
+            print(f"{column:18s}: Min={info['min']:8.1f}, Max={info['max']:8.1f}{mode}")
         except Exception:
-            print(f"{column}: min={col_min}, max={col_max}")
+            print(f"{column}: min={info['min']}, max={info['max']}")
 
     print(f"\n=== 総合スコア計算（面積 × 形状バランス） ===")
 
     # 各銘柄の総合スコア計算
     final_scores = []
 
-    for code in df_scores.index:
-        scores = df_scores.loc[code].tolist()
-        # ensure length 7
-        if len(scores) < 7:
-            scores = (scores + [0] * 7)[:7]
-        comprehensive, area, shape = calculate_comprehensive_score(scores)
-
-        stock_info = next((s for s in target_stocks if s.get('code') == code), None)
-
-        final_scores.append({
-            'code': code,
-            'name': (stock_info.get('name') if stock_info else ''),
-            'scores': scores,
-            'comprehensive_score': float(comprehensive),
-            'area_score': float(area),
-            'shape_score': float(shape),
-            'is_holding': (stock_info.get('is_holding') if stock_info else False),
-            'is_new_high_today': (stock_info.get('is_new_high_today') if stock_info else False)
-        })
+    with stage_timer('scoring'):
+        for code in df_scores.index:
+            scores = df_scores.loc[code].tolist()
+            # ensure length 7
+            if len(scores) < 7:
+                scores = (scores + [0] * 7)[:7]
+            comprehensive, area, shape = calculate_comprehensive_score(scores)
 
-        holding_mark = " (保有)" if stock_info and stock_info.get('is_holding') else ""
-        print(f"{(stock_info.get('name') if stock_info else code)}{holding_mark}:")
-        print(f"  総合スコア: {comprehensive:.4f} (面積: {area:.4f} × 形状: {shape:.4f})")
+            stock_info = next((s for s in target_stocks if s.get('code') == code), None)
+
+            final_scores.append({
+                'code': code,
+                'name': (stock_info.get('name') if stock_info else ''),
+                'scores': scores,
+                'comprehensive_score': float(comprehensive),
+                'area_score': float(area),
+                'shape_score': float(shape),
+                'is_holding': (stock_info.get('is_holding') if stock_info else False),
+                'is_new_high_today': (stock_info.get('is_new_high_today') if stock_info else False)
+            })
+
+            holding_mark = " (保有)" if stock_info and stock_info.get('is_holding') else ""
+            log.info('score.stock', "{name}{mark}:\n  総合スコア: {score:.4f} (面積: {area:.4f} × 形状: {shape:.4f})",
+                     code=code, name=(stock_info.get('name') if stock_info else code), mark=holding_mark,
+                     score=float(comprehensive), area=float(area), shape=float(shape))
 
     # 総合スコアでソート
     final_scores.sort(key=lambda x: x['comprehensive_score'], reverse=True)
 
     # ===== 条件フィルタ適用 =====
+    pipeline_log.flush()
     print(f"\n=== 時価総額・PER条件フィルタ適用 ===")
-    print("条件: 時価総額200億円以下 AND PER10倍以上（保有銘柄は除外対象外）")
+    print(f"条件: {screens.describe()}（保有銘柄は除外対象外）")
 
     qualified_stocks = []
     excluded_stocks = []
@@ -290,7 +371,7 @@ def main():
         market_cap_jpy = md.get('market_cap_jpy')
         eps = md.get('eps') or md.get('EarningsPerShare')
 
-        meets_condition = (market_cap is not None and per is not None and market_cap <= 200 and per >= 10)
+        meets_condition = screens.passes(market_cap, per)
         if is_holding or meets_condition:
             stock['market_cap'] = market_cap
             stock['per'] = per
@@ -307,20 +388,18 @@ def main():
             qualified_stocks.append(stock)
 
             status = "(保有)" if is_holding else "条件クリア"
-            try:
-                print(f"✓ {stock['name']}: 時価総額{(market_cap if market_cap is not None else 0):.0f}億円, PER{(per if per is not None else 0):.1f}倍 - {status}")
-            except Exception:
-                print(f"✓ {stock.get('name')}: 時価総額{market_cap}億円, PER{per}倍 - {status}")
+            log.info('filter.qualified', "✓ {name}: 時価総額{market_cap_text}, PER{per_text} - {status}",
+                     code=code, name=stock.get('name'), market_cap=market_cap, per=per,
+                     market_cap_text=screens.format_market_cap(market_cap), per_text=screens.format_per(per),
+                     status=status)
         else:
             # 除外理由
-            reasons = []
-            try:
-                if market_cap is not None and market_cap > 200:
-                    reasons.append(f"時価総額{market_cap:.0f}億円>200億円")
-            except Exception:
-                pass
-            if per is None or per < 10:
-                reasons.append(f"PER{(per if per is not None else 'N/A')}倍<10倍")
+            if code in deferred and deferred[code].get('stage') == 'valuation':
+                reasons = [f"市場データ未取得（保留: {deferred[code].get('reason')}）"]
+            elif code in unresolved and unresolved[code].get('stage') == 'valuation':
+                reasons = [f"市場データ未解決（取得失敗: {unresolved[code].get('error')}）"]
+            else:
+                reasons = screens.failure_reasons(market_cap, per)
 
             ex_entry = {
                 'code': code,
@@ -334,7 +413,7 @@ def main():
             if latest_close is not None:
                 ex_entry['latest_close'] = latest_close
             excluded_stocks.append(ex_entry)
-            print(f"✗ {stock['name']}: {', '.join(reasons)}")
+            log.info('filter.excluded', "✗ {name}: {reason}", code=code, name=stock['name'], reason=ex_entry['reason'])
 
     # 条件適合銘柄を総合スコア順にソート
     qualified_stocks.sort(key=lambda x: x['comprehensive_score'], reverse=True)
@@ -343,6 +422,7 @@ def main():
     non_holding_top3 = [s for s in qualified_stocks if not s['is_holding']][:3]
     holding_stocks = [s for s in qualified_stocks if s['is_holding']]
 
+    pipeline_log.flush()
     print(f"\n=== 最終選定結果 ===")
     print("投資推奨上位3銘柄:")
     for i, stock in enumerate(non_holding_top3):
@@ -354,7 +434,7 @@ def main():
             extra.append(f"発行済株式数:{stock['issued_shares']:,}株")
         if 'latest_close' in stock:
             extra.append(f"最新終値:{stock['latest_close']:.0f}円")
-        print(f"   時価総額: {stock.get('market_cap',0):.0f}億円, PER: {stock.get('per',0):.1f}倍{new_high_mark}")
+        print(f"   時価総額: {screens.format_market_cap(stock.get('market_cap'))}, PER: {screens.format_per(stock.get('per'))}{new_high_mark}")
         if extra:
             print(f"   ({'; '.join(extra)})")
 
@@ -364,7 +444,7 @@ def main():
         ranking = (ranking + 1) if ranking is not None else 'N/A'
         print(f"{ranking}位. {stock['code']} {stock['name']}")
         print(f"   総合スコア: {stock['comprehensive_score']:.4f}")
-        print(f"   時価総額: {stock.get('market_cap',0):.0f}億円, PER: {stock.get('per',0):.1f}倍")
+        print(f"   時価総額: {screens.format_market_cap(stock.get('market_cap'))}, PER: {screens.format_per(stock.get('per'))}")
         if 'issued_shares' in stock or 'latest_close' in stock:
             parts = []
             if 'issued_shares' in stock:
@@ -383,6 +463,7 @@ def main():
         'metrics_data': all_metrics,
         'scaling_info': scaling_info,
         'token': step1_results.get('token'),
+        'scan_status': scan_status,
         'summary': {
             'total_analyzed': len(target_stocks),
             'qualified_count': len(qualified_stocks),
@@ -391,8 +472,20 @@ def main():
     }
 
     out_file = globals().get('OUTPUT_FILE', 'step2_results.json')
-    with open(out_file, 'w', encoding='utf-8') as f:
+    # 一時ファイルに書いてから置き換える（ranking_service などの読み手が書き込み途中のファイルを読まないように）
+    tmp_file = f"{out_file}.{os.getpid()}.tmp"
+    with open(tmp_file, 'w', encoding='utf-8') as f:
         json.dump(results, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_file, out_file)
+
+    # スコア表を日付パーティションの履歴に追記する（ステップ3の推移表示・過去の問い合わせ用）
+    if step1_results.get('scan_date'):
+        try:
+            with stage_timer('score_history'):
+                score_history.record_step2(step1_results['scan_date'], final_scores, qualified_stocks,
+                                           excluded_stocks, non_holding_top3)
+        except (OSError, ValueError) as e:
+            print(f"スコア履歴の保存に失敗: {e}")
 
     print(f"\n=== ステップ2完了 ===")
     print(f"条件適合銘柄: {len(qualified_stocks)}件")
@@ -403,7 +496,14 @@ def main():
 
 
 if __name__ == "__main__":
-    success = main()
+    if '--profile-imports' in sys.argv:
+        import import_profile
+        sys.exit(0 if import_profile.report('step2_metrics_analysis', 'step2') else 1)
+    try:
+        success = main()
+    finally:
+        pipeline_log.close()
+        write_report('step2')
     if success:
         print(f"\n✓ ステップ2正常完了")
         print(f"次ステップ: python step3_chart_creation.py")
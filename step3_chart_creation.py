@@ -1,26 +1,45 @@
 # 新高値ブレイク法システム - ステップ3: データ読み込み対応版チャート作成
 
-import matplotlib.pyplot as plt
 import numpy as np
-import pandas as pd
-import requests
 from datetime import datetime, timedelta
-import time
 import json
 import os
+import sys
 import base64
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.application import MIMEApplication
-from google.oauth2.credentials import Credentials
-from googleapiclient.discovery import build
-import glob
 
-INPUT_FILE = "step2_results.json"
+import jquants_http
+from jquants_http import API_BASE
+from chart_cache import ChartCache, chart_key, digest_arrays
+from instrumentation import stage, write_report
+import score_history
+import screens
+from quotes_decoder import concat_quotes, ordinals_to_datetime64
 
-# Enable Japanese font support for matplotlib
-import matplotlib
-import japanize_matplotlib  # This automatically configures Japanese fonts
+INPUT_FILE = "step2_results.json"
+# メール本文に表示するスコア推移の期間（暦日）
+SCORE_TREND_DAYS = int(os.environ.get('SCORE_TREND_DAYS', '90'))
+# SCAN_DATE=YYYYMMDD で基準日を固定できる（カセット再生・再現用）
+SCAN_DATE = os.environ.get('SCAN_DATE')
+
+# matplotlib・日本語フォント・pandas・Google API クライアントは重いため、初めて使う時に読み込む
+# （チャートが全てキャッシュ済み・Gmail 未設定の実行では読み込まない）
+_plotting = None
+
+
+def plotting():
+    """(plt, mdates) を返す。初回に Agg バックエンドと日本語フォント（japanize_matplotlib）を設定する"""
+    global _plotting
+    if _plotting is None:
+        import matplotlib
+        matplotlib.use('Agg')
+        import matplotlib.dates as mdates
+        import matplotlib.pyplot as plt
+        import japanize_matplotlib  # noqa: F401  This automatically configures Japanese fonts
+        _plotting = (plt, mdates)
+    return _plotting
 
 # 統一指標配置順序（全レーダーチャートで統一）
 METRICS_ORDER = [
@@ -29,6 +48,18 @@ METRICS_ORDER = [
     "自己資本比率", "フリーキャッシュフロー"
 ]
 
+# 描画プロファイル（描画コードを変更したら version を上げてキャッシュを無効化する）
+RADAR_RENDER_PROFILE = {'version': 1, 'figsize': (14, 12), 'dpi': 300}
+# days: 表示期間（PRICE_CHART_DAYS で5〜10年に拡張可）
+# max_points: 描画点数の上限（None の場合は軸のピクセル幅）
+PRICE_RENDER_PROFILE = {
+    'version': 2,
+    'figsize': (15, 10),
+    'dpi': 300,
+    'days': int(os.environ.get('PRICE_CHART_DAYS', '730')),
+    'max_points': int(os.environ['PRICE_CHART_MAX_POINTS']) if os.environ.get('PRICE_CHART_MAX_POINTS') else None,
+}
+
 def load_step2_results():
     """ステップ2の結果を読み込み"""
     try:
@@ -52,11 +83,15 @@ def load_step2_results():
 # summary including charts and the numeric metrics used for scoring, and send that via
 # Gmail API (or save to a local file when Gmail credentials are not available).
 
+@stage()
 def create_and_send_email(subject, body_text, to_email, attachment_paths, token_json_str):
     """Gmail APIでメール送信"""
     try:
+        from google.oauth2.credentials import Credentials
+        from googleapiclient.discovery import build
         creds = Credentials.from_authorized_user_info(json.loads(token_json_str), scopes=['https://www.googleapis.com/auth/gmail.send'])
-        service = build('gmail', 'v1', credentials=creds)
+        # パッケージ同梱の discovery document を使う（送信のたびに取得しない）
+        service = build('gmail', 'v1', credentials=creds, static_discovery=True, cache_discovery=False)
 
         message = MIMEMultipart()
         message['to'] = to_email
@@ -82,10 +117,30 @@ def create_and_send_email(subject, body_text, to_email, attachment_paths, token_
         print(f"✗ メール送信エラー: {e}")
         return False
 
-def create_radar_chart(stocks_data, chart_title, filename):
-    """レーダーチャート作成（統一指標順序・日本語フォント対応）"""
+@stage()
+def create_radar_chart(stocks_data, chart_title, filename, cache=None):
+    """レーダーチャート作成（統一指標順序・日本語フォント対応）
+
+    入力（スコア・銘柄名・保有区分・タイトル）が前回と同一ならキャッシュ済みPNGを再利用する。
+    戻り値: 出力ファイル名
+    """
+    key = None
+    if cache is not None:
+        key = chart_key('radar', {
+            'title': chart_title,
+            'metrics': METRICS_ORDER,
+            'stocks': [
+                [s.get('code'), s.get('name'), s.get('scores'), bool(s.get('is_holding', False))]
+                for s in stocks_data
+            ],
+        }, RADAR_RENDER_PROFILE)
+        if cache.fetch(key, filename):
+            print(f"✓ レーダーチャート（キャッシュ再利用）: {filename}")
+            return filename
+
     # レーダーチャート設定
-    fig, ax = plt.subplots(figsize=(14, 12), subplot_kw=dict(projection='polar'))
+    plt, _ = plotting()
+    fig, ax = plt.subplots(figsize=RADAR_RENDER_PROFILE['figsize'], subplot_kw=dict(projection='polar'))
 
     # 角度設定（7角形）
     angles = [i * 2 * np.pi / 7 for i in range(7)]
@@ -138,97 +193,194 @@ def create_radar_chart(stocks_data, chart_title, filename):
     ax.set_yticklabels(['0.2', '0.4', '0.6', '0.8', '1.0'], fontsize=10)
     
     plt.tight_layout()
-    plt.savefig(filename, dpi=300, bbox_inches='tight', facecolor='white')
+    plt.savefig(filename, dpi=RADAR_RENDER_PROFILE['dpi'], bbox_inches='tight', facecolor='white')
     plt.close()  # Remove plt.show() to avoid blocking
+    if cache is not None:
+        cache.store(key, filename)
     
     print(f"✓ レーダーチャート作成完了: {filename}")
+    return filename
 
-def create_stock_price_chart(code, stock_name, headers):
-    """株価チャート作成（過去2年間日足）"""
+def lttb_indices(x, y, n_out, keep=None):
+    """Largest-Triangle-Three-Buckets: 視覚的に重要な n_out 点のインデックスを返す。
+
+    keep に渡したインデックス（新高値更新日など）は必ず結果に含める。
+    """
+    n = len(y)
+    if n_out >= n or n_out < 3:
+        idx = np.arange(n)
+    else:
+        x = np.asarray(x, dtype='float64')
+        y = np.asarray(y, dtype='float64')
+        # 欠損値は直前の値で埋めて面積計算を安定させる
+        if np.isnan(y).any():
+            import pandas as pd
+            y = pd.Series(y).ffill().bfill().fillna(0.0).to_numpy()
+        edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+        idx = np.empty(n_out, dtype=int)
+        idx[0] = 0
+        idx[-1] = n - 1
+        a = 0
+        for i in range(n_out - 2):
+            lo, hi = edges[i], edges[i + 1]
+            nxt_lo, nxt_hi = edges[i + 1], (edges[i + 2] if i + 2 < len(edges) else n)
+            avg_x = x[nxt_lo:nxt_hi].mean() if nxt_hi > nxt_lo else x[n - 1]
+            avg_y = y[nxt_lo:nxt_hi].mean() if nxt_hi > nxt_lo else y[n - 1]
+            areas = np.abs((x[a] - avg_x) * (y[lo:hi] - y[a]) - (x[a] - x[lo:hi]) * (avg_y - y[a]))
+            a = lo + int(np.argmax(areas)) if hi > lo else lo
+            idx[i + 1] = a
+    if keep is not None and len(keep):
+        idx = np.union1d(idx, np.asarray(keep, dtype=int))
+    return idx
+
+
+def minmax_decimate(x, low, high, n_buckets):
+    """区間ごとの最小Low・最大Highで値幅帯を間引く（外形は保持される）。"""
+    n = len(x)
+    if n_buckets >= n:
+        return np.asarray(x), np.asarray(low), np.asarray(high)
+    starts = np.linspace(0, n, n_buckets, endpoint=False).astype(int)
+    return (np.asarray(x)[starts],
+            np.fmin.reduceat(np.asarray(low, dtype='float64'), starts),
+            np.fmax.reduceat(np.asarray(high, dtype='float64'), starts))
+
+
+def new_high_indices(high):
+    """ウィンドウ内で高値を更新した日のインデックス（step1 の更新回数と同じ定義）"""
+    high = np.nan_to_num(np.asarray(high, dtype='float64'), nan=-np.inf)
+    prev_max = np.maximum.accumulate(np.concatenate(([0.0], high[:-1])))
+    return np.flatnonzero(high > prev_max)
+
+
+def stock_chart_filename(code, stock_name):
+    """株価チャートの出力ファイル名"""
+    return f'stock_chart_{code}_{stock_name.replace(" ", "_").replace("（", "_").replace("）", "")}.png'
+
+@stage()
+def create_stock_price_chart(code, stock_name, headers, cache=None):
+    """株価チャート作成（過去2年間日足。PRICE_CHART_DAYS で期間変更可）
+
+    価格データは毎回取得するが、系列・銘柄名が前回と同一なら描画を省略してキャッシュを再利用する。
+    """
     
     # 2年間の期間設定
     #end_date = datetime(2025, 9, 26)  # 実運用時は datetime.now()
-    end_date = datetime.now()
-    start_date = end_date - timedelta(days=730)
+    end_date = datetime.strptime(SCAN_DATE, '%Y%m%d') if SCAN_DATE else datetime.now()
+    start_date = end_date - timedelta(days=PRICE_RENDER_PROFILE['days'])
     end_date_str = end_date.strftime('%Y%m%d')
     start_date_str = start_date.strftime('%Y%m%d')
     
     print(f"株価データ取得中: {stock_name}({code}) 期間:{start_date_str}～{end_date_str}")
     
     # 株価データ取得
-    url = f"https://api.jquants.com/v1/prices/daily_quotes"
     params = {'code': code, 'from': start_date_str, 'to': end_date_str}
     
     try:
-        response = requests.get(url, params=params, headers=headers)
-        if response.status_code == 200:
-            data = response.json()
-            if 'daily_quotes' in data and data['daily_quotes']:
-                df = pd.DataFrame(data['daily_quotes'])
-                df['Date'] = pd.to_datetime(df['Date'])
-                df['High'] = pd.to_numeric(df['High'], errors='coerce')
-                df['Low'] = pd.to_numeric(df['Low'], errors='coerce')
-                df['Close'] = pd.to_numeric(df['Close'], errors='coerce')
-                df['Volume'] = pd.to_numeric(df['Volume'], errors='coerce')
-                df = df.sort_values('Date')
-                
-                print(f"  データ取得成功: {len(df)}日分")
-                
-                # japanize_matplotlib が自動で日本語フォントを設定
-                
-                # 株価チャート作成
-                fig, (ax1, ax2) = plt.subplots(2, 1, figsize=(15, 10), 
-                                             gridspec_kw={'height_ratios': [3, 1]})
-                
-                # 株価チャート（上部）- 高値を強調
-                ax1.plot(df['Date'], df['High'], linewidth=2, color='red', alpha=0.8, label='High', zorder=3)
-                ax1.plot(df['Date'], df['Close'], linewidth=1.5, color='blue', alpha=0.7, label='Close')
-                ax1.fill_between(df['Date'], df['Low'], df['High'], alpha=0.1, color='gray', label='Daily Range')
-                
-                ax1.set_title(f"{stock_name}({code}) Stock Price - Past 2 Years", 
-                             fontsize=16, fontweight='bold', pad=20)
-                ax1.set_ylabel('Price (JPY)', fontsize=14, fontweight='bold')
-                ax1.legend(fontsize=12)
-                ax1.grid(True, alpha=0.3)
-                
-                # 新高値ポイントをマーク
-                latest_high = df['High'].iloc[-1]
-                latest_date = df['Date'].iloc[-1]
-                ax1.scatter([latest_date], [latest_high], color='red', s=150, zorder=5, 
-                           marker='*', edgecolors='darkred', linewidth=2)
-                ax1.annotate(f'65W New High\\n{latest_high:.0f} JPY', 
-                           xy=(latest_date, latest_high), xytext=(20, 20),
-                           textcoords='offset points', fontsize=12, fontweight='bold',
-                           bbox=dict(boxstyle='round,pad=0.5', facecolor='red', alpha=0.8, edgecolor='darkred'),
-                           arrowprops=dict(arrowstyle='->', connectionstyle='arc3,rad=0', color='darkred', lw=2))
-                
-                # 価格統計表示
-                price_high = df['High'].max()
-                price_low = df['Low'].min()
-                price_range = ((price_high - price_low) / price_low * 100)
-                
-                ax1.text(0.02, 0.98, f'2Y High: {price_high:.0f}\\n2Y Low: {price_low:.0f}\\nRange: {price_range:.1f}%', 
-                        transform=ax1.transAxes, fontsize=11, verticalalignment='top',
-                        bbox=dict(boxstyle='round', facecolor='wheat', alpha=0.8))
-                
-                # 出来高チャート（下部）
-                ax2.bar(df['Date'], df['Volume'], width=0.8, alpha=0.6, color='orange', label='Volume')
-                ax2.set_ylabel('Volume', fontsize=14, fontweight='bold')
-                ax2.set_xlabel('Date', fontsize=14, fontweight='bold')
-                ax2.legend(fontsize=12)
-                ax2.grid(True, alpha=0.3)
-                
-                # 出来高移動平均線
-                df['Volume_MA20'] = df['Volume'].rolling(20).mean()
-                ax2.plot(df['Date'], df['Volume_MA20'], color='red', linewidth=2, alpha=0.7, label='20MA')
-                
-                plt.tight_layout()
-                filename = f'stock_chart_{code}_{stock_name.replace(" ", "_").replace("（", "_").replace("）", "")}.png'
-                plt.savefig(filename, dpi=300, bbox_inches='tight', facecolor='white')
-                plt.show()
-                plt.close()
-                
-                return True, df
+        # 必要な列だけを配列で取り出し、ページを結合してから DataFrame 化する
+        quotes = concat_quotes(jquants_http.iter_quote_pages(params, headers, fields=('High', 'Low', 'Close', 'Volume')))
+        if quotes is not None:
+            import pandas as pd
+            df = pd.DataFrame({
+                'Date': ordinals_to_datetime64(quotes['date']),
+                'High': quotes['High'],
+                'Low': quotes['Low'],
+                'Close': quotes['Close'],
+                'Volume': quotes['Volume'],
+            })
+            
+            print(f"  データ取得成功: {len(df)}日分")
+
+            filename = stock_chart_filename(code, stock_name)
+            key = None
+            if cache is not None:
+                key = chart_key('price', {
+                    'code': code,
+                    'name': stock_name,
+                    'series': digest_arrays(
+                        df['Date'].values.astype('datetime64[D]'),
+                        df[['High', 'Low', 'Close', 'Volume']].to_numpy(dtype='float64'),
+                    ),
+                }, PRICE_RENDER_PROFILE)
+                if cache.fetch(key, filename):
+                    print(f"  ✓ 株価チャート（キャッシュ再利用）: {filename}")
+                    return True, df
+            
+            # japanize_matplotlib が自動で日本語フォントを設定
+            plt, mdates = plotting()
+
+            # 株価チャート作成
+            fig, (ax1, ax2) = plt.subplots(2, 1, figsize=PRICE_RENDER_PROFILE['figsize'], 
+                                         gridspec_kw={'height_ratios': [3, 1]})
+            
+            # 描画点数の上限: 軸のピクセル幅（保存dpi換算）を超える点は見えないので間引く
+            dpi = PRICE_RENDER_PROFILE['dpi']
+            max_points = PRICE_RENDER_PROFILE['max_points'] or int(ax1.get_window_extent().width * dpi / fig.dpi)
+            x = mdates.date2num(df['Date'].to_numpy())
+            high = df['High'].to_numpy(dtype='float64')
+            low = df['Low'].to_numpy(dtype='float64')
+            close = df['Close'].to_numpy(dtype='float64')
+            volume = df['Volume'].to_numpy(dtype='float64')
+
+            # 株価チャート（上部）- 高値を強調（新高値更新点はLTTBでも必ず残す）
+            hi_idx = lttb_indices(x, high, max_points, keep=new_high_indices(high))
+            cl_idx = lttb_indices(x, close, max_points)
+            ax1.plot(x[hi_idx], high[hi_idx], linewidth=2, color='red', alpha=0.8, label='High', zorder=3)
+            ax1.plot(x[cl_idx], close[cl_idx], linewidth=1.5, color='blue', alpha=0.7, label='Close')
+            band_x, band_low, band_high = minmax_decimate(x, low, high, max_points)
+            ax1.fill_between(band_x, band_low, band_high, alpha=0.1, color='gray', label='Daily Range')
+            ax1.xaxis_date()
+
+            years = PRICE_RENDER_PROFILE['days'] / 365
+            ax1.set_title(f"{stock_name}({code}) Stock Price - Past {years:.0f} Years", 
+                         fontsize=16, fontweight='bold', pad=20)
+            ax1.set_ylabel('Price (JPY)', fontsize=14, fontweight='bold')
+            ax1.legend(fontsize=12)
+            ax1.grid(True, alpha=0.3)
+            
+            # 新高値ポイントをマーク
+            latest_high = df['High'].iloc[-1]
+            latest_date = x[-1]
+            ax1.scatter([latest_date], [latest_high], color='red', s=150, zorder=5, 
+                       marker='*', edgecolors='darkred', linewidth=2)
+            ax1.annotate(f'65W New High\\n{latest_high:.0f} JPY', 
+                       xy=(latest_date, latest_high), xytext=(20, 20),
+                       textcoords='offset points', fontsize=12, fontweight='bold',
+                       bbox=dict(boxstyle='round,pad=0.5', facecolor='red', alpha=0.8, edgecolor='darkred'),
+                       arrowprops=dict(arrowstyle='->', connectionstyle='arc3,rad=0', color='darkred', lw=2))
+            
+            # 価格統計表示
+            price_high = df['High'].max()
+            price_low = df['Low'].min()
+            price_range = ((price_high - price_low) / price_low * 100)
+            
+            ax1.text(0.02, 0.98, f'{years:.0f}Y High: {price_high:.0f}\\n{years:.0f}Y Low: {price_low:.0f}\\nRange: {price_range:.1f}%', 
+                    transform=ax1.transAxes, fontsize=11, verticalalignment='top',
+                    bbox=dict(boxstyle='round', facecolor='wheat', alpha=0.8))
+            
+            # 出来高チャート（下部）: 棒1本ごとのRectangleではなく単一のLineCollectionで描画
+            vol_x, _, vol_max = minmax_decimate(x, volume, volume, max_points)
+            bar_px = ax2.get_window_extent().width / max(len(vol_x), 1)
+            ax2.vlines(vol_x, 0, np.nan_to_num(vol_max), colors='orange', alpha=0.6,
+                       linewidth=max(bar_px * 0.8 * 72 / fig.dpi, 0.3), label='Volume')
+            ax2.xaxis_date()
+            ax2.set_ylabel('Volume', fontsize=14, fontweight='bold')
+            ax2.set_xlabel('Date', fontsize=14, fontweight='bold')
+            ax2.legend(fontsize=12)
+            ax2.grid(True, alpha=0.3)
+            
+            # 出来高移動平均線
+            df['Volume_MA20'] = df['Volume'].rolling(20).mean()
+            ma20 = df['Volume_MA20'].to_numpy(dtype='float64')
+            ma_idx = lttb_indices(x, ma20, max_points)
+            ax2.plot(x[ma_idx], ma20[ma_idx], color='red', linewidth=2, alpha=0.7, label='20MA')
+            
+            plt.tight_layout()
+            plt.savefig(filename, dpi=PRICE_RENDER_PROFILE['dpi'], bbox_inches='tight', facecolor='white')
+            plt.close()
+            if cache is not None:
+                cache.store(key, filename)
+            
+            return True, df
         
         return False, None
     except Exception as e:
@@ -247,14 +399,12 @@ def main():
     # 取引所上の銘柄コード->会社名マッピングを取得（あれば表示に使う）
     def fetch_company_names(headers):
         try:
-            url = 'https://api.jquants.com/v1/listed/info'
-            resp = requests.get(url, headers=headers, timeout=15)
+            url = f'{API_BASE}/listed/info'
+            resp = jquants_http.get(url, headers=headers, timeout=15)
             if resp.status_code == 200:
                 info = resp.json().get('info', [])
-                df = pd.DataFrame(info)
-                if 'Code' in df.columns and 'CompanyName' in df.columns:
-                    mapping = dict(zip(df['Code'].astype(str).str.zfill(4), df['CompanyName']))
-                    return mapping
+                return {str(r['Code']).zfill(4): r['CompanyName'] for r in info
+                        if r.get('Code') is not None and 'CompanyName' in r}
         except Exception as e:
             print(f"警告: 上場会社情報取得失敗: {e}")
         return {}
@@ -279,6 +429,10 @@ def main():
     
     print(f"\\n=== ステップ3: チャート作成開始 ===")
     
+    # 今回の実行で作成（またはキャッシュから復元）したファイルのみを添付する
+    produced_files = []
+    chart_cache = ChartCache()
+
     # ===== レーダーチャート4枚作成 =====
     print(f"\\n【レーダーチャート作成】")
     
@@ -291,37 +445,41 @@ def main():
     # チャート1: 1位 + 保有2銘柄
     if len(top3_stocks) > 0:
         chart1_stocks = [top3_stocks[0]] + holding_stocks
-        create_radar_chart(
+        produced_files.append(create_radar_chart(
             chart1_stocks,
             f"保有銘柄 vs {top3_stocks[0]['name']} (1位)",
-            "radar_chart_1_top1_vs_holdings.png"
-        )
+            "radar_chart_1_top1_vs_holdings.png",
+            cache=chart_cache,
+        ))
     
     # チャート2: 2位 + 保有2銘柄  
     if len(top3_stocks) > 1:
         chart2_stocks = [top3_stocks[1]] + holding_stocks
-        create_radar_chart(
+        produced_files.append(create_radar_chart(
             chart2_stocks,
             f"保有銘柄 vs {top3_stocks[1]['name']} (2位)", 
-            "radar_chart_2_top2_vs_holdings.png"
-        )
+            "radar_chart_2_top2_vs_holdings.png",
+            cache=chart_cache,
+        ))
     
     # チャート3: 3位 + 保有2銘柄
     if len(top3_stocks) > 2:
         chart3_stocks = [top3_stocks[2]] + holding_stocks
-        create_radar_chart(
+        produced_files.append(create_radar_chart(
             chart3_stocks,
             f"保有銘柄 vs {top3_stocks[2]['name']} (3位)",
-            "radar_chart_3_top3_vs_holdings.png"
-        )
+            "radar_chart_3_top3_vs_holdings.png",
+            cache=chart_cache,
+        ))
     
     # チャート4: 上位3銘柄総合比較
     if len(top3_stocks) >= 3:
-        create_radar_chart(
+        produced_files.append(create_radar_chart(
             top3_stocks,
             "投資推奨上位3銘柄 比較分析（総合スコア順）",
-            "radar_chart_4_top3_comparison.png"
-        )
+            "radar_chart_4_top3_comparison.png",
+            cache=chart_cache,
+        ))
     
     print("✓ レーダーチャート4枚作成完了")
     
@@ -337,9 +495,10 @@ def main():
         
         print(f"\\n株価チャート作成 {i+1}/3: {name}({code})")
         
-        success, price_df = create_stock_price_chart(code, name, headers)
+        success, price_df = create_stock_price_chart(code, name, headers, cache=chart_cache)
         
         if success:
+            produced_files.append(stock_chart_filename(code, name))
             chart_data.append({
                 'code': code,
                 'name': name,
@@ -352,7 +511,7 @@ def main():
         else:
             print(f"  ✗ {name}のチャート作成失敗")
         
-        time.sleep(0.5)  # API制限対策
+        jquants_http.throttle(0.5)  # API制限対策
     
     print("\\n✓ 株価チャート3枚作成完了")
     
@@ -363,9 +522,21 @@ def main():
     to_address = os.environ.get('TO_EMAIL')
 
     # 件名
-    subject = f"日次新高値ブレイク法分析レポート ({datetime.now().strftime('%Y-%m-%d')})"
+    report_date = datetime.strptime(SCAN_DATE, '%Y%m%d') if SCAN_DATE else datetime.now()
+    subject = f"日次新高値ブレイク法分析レポート ({report_date.strftime('%Y-%m-%d')})"
 
     # 本文組み立て: 上位3・保有銘柄・チャート要約・指標の数値
+    # スコア履歴（score_history）の推移: 直近 SCORE_TREND_DAYS 日の総合スコアと今四半期の上位3入り日数
+    history = score_history.ScoreHistory()
+
+    def trend_line(code):
+        dates, values = history.trajectory(code, SCORE_TREND_DAYS)
+        if len(dates) < 2:
+            return None
+        top3_days = history.days_with(code, score_history.TOP3, since=score_history.quarter_start(dates[-1]))
+        return (f"   スコア推移（{len(dates)}日）: {score_history.sparkline(values)} "
+                f"{values[0]:.3f}→{values[-1]:.3f}, 今四半期の上位3入り {top3_days}日")
+
     lines = []
     lines.append(subject)
     lines.append("\n=== 投資推奨上位3銘柄 ===\n")
@@ -375,7 +546,10 @@ def main():
         lines.append(f"{i+1}. {code} {display_name}")
         lines.append(f"   総合スコア: {stock.get('comprehensive_score', 0):.4f}")
         lines.append(f"   面積スコア: {stock.get('area_score', 0):.4f}, 形状スコア: {stock.get('shape_score', 0):.4f}")
-        lines.append(f"   時価総額(億円): {stock.get('market_cap', 'N/A')}, PER: {stock.get('per', 'N/A')}")
+        lines.append(f"   時価総額: {screens.format_market_cap(stock.get('market_cap'))}, PER: {screens.format_per(stock.get('per'))}")
+        trend = trend_line(stock.get('code'))
+        if trend:
+            lines.append(trend)
         # raw fields if present
         if 'issued_shares' in stock or 'latest_close' in stock or 'eps' in stock or 'market_cap_jpy' in stock:
             extra = []
@@ -395,6 +569,9 @@ def main():
         code = str(h.get('code','')).zfill(4)
         display_name = h.get('name') or code_to_name.get(code) or code
         lines.append(f"- {code} {display_name}  総合スコア:{h.get('comprehensive_score',0):.4f}")
+        trend = trend_line(h.get('code'))
+        if trend:
+            lines.append(trend)
 
     lines.append("\n=== 株価チャート要約 ===\n")
     if chart_data:
@@ -404,11 +581,16 @@ def main():
         lines.append("(株価チャートデータはありません)")
 
     lines.append("\n=== 補足 ===")
+    scan_status = step2_results.get('scan_status') or {}
+    if scan_status and not scan_status.get('complete', True):
+        lines.append(f"※ 本日のスキャンは部分結果です（{scan_status.get('reason') or '市場データ取得の保留あり'}: "
+                     f"未スキャン{scan_status.get('unscanned_count', 0)}銘柄, 市場データ保留{scan_status.get('deferred_count', 0)}件, "
+                     f"取得失敗{scan_status.get('unresolved_count', 0)}件）。")
     lines.append("このメールにはレーダーチャートと株価チャートのPNGファイルを添付しています。LLMによる文章生成は行っていません。")
 
     body_text = "\n".join(lines)
 
-    attachments = glob.glob('*.png')
+    attachments = [p for p in produced_files if p]
 
     if token_secret and to_address:
         print(f"{len(attachments)}個のファイルを添付して、{to_address}にメールを送信します...")
@@ -429,15 +611,14 @@ def main():
     print(f"\\n=== ステップ3完了 ===")
     print("生成ファイル:")
     print("【レーダーチャート】")
-    print("  - radar_chart_1_top1_vs_holdings.png")
-    print("  - radar_chart_2_top2_vs_holdings.png")
-    print("  - radar_chart_3_top3_vs_holdings.png")
-    print("  - radar_chart_4_top3_comparison.png")
+    for filename in produced_files:
+        if filename and filename.startswith('radar_chart_'):
+            print(f"  - {filename}")
     
     print("【株価チャート】")
     if chart_data:
         for data in chart_data:
-            filename = f"stock_chart_{data['code']}_{data['name'].replace(' ', '_').replace('（', '_').replace('）', '')}.png"
+            filename = stock_chart_filename(data['code'], data['name'])
             print(f"  - {filename}")
             print(f"    2年間高値: {data['period_high']:.0f}円, 安値: {data['period_low']:.0f}円")
     
@@ -445,14 +626,23 @@ def main():
     for i, stock in enumerate(top3_stocks[:3]):
         new_high_mark = " ★65週新高値" if stock.get('is_new_high_today', False) else ""
         print(f"{i+1}. {stock['name']}（{stock['code']})：総合スコア {stock['comprehensive_score']:.4f}{new_high_mark}")
-        print(f"   時価総額: {stock.get('market_cap', 0):.0f}億円, PER: {stock.get('per', 0):.1f}倍")
+        print(f"   時価総額: {screens.format_market_cap(stock.get('market_cap'))}, PER: {screens.format_per(stock.get('per'))}")
     
+    evicted = chart_cache.evict()
+    print(f"\\nチャートキャッシュ: ヒット{chart_cache.hits}件, ミス{chart_cache.misses}件, 削除{evicted}件")
+
     print(f"\\n🎉 新高値ブレイク法による銘柄選定・チャート作成・LLM考察・メール送信完了！")
     
     return True
 
 if __name__ == "__main__":
-    success = main()
+    if '--profile-imports' in sys.argv:
+        import import_profile
+        sys.exit(0 if import_profile.report('step3_chart_creation', 'step3') else 1)
+    try:
+        success = main()
+    finally:
+        write_report('step3')
     if success:
         print(f"\\n✓ ステップ3正常完了")
         print(f"全ての処理が完了しました。生成されたチャートとメール送信を確認してください。")
@@ -0,0 +1,36 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# 計測レポートを書かない・API を呼ばない
+os.environ['METRICS_DIR'] = ''
+for _k in ('JQUANTS_TOKEN', 'JQUANTS_ACCESS_TOKEN'):
+    os.environ.pop(_k, None)
+
+import price_matrix  # noqa: E402
+
+# 2026-01-05（月）からの営業日（土日を除く）
+_START = np.datetime64('2026-01-05')
+
+
+def sessions(n):
+    days = np.busday_offset(_START, np.arange(n), roll='forward')
+    return (days - np.datetime64('1970-01-01')).astype('int32')
+
+
+@pytest.fixture
+def build_matrix(tmp_path):
+    """{code: {'High': [...], 'Low': ..., 'Close': ..., 'Volume': ...}} から株価行列を作って開く（NaN は欠損）"""
+    def build(series, n_sessions=None):
+        n = n_sessions or max(len(v['Close']) for v in series.values())
+        dates = sessions(n)
+        writer = price_matrix.MatrixWriter(list(series), dates, path=str(tmp_path / 'matrix'))
+        for code, fields in series.items():
+            writer.add(code, dict({k: np.asarray(v, dtype='float64') for k, v in fields.items()},
+                                  date=dates[:len(fields['Close'])]))
+            writer.mark_complete(code)
+        return writer.commit()
+    return build
@@ -0,0 +1,54 @@
+from datetime import datetime
+
+import pytest
+
+import disclosure_sync
+import fundamentals_cache
+
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.setattr(fundamentals_cache, 'CACHE_DIR', str(tmp_path))
+    monkeypatch.setattr(disclosure_sync, 'STATE_FILE', str(tmp_path / 'disclosures.json'))
+    return tmp_path
+
+
+def _sync(monkeypatch, rows, announcements=(), **kwargs):
+    monkeypatch.setattr(disclosure_sync, 'fetch_disclosed', lambda headers, day: list(rows))
+    monkeypatch.setattr(disclosure_sync, 'fetch_announcements', lambda headers: list(announcements))
+    state = disclosure_sync.load_state()
+    invalidated = disclosure_sync.sync({}, today=datetime(2026, 10, 19), state=state, **kwargs)
+    return state, invalidated
+
+
+def test_five_digit_disclosure_invalidates_four_digit_holding(cache, monkeypatch):
+    # 保有銘柄は4桁（'5621'）、グロース銘柄は5桁（'13000'）でキャッシュされている
+    fundamentals_cache.put('statements', '5621', [{'x': 1}])
+    fundamentals_cache.put('statements', '13000', [{'x': 1}])
+    rows = [
+        {'LocalCode': '56210', 'DisclosureNumber': '1', 'TypeOfDocument': '3QFinancialStatements'},
+        {'LocalCode': '13000', 'DisclosureNumber': '2', 'TypeOfDocument': 'FYFinancialStatements',
+         'TypeOfCurrentPeriod': 'FY'},
+    ]
+    state, invalidated = _sync(monkeypatch, rows, codes=['5621', '13000'], holdings=['5621'])
+
+    assert invalidated == ['5621', '13000']
+    assert not fundamentals_cache.has('statements', '5621')
+    assert not fundamentals_cache.has('statements', '13000')
+    assert state['queue']['5621']['priority'] == disclosure_sync.PRIORITY_HOLDING
+    assert disclosure_sync.pending(state) == ['5621', '13000']
+
+
+def test_announcement_uses_target_code(cache, monkeypatch):
+    rows = [{'LocalCode': '99990', 'DisclosureNumber': '3', 'TypeOfDocument': '1QFinancialStatements'}]
+    announcements = [{'Code': '99990', 'Date': '2026-10-20', 'FiscalQuarter': 'FY'}]
+    state, _ = _sync(monkeypatch, rows, announcements, codes=['9999'])
+    assert '9999' in state['announced']
+    assert state['queue']['9999']['priority'] == disclosure_sync.PRIORITY_ANNUAL
+
+
+def test_untargeted_codes_are_skipped(cache, monkeypatch):
+    rows = [{'LocalCode': '56210', 'DisclosureNumber': '1'}]
+    state, invalidated = _sync(monkeypatch, rows, codes=['13000'])
+    assert invalidated == []
+    assert state['queue'] == {}
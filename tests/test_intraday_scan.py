@@ -0,0 +1,35 @@
+import numpy as np
+
+import intraday_scan
+
+
+class _Calendar:
+    def __init__(self, dates):
+        self.dates = [int(d) for d in dates]
+
+    def window_start(self, day):
+        return self.dates[0]
+
+    def previous_session(self, day):
+        return max(d for d in self.dates if d < day)
+
+
+def _bars(n, high):
+    return {'High': [high] * n, 'Low': [high - 10] * n, 'Close': [high - 5] * n, 'Volume': [1000.0] * n}
+
+
+def test_five_digit_feed_updates_four_digit_holding(build_matrix):
+    # 保有銘柄は4桁で行列にあり、フィードは5桁で届く
+    matrix = build_matrix({'5621': _bars(10, 100.0), '13000': _bars(10, 200.0)})
+    today = int(matrix.dates[-1]) + 1
+    state = intraday_scan.RollingHighState.from_matrix(matrix, _Calendar(matrix.dates), today)
+    assert state.past_max.tolist() == [100.0, 200.0]
+
+    idx, highs = state.arrays([{'Code': '56210', 'High': 101.0}, {'Code': '13000', 'High': 150.0},
+                               {'Code': '99990', 'High': 1.0}])
+    assert idx.tolist() == [0, 1]
+    hits = state.apply(idx, highs)
+    assert [state.codes[i] for i in hits] == ['5621']
+    # 同じ銘柄は2度出力しない
+    assert len(state.apply(*state.arrays([{'Code': '5621', 'High': 105.0}]))) == 0
+    assert np.isclose(state.day_high[0], 105.0)
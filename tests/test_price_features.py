@@ -0,0 +1,57 @@
+import numpy as np
+
+import price_features
+
+
+def _series(n, seed=0):
+    rng = np.random.default_rng(seed)
+    close = 100 * np.exp(np.cumsum(rng.normal(0, 0.02, n)))
+    return {'High': close * 1.01, 'Low': close * 0.99, 'Close': close,
+            'Volume': rng.integers(1000, 5000, n).astype('float64')}
+
+
+def test_volume_ratio_uses_full_prior_windows(build_matrix):
+    s = _series(80)
+    matrix = build_matrix({'5621': s})
+    keys, values = price_features.compute(matrix)
+    v = s['Volume'].astype('float32').astype('float64')
+    assert keys == ['5621']
+    assert np.isclose(values['volume_ratio'][0], v[-1] / v[-21:-1].mean())
+    assert np.isclose(values['volume_ratio_50'][0], v[-1] / v[-51:-1].mean())
+
+
+def test_volume_ratio_50_at_exactly_51_sessions(build_matrix):
+    s = _series(51, seed=1)
+    matrix = build_matrix({'5621': s})
+    _, values = price_features.compute(matrix)
+    v = s['Volume'].astype('float32').astype('float64')
+    assert np.isclose(values['volume_ratio_50'][0], v[-1] / v[:50].mean())
+
+
+def test_volatility_and_atr_window_lengths(build_matrix):
+    s = _series(40, seed=2)
+    matrix = build_matrix({'5621': s})
+    _, values = price_features.compute(matrix)
+    close = price_features.price_matrix.as_float64(s['Close'].astype('float32'))
+    high = price_features.price_matrix.as_float64(s['High'].astype('float32'))
+    low = price_features.price_matrix.as_float64(s['Low'].astype('float32'))
+    returns = np.diff(np.log(close))[-20:]
+    assert np.isclose(values['volatility'][0], returns.std(ddof=1) * np.sqrt(250))
+    prev = close[-15:-1]
+    tr = np.maximum(high[-14:] - low[-14:], np.maximum(abs(high[-14:] - prev), abs(low[-14:] - prev)))
+    assert np.isclose(values['atr_pct'][0], tr.mean() / close[-1])
+
+
+def test_short_history_is_nan(build_matrix):
+    matrix = build_matrix({'5621': _series(15)})
+    _, values = price_features.compute(matrix)
+    assert np.isnan(values['volume_ratio_50'][0])
+    assert not np.isnan(values['volume_ratio'][0])
+
+
+def test_lookup_accepts_both_code_forms(build_matrix):
+    matrix = build_matrix({'5621': _series(30), '13000': _series(30, seed=3)})
+    keys, values = price_features.compute(matrix)
+    out = price_features.lookup(matrix, keys, values, ['56210', '1300'])
+    assert set(out) == {'56210', '1300'}
+    assert out['56210']['volume_ratio'] == round(float(values['volume_ratio'][0]), 6)
@@ -0,0 +1,33 @@
+import numpy as np
+
+import price_matrix
+
+
+def _flat(n, close=100.0):
+    return {'High': [close + 1] * n, 'Low': [close - 1] * n, 'Close': [close] * n, 'Volume': [1000.0] * n}
+
+
+def test_code4():
+    assert price_matrix.code4('56210') == '5621'
+    assert price_matrix.code4('5621') == '5621'
+    assert price_matrix.code4('56211') == '56211'
+
+
+def test_code_for_resolves_both_forms(build_matrix):
+    matrix = build_matrix({'5621': _flat(5), '13000': _flat(5)})
+    assert matrix.code_for('56210') == '5621'
+    assert matrix.code_for('5621') == '5621'
+    assert matrix.code_for('1300') == '13000'
+    assert matrix.code_for('13000') == '13000'
+    assert matrix.code_for('9999') is None
+
+
+def test_writer_roundtrip_marks_missing_as_invalid(build_matrix):
+    series = _flat(4)
+    series['Close'] = [100.0, np.nan, 102.0, 103.0]
+    matrix = build_matrix({'5621': series})
+    assert matrix.n_sessions == 4
+    assert matrix.valid[matrix.row('5621')].tolist() == [True, False, True, True]
+    dates, closes = matrix.history('5621')
+    assert closes.tolist() == [100.0, 102.0, 103.0]
+    assert len(dates) == 3
@@ -0,0 +1,52 @@
+import numpy as np
+
+import quantile_sketch
+from quantile_sketch import KLLSketch
+
+
+def test_cdf_close_to_exact_rank():
+    rng = np.random.default_rng(0)
+    values = rng.normal(0, 1, 20000)
+    sketch = KLLSketch(k=200)
+    sketch.update_many(values)
+    probes = np.quantile(values, [0.05, 0.25, 0.5, 0.75, 0.95])
+    exact = np.searchsorted(np.sort(values), probes) / len(values)
+    assert np.max(np.abs(sketch.cdf(probes) - exact)) < 0.02
+    # 保持点数は観測数に依存しない
+    assert sketch._size() < 1000
+    assert sketch.n == 20000
+
+
+def test_merge_matches_single_stream():
+    rng = np.random.default_rng(1)
+    a, b = rng.random(5000), rng.random(5000) + 0.5
+    left, right = KLLSketch(), KLLSketch()
+    left.update_many(a)
+    right.update_many(b)
+    merged = left.merge(right)
+    assert merged.n == 10000
+    assert merged.min == a.min() and merged.max == b.max()
+    exact = np.mean(np.concatenate([a, b]) < 0.75)
+    assert abs(merged.cdf([0.75])[0] - exact) < 0.03
+
+
+def test_nan_is_ignored_and_roundtrip():
+    sketch = KLLSketch()
+    sketch.update_many([1.0, float('nan'), 2.0, 3.0])
+    assert sketch.n == 3
+    restored = KLLSketch.from_dict(sketch.to_dict())
+    assert restored.n == 3
+    assert restored.cdf([2.0]).tolist() == sketch.cdf([2.0]).tolist() == [0.5]
+
+
+def test_update_refuses_same_day_twice(tmp_path):
+    path = str(tmp_path / 'sketches.json')
+    state = quantile_sketch.load(path)
+    assert quantile_sketch.update(state, {'roe': [0.1, 0.2]}, '20261019')
+    quantile_sketch.save(state, path)
+    state = quantile_sketch.load(path)
+    assert state['version'] == 1 and state['metrics']['roe'].n == 2
+    assert not quantile_sketch.update(state, {'roe': [0.3]}, '20261019')
+    assert not quantile_sketch.update(state, {'roe': [0.3]}, '20261016')
+    assert quantile_sketch.update(state, {'roe': [0.3]}, '20261020')
+    assert state['version'] == 2 and state['metrics']['roe'].n == 3
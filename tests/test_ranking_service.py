@@ -0,0 +1,45 @@
+import json
+
+import ranking_service
+
+
+def _results():
+    qualified = [
+        {'code': '13000', 'comprehensive_score': 0.9, 'is_holding': False},
+        {'code': '5621', 'comprehensive_score': 0.8, 'is_holding': True},
+        {'code': '13010', 'comprehensive_score': 0.7, 'is_holding': False},
+    ]
+    return {
+        'analysis_date': '20261019',
+        'top3_stocks': [qualified[0], qualified[2]],
+        'qualified_stocks': qualified,
+        'holding_stocks': [qualified[1]],
+        'excluded_stocks': [{'code': '13020', 'reason': '時価総額N/A'}],
+        'token': 'secret-token',
+    }
+
+
+def _body(rankings, path):
+    return json.loads(rankings.lookup(path).body)
+
+
+def test_holdings_report_rank_within_qualified():
+    rankings = ranking_service.Rankings(_results())
+    assert [s['rank'] for s in _body(rankings, '/holdings')['stocks']] == [2]
+    stock = _body(rankings, '/stock/5621')['stock']
+    assert stock['status'] == 'holding' and stock['rank'] == 2
+    # 保有銘柄以外の順位は保有銘柄を除いた順位（上位3と同じ並び）
+    assert _body(rankings, '/stock/13010')['stock']['rank'] == 2
+
+
+def test_stock_lookup_accepts_both_code_forms():
+    rankings = ranking_service.Rankings(_results())
+    assert rankings.lookup('/stock/56210') is rankings.lookup('/stock/5621')
+    assert rankings.lookup('/stock/1300') is rankings.lookup('/stock/13000')
+    assert rankings.lookup('/stock/9999') is None
+
+
+def test_token_is_not_served():
+    rankings = ranking_service.Rankings(_results())
+    for path in ('/top', '/holdings', '/excluded', '/health', '/stock/13000'):
+        assert b'secret-token' not in rankings.lookup(path).body
@@ -0,0 +1,34 @@
+import numpy as np
+
+import score_history
+
+
+def _row(code, score, flags=0, rank=0):
+    return {'code': code, 'name': code, 'comprehensive': score, 'area': score, 'shape': 1.0,
+            'scores': [score] * 7, 'flags': flags, 'rank': rank, 'reason': None}
+
+
+def test_append_replaces_same_day_and_indexes_by_code(tmp_path):
+    path = str(tmp_path)
+    score_history.append('20261016', [_row('5621', 0.5, score_history.TOP3, 1), _row('13000', 0.2)], path)
+    score_history.append('20261019', [_row('5621', 0.1), _row('13000', 0.3)], path)
+    # 同じ日の再実行はその日だけを置き換える
+    score_history.append('20261019', [_row('5621', 0.6, score_history.TOP3, 1), _row('13000', 0.4)], path)
+
+    history = score_history.ScoreHistory(path)
+    assert history.summary() == {'partitions': 2, 'codes': 2, 'rows': 4}
+    dates, values = history.trajectory('5621', days=30)
+    assert dates == [20261016, 20261019]
+    assert values.tolist() == [0.5, 0.6]
+    _, area = history.trajectory('13000', days=30, col='area')
+    assert area.tolist() == [0.2, 0.4]
+    assert history.days_with('5621', score_history.TOP3, since=score_history.quarter_start(20261019)) == 2
+    assert history.days_with('13000', score_history.TOP3) == 0
+    assert len(history.entries_for('9999')) == 0
+
+
+def test_quarter_start_and_sparkline():
+    assert score_history.quarter_start('2026-11-30') == 20261001
+    assert score_history.quarter_start(20260331) == 20260101
+    assert score_history.sparkline([0, 1]) == '▁█'
+    assert score_history.sparkline(np.array([])) == ''
@@ -0,0 +1,79 @@
+import io
+import json
+import tarfile
+
+import pytest
+
+import snapshot
+
+
+@pytest.fixture
+def sketch_source(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    root = tmp_path / 'sketches'
+    root.mkdir()
+    (root / 'sketches.json').write_text('{"version": 1}')
+    monkeypatch.setitem(snapshot.SOURCES, 'sketches', (str(root), snapshot.SOURCES['sketches'][1]))
+    return root
+
+
+def _rewrite(path, name, data):
+    """name のエントリだけ中身を差し替えた tar.gz を書き直す（manifest のチェックサムはそのまま）"""
+    with tarfile.open(path, 'r:gz') as tar:
+        members = [(m, tar.extractfile(m).read()) for m in tar]
+    with tarfile.open(path, 'w:gz') as tar:
+        for member, content in members:
+            if member.name == name:
+                content = data
+                member.size = len(data)
+            tar.addfile(member, io.BytesIO(content))
+
+
+def test_roundtrip(sketch_source, tmp_path):
+    path = str(tmp_path / 'state.tar.gz')
+    manifest = snapshot.export(path, sources=['sketches'])
+    assert list(manifest['files']) == ['sketches/sketches.json']
+    (sketch_source / 'sketches.json').write_text('changed')
+    assert snapshot.import_snapshot(path, sources=['sketches']) == ['sketches']
+    assert json.loads((sketch_source / 'sketches.json').read_text()) == {'version': 1}
+
+
+def test_checksum_mismatch_is_rejected_without_changes(sketch_source, tmp_path):
+    path = str(tmp_path / 'state.tar.gz')
+    snapshot.export(path, sources=['sketches'])
+    _rewrite(path, 'sketches/sketches.json', b'{"version": 2}')
+    (sketch_source / 'sketches.json').write_text('local')
+    with pytest.raises(snapshot.SnapshotError, match='チェックサム'):
+        snapshot.import_snapshot(path, sources=['sketches'])
+    assert (sketch_source / 'sketches.json').read_text() == 'local'
+    assert not list(tmp_path.glob('.snapshot_import.*'))
+
+
+def test_unexpected_entry_is_rejected(sketch_source, tmp_path):
+    path = str(tmp_path / 'state.tar.gz')
+    snapshot.export(path, sources=['sketches'])
+    with tarfile.open(path, 'r:gz') as tar:
+        members = [(m, tar.extractfile(m).read()) for m in tar]
+    with tarfile.open(path, 'w:gz') as tar:
+        for member, content in members:
+            tar.addfile(member, io.BytesIO(content))
+        extra = tarfile.TarInfo('sketches/../../evil.txt')
+        extra.size = 1
+        tar.addfile(extra, io.BytesIO(b'x'))
+    with pytest.raises(snapshot.SnapshotError, match='想定外'):
+        snapshot.import_snapshot(path, sources=['sketches'])
+    assert not (tmp_path.parent / 'evil.txt').exists()
+
+
+def test_working_directory_source_is_refused(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setitem(snapshot.SOURCES, 'charts', ('.', 1))
+    with pytest.raises(snapshot.SnapshotError):
+        snapshot.export(str(tmp_path / 'out' / 'state.tar.gz'), sources=['charts'])
+
+
+def test_secret_in_file_blocks_export(sketch_source, tmp_path, monkeypatch):
+    monkeypatch.setenv('JQUANTS_TOKEN', 'x' * 32)
+    (sketch_source / 'sketches.json').write_text('token=' + 'x' * 32)
+    with pytest.raises(snapshot.SnapshotError, match='トークン'):
+        snapshot.export(str(tmp_path / 'state.tar.gz'), sources=['sketches'])
@@ -0,0 +1,16 @@
+import price_matrix
+import step1_stock_scanner as step1
+from conftest import sessions
+
+
+class _Calendar:
+    def sessions_between(self, start, end):
+        return sessions(5)
+
+
+def test_holding_that_is_also_growth_gets_one_row(tmp_path, monkeypatch):
+    monkeypatch.setattr(price_matrix, 'MATRIX_DIR', str(tmp_path / 'matrix'))
+    results, writer = step1.prepare_price_matrix(
+        {}, _Calendar(), ['13000', '56210', '5621', '5527'], '20260105', '20260109')
+    assert results == {}
+    assert writer.codes == ['13000', '56210', '5527']
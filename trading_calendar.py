@@ -0,0 +1,197 @@
+# 新高値ブレイク法システム - 取引カレンダー（markets/trading_calendar をキャッシュして営業日を解決）
+
+import json
+import os
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+import instrumentation
+from jquants_http import API_BASE, JQuantsError, iter_records
+from quotes_decoder import date_ordinal, ordinal_to_str
+
+# カレンダーのキャッシュ（月が変わったら取り直す）
+CALENDAR_CACHE_FILE = os.environ.get('TRADING_CALENDAR_CACHE', os.path.join('.calendar_cache', 'trading_calendar.json'))
+# 日足が公開される時刻（JST, HH:MM）。これより前に実行した場合は前営業日を分析対象にする
+QUOTES_READY_TIME = os.environ.get('QUOTES_READY_TIME', '16:30')
+# 65週の判定窓を営業日数で表す（65週 × 5営業日）
+WINDOW_SESSIONS_65W = int(os.environ.get('HIGH_WINDOW_SESSIONS', str(65 * 5)))
+
+# HolidayDivision: 1=営業日, 2=半日立会日 は取引あり / 0=休業日, 3=祝日取引のある休業日 は取引なし
+SESSION_DIVISIONS = ('1', '2')
+# 取得範囲（65週窓 + 余裕、先の営業日も少し持っておく）
+LOOKBACK_DAYS = 800
+LOOKAHEAD_DAYS = 120
+
+JST = timezone(timedelta(hours=9))
+
+
+def _ordinal(day):
+    """日数（int）はそのまま、日付・文字列は 1970-01-01 からの日数に変換する"""
+    if isinstance(day, (int, np.integer)):
+        return int(day)
+    return date_ordinal(day)
+
+
+class TradingCalendar:
+    """営業日の集合（日付は 1970-01-01 からの日数で保持）"""
+
+    def __init__(self, sessions, first, last, source='api'):
+        self.sessions = np.unique(np.asarray(sessions, dtype='int32'))
+        self.first = int(first)
+        self.last = int(last)
+        self.source = source
+
+    @classmethod
+    def weekdays(cls, first, last):
+        """カレンダーが取得できない場合の代替（土日のみ休場とみなす）"""
+        days = np.arange(date_ordinal(first), date_ordinal(last) + 1).astype('datetime64[D]')
+        ordinals = days[np.is_busday(days)].astype('int64')
+        return cls(ordinals, date_ordinal(first), date_ordinal(last), source='weekdays')
+
+    def covers(self, day):
+        return self.first <= _ordinal(day) <= self.last
+
+    def is_session(self, day):
+        d = _ordinal(day)
+        i = int(np.searchsorted(self.sessions, d))
+        return i < len(self.sessions) and int(self.sessions[i]) == d
+
+    def session_on_or_before(self, day):
+        """day 以前の直近営業日（無ければ None）"""
+        i = int(np.searchsorted(self.sessions, _ordinal(day), side='right'))
+        return int(self.sessions[i - 1]) if i > 0 else None
+
+    def previous_session(self, day):
+        """day より前の直近営業日（無ければ None）"""
+        i = int(np.searchsorted(self.sessions, _ordinal(day), side='left'))
+        return int(self.sessions[i - 1]) if i > 0 else None
+
+    def sessions_between(self, first, last):
+        """[first, last] の営業日（日数のリスト）"""
+        lo = int(np.searchsorted(self.sessions, _ordinal(first), side='left'))
+        hi = int(np.searchsorted(self.sessions, _ordinal(last), side='right'))
+        return [int(d) for d in self.sessions[lo:hi]]
+
+    def window_start(self, day, n_sessions=WINDOW_SESSIONS_65W):
+        """day の n_sessions 営業日前（カレンダーの範囲外なら None）"""
+        i = int(np.searchsorted(self.sessions, _ordinal(day), side='left'))
+        if i - n_sessions < 0:
+            return None
+        return int(self.sessions[i - n_sessions])
+
+    def to_json(self):
+        return {
+            'source': self.source,
+            'from': ordinal_to_str(self.first),
+            'to': ordinal_to_str(self.last),
+            'sessions': [ordinal_to_str(d) for d in self.sessions],
+        }
+
+    @classmethod
+    def from_json(cls, doc):
+        return cls([date_ordinal(d) for d in doc.get('sessions', [])],
+                   date_ordinal(doc['from']), date_ordinal(doc['to']), doc.get('source', 'api'))
+
+
+def now_jst():
+    return datetime.now(JST).replace(tzinfo=None)
+
+
+def _read_cache(path):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            doc = json.load(f)
+        return doc, TradingCalendar.from_json(doc)
+    except (OSError, ValueError, KeyError):
+        return None, None
+
+
+def _write_cache(path, cal, fetched_at):
+    try:
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'fetched_at': fetched_at.isoformat(timespec='seconds'), **cal.to_json()}, f)
+        os.replace(tmp, path)
+    except OSError as e:
+        print(f"取引カレンダーのキャッシュ保存に失敗: {e}")
+
+
+def fetch_calendar(headers, first, last):
+    """markets/trading_calendar から [first, last] の営業日を取得する"""
+    params = {'from': first.strftime('%Y%m%d'), 'to': last.strftime('%Y%m%d')}
+    sessions = [date_ordinal(r['Date'])
+                for r in iter_records(f"{API_BASE}/markets/trading_calendar", 'trading_calendar', params=params, headers=headers)
+                if r.get('Date') and str(r.get('HolidayDivision')) in SESSION_DIVISIONS]
+    return TradingCalendar(sessions, date_ordinal(first), date_ordinal(last))
+
+
+def load_calendar(headers, today=None, cache_file=None):
+    """キャッシュ済みカレンダーを返す。月が変わった・範囲外の場合は取り直す。
+
+    取得に失敗した場合は古いキャッシュ、それも無ければ平日カレンダーで代替する。
+    """
+    cache_file = cache_file or CALENDAR_CACHE_FILE
+    now = now_jst()
+    today = today or now
+    doc, cached = _read_cache(cache_file)
+    if cached is not None and cached.source == 'api':
+        fetched = doc.get('fetched_at', '')[:7]
+        if fetched == now.strftime('%Y-%m') and cached.covers(today):
+            instrumentation.record_cache('calendar', True)
+            return cached
+    instrumentation.record_cache('calendar', False)
+
+    first = today - timedelta(days=LOOKBACK_DAYS)
+    last = today + timedelta(days=LOOKAHEAD_DAYS)
+    try:
+        cal = fetch_calendar(headers, first, last)
+        if len(cal.sessions):
+            _write_cache(cache_file, cal, now)
+            return cal
+        print("取引カレンダーが空でした")
+    except JQuantsError as e:
+        print(f"取引カレンダー取得エラー: {e}")
+    if cached is not None and cached.covers(today):
+        print("  → 前回取得したカレンダーを使用します")
+        return cached
+    print("  → 土日のみを休場日とみなして続行します")
+    return TradingCalendar.weekdays(first, last)
+
+
+def plan_session(cal, now=None, scan_date=None):
+    """分析対象の営業日を決める。戻り値: (営業日の日数 or None, 理由)
+
+    - scan_date 指定時はその日（休場日ならスキップ）
+    - 休場日（土日・祝日・年末年始）はスキップ
+    - 日足の公開前（QUOTES_READY_TIME より前）は前営業日
+    """
+    if scan_date:
+        d = _ordinal(scan_date)
+        if not cal.is_session(d):
+            return None, f"SCAN_DATE {ordinal_to_str(d)} は休場日です"
+        return d, 'SCAN_DATE 指定'
+
+    now = now or now_jst()
+    today = date_ordinal(now)
+    if not cal.is_session(today):
+        return None, f"{ordinal_to_str(today)} は休場日です"
+    if now.strftime('%H:%M') < QUOTES_READY_TIME:
+        prev = cal.previous_session(today)
+        if prev is None:
+            return None, '前営業日がカレンダーにありません'
+        return prev, f"日足公開前（{QUOTES_READY_TIME} JST 以前）のため前営業日を対象にします"
+    return today, '当日'
+
+
+def export_github_output(name, value):
+    """GitHub Actions のステップ出力に書き出す（Actions 以外では何もしない）"""
+    path = os.environ.get('GITHUB_OUTPUT')
+    if not path:
+        return
+    try:
+        with open(path, 'a', encoding='utf-8') as f:
+            f.write(f"{name}={value}\n")
+    except OSError:
+        pass